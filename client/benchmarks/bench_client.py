@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks of the client's collection and cache replay paths.
+
+    python benchmarks/bench_client.py [--check | --update] [name ...]
+
+runs every benchmark (or the named ones) on a plain Linux machine: the
+board files under /proc and /sys come from fixture trees (FIXTURES),
+vcgencmd is a fake shell script put first on PATH and psutil returns large
+synthetic interface and process sets. For every benchmark it reports the
+shortest duration of a call, the subprocesses a call starts and the peak
+memory it allocates (tracemalloc), next to the values in baselines.json.
+
+--check exits with status 1 when a benchmark starts more subprocesses
+than its baseline, or is slower or allocates more than its baseline by
+more than --tolerance. Durations depend on the machine, so record the
+baselines with --update on the machine that checks them; subprocess
+counts and allocations do not.
+"""
+import argparse
+import contextlib
+import functools
+import importlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+client = importlib.import_module('client')
+probes = importlib.import_module('probes')
+spooling = importlib.import_module('spooling')
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'baselines.json')
+REPEAT = 20
+# Calls faster than this are timed in loops that take about this long.
+MIN_TIMED_SECONDS = 0.01
+# Allowed slowdown or allocation growth over the baseline, as a fraction.
+TOLERANCE = 0.5
+
+# Synthetic sizes, well above what a Pi sees, so costs that grow with them
+# stand out.
+INTERFACES = 500
+PROCESSES = 1000
+DISKS = 64
+CACHED_SAMPLES = 60
+SPOOLED_BATCHES = 10
+
+# Board files, by path below the fixture root; the probes' path constants
+# (BOARD_PATHS) are pointed into the tree of the board being benchmarked.
+FIXTURES = {
+    # Temperature, throttling and voltages come from vcgencmd.
+    'pi4': {
+        'proc/device-tree/model': 'Raspberry Pi 4 Model B Rev 1.4\x00',
+    },
+    # Everything is read from sysfs.
+    'bananapi': {
+        'proc/device-tree/model': 'Banana Pi BPI-M1\x00',
+        'sys/class/thermal/thermal_zone0/temp': '47125\n',
+        'sys/devices/platform/soc/1c2ac00.i2c/i2c-1/1-0034/ac/amperage':
+            '512\n',
+        'sys/devices/platform/soc/1c2ac00.i2c/i2c-1/1-0034/ac/voltage':
+            '5012000\n',
+    },
+}
+BOARD_PATHS = ('DEVICE_MODEL_PATH', 'THERMAL_ZONE_PATH', 'BANANA_POWER_PATH',
+               'MAX17042_CURRENT_PATH', 'DISKSTATS_PATH', 'MOUNTS_PATH',
+               'SYS_BLOCK_PATH')
+
+# Answers like the real vcgencmd, without forking anything else.
+FAKE_VCGENCMD = """#!/bin/sh
+case "$1" in
+    measure_temp) echo "temp=48.3'C" ;;
+    get_throttled) echo "throttled=0x0" ;;
+    measure_volts) echo "volt=0.8500V" ;;
+    *) exit 1 ;;
+esac
+"""
+
+NetIO = namedtuple('NetIO', 'bytes_sent bytes_recv packets_sent packets_recv')
+NetStats = namedtuple('NetStats', 'isup speed mtu')
+Address = namedtuple('Address', 'family address')
+CpuTimes = namedtuple('CpuTimes', 'user system')
+MemoryInfo = namedtuple('MemoryInfo', 'rss')
+Response = namedtuple('Response', 'status_code headers raise_for_status')
+
+# A sample as the client sends it, for the cache replay.
+SAMPLE = {
+    'cpu': {'usage': 12.5, 'frequency': 1500.0},
+    'memory': {'total': 3.7, 'used': 0.81, 'available': 2.89,
+               'percentage': 21.9},
+    'disk': {'total': 29.0, 'used': 7.5, 'free': 20.3, 'percentage': 25.86},
+    'network': {
+        'total': {'bytes_sent': 123456789, 'bytes_recv': 987654321,
+                  'packets_sent': 123456, 'packets_recv': 654321},
+        'interfaces': {'eth0': {
+            'bytes_sent': 123456789, 'bytes_recv': 987654321,
+            'packets_sent': 123456, 'packets_recv': 654321,
+            'speed': 1000, 'is_up': True, 'mtu': 1500,
+            'addresses': ['192.168.1.20', 'fe80::1']}},
+    },
+    'throttled': '0x0',
+    'voltages': {'core': 0.85, 'sdram_c': 1.1, 'sdram_i': 1.1,
+                 'sdram_p': 1.1},
+    'temperature': 48.3,
+    'uptime': 86400.0,
+}
+
+
+def disk_files(count):
+    """Return /proc/diskstats, the mount table and /sys/block entries for
+    `count` disks with a partition each, plus loop devices."""
+    stats, files = [], {}
+    for i in range(count):
+        name = f'mmcblk{i}'
+        counters = ' '.join(str(i * 1000 + j) for j in range(11))
+        stats.append(f' 179 {i * 8} {name} {counters}')
+        stats.append(f' 179 {i * 8 + 1} {name}p1 {counters}')
+        files[f'sys/block/{name}/dev'] = f'179:{i * 8}\n'
+    for i in range(8):
+        stats.append(f'   7 {i} loop{i} ' + ' '.join('0' * 11))
+        files[f'sys/block/loop{i}/dev'] = f'7:{i}\n'
+    files['proc/diskstats'] = '\n'.join(stats) + '\n'
+    files['proc/self/mounts'] = (
+        '/dev/root / ext4 rw,noatime 0 0\n'
+        'proc /proc proc rw,nosuid,nodev,noexec,relatime 0 0\n'
+        '/dev/mmcblk1p1 /mnt/ssd ext4 rw,relatime 0 0\n'
+        'nas:/export /mnt/nas nfs4 rw,relatime 0 0\n'
+    )
+    return files
+
+
+class CountingPopen(subprocess.Popen):
+    """subprocess.Popen that counts the processes it starts."""
+
+    started = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingPopen.started += 1
+        super().__init__(*args, **kwargs)
+
+
+class FakeProcess:
+    """psutil.Process of a synthetic process whose CPU time keeps growing."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.cpu = 0.0
+
+    def name(self):
+        """Return the process name."""
+        return f'worker-{self.pid % 50}'
+
+    def oneshot(self):
+        """Return a no-op context, like psutil's cache."""
+        return contextlib.nullcontext()
+
+    def cpu_times(self):
+        """Return a CPU time that grows with every read."""
+        self.cpu += (self.pid % 7) / 100
+        return CpuTimes(self.cpu, 0.0)
+
+    def memory_info(self):
+        """Return the resident memory."""
+        return MemoryInfo((self.pid % 300) * 1024**2)
+
+
+# The answer to an accepted /api/data request.
+ACCEPTED = Response(201, {}, lambda: None)
+
+
+def fake_post(url, payload, headers, timeout=10):
+    """Stand-in for client.post_json that only encodes the payload."""
+    del url, headers, timeout
+    json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return ACCEPTED
+
+
+class Fixtures:
+    """The fixture trees, the fake vcgencmd and the synthetic psutil data,
+    written below a directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        for board, files in FIXTURES.items():
+            for path, content in dict(files, **disk_files(DISKS)).items():
+                path = os.path.join(directory, board, path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w', encoding='UTF-8') as f:
+                    f.write(content)
+        self.bin_dir = os.path.join(directory, 'bin')
+        os.makedirs(self.bin_dir)
+        vcgencmd = os.path.join(self.bin_dir, 'vcgencmd')
+        with open(vcgencmd, 'w', encoding='UTF-8') as f:
+            f.write(FAKE_VCGENCMD)
+        os.chmod(vcgencmd, 0o755)
+        self.interfaces = self.make_interfaces(INTERFACES)
+
+    @staticmethod
+    def make_interfaces(count):
+        """Return synthetic (counters, addresses, stats) of `count`
+        interfaces: mostly up, some down, idle or virtual."""
+        counters, addresses, stats = {}, {}, {}
+        for i in range(count):
+            name = ('veth', 'eth', 'wlan', 'docker')[i % 4] + str(i)
+            counters[name] = NetIO(i * 1000 * (i % 9 != 0), i * 2000,
+                                   i * 10, i * 20)
+            stats[name] = NetStats(i % 5 != 0, 1000, 1500)
+            addresses[name] = [Address(2, f'10.{i // 250}.{i % 250}.1'),
+                               Address(10, f'fe80::{i:x}'),
+                               Address(17, '00:11:22:33:44:55')]
+        counters['lo'] = NetIO(1, 1, 1, 1)
+        return counters, addresses, stats
+
+    @contextlib.contextmanager
+    def board(self, name):
+        """Run the client against the fixture tree of a board."""
+        root = os.path.join(self.directory, name)
+        with contextlib.ExitStack() as stack:
+            for constant in BOARD_PATHS:
+                stack.enter_context(patch.object(
+                    probes, constant,
+                    os.path.join(root, getattr(probes, constant).lstrip('/'))
+                ))
+            stack.enter_context(patch.dict(os.environ, {
+                'PATH': self.bin_dir + os.pathsep + os.environ.get('PATH', '')
+            }))
+            yield
+
+    @contextlib.contextmanager
+    def psutil(self):
+        """Make psutil return the synthetic interfaces and processes and
+        read the CPU usage without its one-second wait."""
+        counters, addresses, stats = self.interfaces
+        total = NetIO(*(sum(values) for values in zip(*counters.values())))
+        with patch('psutil.net_io_counters',
+                   lambda pernic=False: counters if pernic else total), \
+                patch('psutil.net_if_addrs', lambda: addresses), \
+                patch('psutil.net_if_stats', lambda: stats), \
+                patch('psutil.cpu_percent', lambda interval=None: 12.5), \
+                patch('psutil.pids', lambda: list(range(1, PROCESSES + 1))), \
+                patch('psutil.Process', FakeProcess):
+            yield
+
+
+# name -> context manager taking the Fixtures and yielding (prepare, run):
+# run() is measured, prepare() (or None) is called untimed before each run.
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register the decorated generator function as a benchmark."""
+    def register(setup):
+        BENCHMARKS[name] = contextlib.contextmanager(setup)
+        return setup
+    return register
+
+
+@benchmark('active_ifaces')
+def bench_active_ifaces(fixtures):
+    """get_active_ifaces() over the synthetic interfaces."""
+    counters, addresses, stats = fixtures.interfaces
+    yield None, lambda: probes.get_active_ifaces(counters, addresses, stats)
+
+
+@benchmark('temperature_pi4')
+def bench_temperature_pi4(fixtures):
+    """get_temperature() through vcgencmd."""
+    with fixtures.board('pi4'):
+        yield None, probes.get_temperature
+
+
+@benchmark('temperature_bananapi')
+def bench_temperature_bananapi(fixtures):
+    """get_temperature() from the thermal zone."""
+    with fixtures.board('bananapi'):
+        yield None, probes.get_temperature
+
+
+@benchmark('voltage_pi4')
+def bench_voltage_pi4(fixtures):
+    """get_voltage_info() through vcgencmd, one call per rail."""
+    with fixtures.board('pi4'):
+        yield None, probes.get_voltage_info
+
+
+@benchmark('voltage_bananapi')
+def bench_voltage_bananapi(fixtures):
+    """get_voltage_info() from the power management chip in sysfs."""
+    with fixtures.board('bananapi'):
+        yield None, probes.get_voltage_info
+
+
+@benchmark('disk_io')
+def bench_disk_io(fixtures):
+    """The disk_io probe over the synthetic disks."""
+    tracker = probes.DiskTracker(('/', '/mnt/ssd', '/mnt/missing'))
+    with fixtures.board('pi4'):
+        tracker.read()
+        yield None, tracker.read
+
+
+@benchmark('processes')
+def bench_processes(fixtures):
+    """The processes probe over the synthetic processes, with warm PID
+    cache."""
+    tracker = probes.ProcessTracker()
+    with fixtures.psutil():
+        tracker.read()
+        yield None, tracker.read
+
+
+@benchmark('collect_pi4')
+def bench_collect_pi4(fixtures):
+    """collect_metrics_once() with the default probes."""
+    with fixtures.board('pi4'), fixtures.psutil(), \
+            patch.object(probes, 'disk_tracker', probes.DiskTracker()):
+        yield None, probes.collect_metrics_once
+
+
+@benchmark('cache_replay')
+def bench_cache_replay(fixtures):
+    """Spool.send_cache() of cached samples and spooled batches to a server
+    that accepts everything."""
+    template = os.path.join(fixtures.directory, 'replay_template.db')
+    if not os.path.exists(template):
+        batch = [SAMPLE] * spooling.SPOOL_FLUSH_SAMPLES
+        conn = sqlite3.connect(template)
+        spooling.create_cache_tables(conn.cursor())
+        conn.executemany(
+            'INSERT INTO metrics_cache (metrics_json) VALUES (?)',
+            [(json.dumps(SAMPLE),)] * CACHED_SAMPLES)
+        conn.executemany(
+            'INSERT INTO spool_batches (samples, payload) VALUES (?, ?)',
+            [(len(batch), spooling.encode_batch(batch))] * SPOOLED_BATCHES)
+        conn.commit()
+        conn.close()
+    path = os.path.join(fixtures.directory, 'replay.db')
+    config = {'device_id': 1, 'server_url': 'http://localhost:5000'}
+    send = functools.partial(client.send_samples, config)
+    with patch.object(spooling, 'LOCAL_DB_PATH', path), \
+            patch.object(client, 'post_json', fake_post), \
+            patch.object(client.spool, 'cache_pending', True):
+        yield (lambda: shutil.copyfile(template, path),
+               lambda: client.spool.send_cache(send))
+
+
+def _nothing():
+    pass
+
+
+def measure(prepare, run, repeat=REPEAT):
+    """Return the shortest duration, subprocesses and peak allocation of
+    a call of run(). The shortest of `repeat` timings is the one least
+    disturbed by the rest of the machine."""
+    prepare = prepare or _nothing
+    with contextlib.redirect_stdout(io.StringIO()), \
+            patch.object(subprocess, 'Popen', CountingPopen):
+        # Warm up imports and caches first.
+        prepare()
+        run()
+
+        prepare()
+        CountingPopen.started = 0
+        tracemalloc.start()
+        try:
+            base = tracemalloc.get_traced_memory()[0]
+            run()
+            peak = tracemalloc.get_traced_memory()[1] - base
+        finally:
+            tracemalloc.stop()
+        started = CountingPopen.started
+
+        # Fast calls without preparation are timed in loops; timer
+        # resolution and scheduling noise would swamp single calls.
+        number = 1
+        if prepare is _nothing:
+            begin = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - begin
+            if elapsed < MIN_TIMED_SECONDS:
+                number = int(MIN_TIMED_SECONDS / max(elapsed, 1e-7))
+
+        durations = []
+        for _ in range(repeat):
+            prepare()
+            begin = time.perf_counter()
+            for _ in range(number):
+                run()
+            durations.append((time.perf_counter() - begin) / number)
+    return {
+        'best_ms': round(min(durations) * 1000, 3),
+        'subprocesses': started,
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def run_benchmarks(names=None, repeat=REPEAT):
+    """Run the named benchmarks (default: all); returns {name: result}."""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        fixtures = Fixtures(directory)
+        for name in names or BENCHMARKS:
+            with BENCHMARKS[name](fixtures) as (prepare, run):
+                results[name] = measure(prepare, run, repeat)
+    return results
+
+
+def compare(result, baseline, tolerance=TOLERANCE):
+    """Return the regressions of a result against its baseline."""
+    problems = []
+    if result['subprocesses'] > baseline['subprocesses']:
+        problems.append(f"{result['subprocesses']} subprocesses, baseline "
+                        f"{baseline['subprocesses']}")
+    for key, unit in (('best_ms', 'ms'), ('peak_kb', 'KB')):
+        limit = baseline[key] * (1 + tolerance)
+        if result[key] > limit:
+            problems.append(f'{result[key]:g} {unit}, baseline '
+                            f'{baseline[key]:g} {unit}')
+    return problems
+
+
+def load_baselines(path=BASELINES_FILE):
+    """Return the stored baselines, or {} if there are none."""
+    try:
+        with open(path, 'r', encoding='UTF-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the client collection paths.'
+    )
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help=f"benchmarks to run: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help='timed calls per benchmark')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='allowed slowdown and allocation growth')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--check', action='store_true',
+                      help='exit with status 1 on regressions')
+    mode.add_argument('--update', action='store_true',
+                      help='store the results as the new baselines')
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    baselines = load_baselines()
+    results = run_benchmarks(args.names, args.repeat)
+    failed = False
+    print(f"{'benchmark':<22}{'best ms':>12}{'baseline':>10}"
+          f"{'procs':>7}{'peak KB':>10}{'baseline':>10}")
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        print(f"{name:<22}{result['best_ms']:>12.3f}"
+              f"{baseline['best_ms'] if baseline else '-':>10}"
+              f"{result['subprocesses']:>7}{result['peak_kb']:>10.1f}"
+              f"{baseline['peak_kb'] if baseline else '-':>10}")
+        if args.check and baseline:
+            for problem in compare(result, baseline, args.tolerance):
+                print(f'  REGRESSION: {problem}')
+                failed = True
+
+    if args.update:
+        baselines.update(results)
+        with open(BASELINES_FILE + '.tmp', 'w', encoding='UTF-8') as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+            f.write('\n')
+        os.replace(BASELINES_FILE + '.tmp', BASELINES_FILE)
+        print(f'Baselines written to {BASELINES_FILE}.')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,27 @@
-"""Client code for Raspberry Pi status monitoring."""
+"""
+Client code for Raspberry Pi status monitoring.
+
+Modules that are large or only needed some of the time (requests, psutil,
+sqlite3, subprocess, the profilers) are LazyModules, imported when they
+are first used, so the client only pays for what it actually runs.
+"""
+import functools
+import hashlib
+import hmac
 import json
 import os
+import signal
 import socket
-import sqlite3
-import subprocess
+import struct
 import time
 import uuid
+import zlib
+from urllib.parse import urlparse
 
-import psutil
-import requests
+from lazy import LazyModule
+from probes import PROBES, ProbeScheduler, disk_tracker, process_tracker
+from spooling import LOCAL_DB_PATH, Spool, init_local_db
+from streaming import StreamChannel, uses_stream
 
 
 SERVER_URL = 'http://localhost:5000'
@@ -20,7 +33,54 @@ if not SERVER_URL.endswith(':5000') and not SERVER_URL.endswith(':5000/'):
 COLLECT_INTERVAL = 10  # seconds
 BASE_PATH = os.path.dirname(os.path.abspath(__file__))
 CLIENT_CONFIG_FILE = os.path.join(BASE_PATH, 'client_config.json')
-LOCAL_DB_PATH = os.path.join(BASE_PATH, 'local_cache.db')
+
+# Statuses the server uses to shed load; both come with a Retry-After hint.
+BACKOFF_STATUSES = (429, 503)
+
+# Datagram format of the optional UDP transport ("transport": "udp" in
+# client_config.json); must match server/udp_ingest.py.
+UDP_MAGIC = b'RM'
+UDP_FORMAT_VERSION = 1
+UDP_FLAG_ZLIB = 0x01
+UDP_HEADER = struct.Struct('!2sBBQQ')
+UDP_MAC_SIZE = 16
+
+cProfile = LazyModule('cProfile')
+http_client = LazyModule('http.client')
+pstats = LazyModule('pstats')
+psutil = LazyModule('psutil')
+requests = LazyModule('requests')
+subprocess = LazyModule('subprocess')
+
+
+class Transport:
+    """Connection state of the HTTP and UDP transports."""
+
+    __slots__ = ('backoff_until', 'http_conn', 'udp_socket', 'udp_sequence')
+
+    def __init__(self):
+        # Monotonic time before which no data is sent, as asked by the
+        # server.
+        self.backoff_until = 0.0
+        # Kept-alive connection of the low-footprint HTTP transport:
+        # (scheme://host:port, http.client connection), or None.
+        self.http_conn = None
+        self.udp_socket = None
+        # Starts at the current time in milliseconds, so it keeps
+        # increasing across client restarts and the server does not take
+        # new datagrams for replays.
+        self.udp_sequence = int(time.time() * 1000)
+
+    def back_off(self, seconds):
+        """Send nothing for the next `seconds`."""
+        self.backoff_until = time.monotonic() + seconds
+
+    def backing_off(self):
+        """Return True while the server has asked us to hold off."""
+        return time.monotonic() < self.backoff_until
+
+
+transport = Transport()
 
 
 def read_client_config():
@@ -36,6 +96,10 @@ def read_client_config():
 
 config_data = read_client_config()
 CLIENT_VERSION = config_data.get('version', '0.0.0')
+# "low_footprint": true sends samples over a kept-alive http.client
+# connection instead of requests, which saves loading the whole
+# requests/urllib3 stack on boards with little memory.
+LOW_FOOTPRINT = config_data.get('low_footprint', False)
 
 
 def get_device_uid():
@@ -54,214 +118,88 @@ def get_hostname():
         return socket.gethostname()
 
 
-def init_local_db():
-    """Initialize the local SQLite database for caching."""
-    conn = sqlite3.connect(LOCAL_DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS metrics_cache (
-                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                 metrics_json TEXT
-                 )''')
-    conn.commit()
-    conn.close()
-
-
-def get_temperature():
-    """Get CPU temperature (tries vcgencmd then psutil sensors)."""
-    if os.path.exists("/proc/device-tree/model"):
-        with open("/proc/device-tree/model", "r", encoding="UTF-8") as f:
-            model = f.read().lower()
-            if all(("banana" in model,
-                    os.path.exists('/sys/class/thermal/thermal_zone0/temp'))):
-                with open(
-                    '/sys/class/thermal/thermal_zone0/temp', 'r',
-                    encoding="UTF-8"
-                ) as f:
-                    temp_str = f.read().strip()
-                    return float(temp_str) / 1000.0
+# SIGUSR1 starts profiling the client; a second SIGUSR1 writes the
+# collected cProfile stats to PROFILE_FILE (open with python -m pstats).
+PROFILE_FILE = os.path.join(BASE_PATH, 'client_profile.prof')
 
-    try:
-        cmd = ['vcgencmd', 'measure_temp']
-        result = subprocess.run(
-            cmd, capture_output=True, text=True, check=True
-        )
-        temp_str = result.stdout.strip()
-        temp = float(temp_str.replace('temp=', '').replace("'C", ''))
-        return temp
-    except (FileNotFoundError, subprocess.CalledProcessError):
-        max_temp = 0
-        if hasattr(psutil, 'sensors_temperatures'):
-            temps = psutil.sensors_temperatures()
-            if "coretemp" in temps:
-                for entry in temps["coretemp"]:
-                    max_temp = max(max_temp, entry.current)
-
-        return max_temp
-
-
-def get_throttle_info():
-    """Get throttled status using vcgencmd."""
-    throttled = None
-    try:
-        out = subprocess.run(
-            ['vcgencmd', 'get_throttled'],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        throttled = out.stdout.strip().split('=')[-1]
-    except Exception:
-        throttled = None
-
-    return throttled
-
-
-def get_voltage_info():
-    """Get voltage information using vcgencmd or sysfs for Banana Pi."""
-    voltages = {}
-
-    if os.path.exists("/proc/device-tree/model"):
-        with open("/proc/device-tree/model", "r", encoding="UTF-8") as f:
-            model = f.read().lower()
-            power_info_path = "/sys/devices/platform/soc/1c2ac00.i2c/i2c-1/1-0034/ac"
-            if "banana" in model and os.path.exists(power_info_path):
-                try:
-                    with open(
-                        f'{power_info_path}/amperage', 'r', encoding="UTF-8"
-                    ) as f:
-                        temp_str = f.read().strip()
-                        current_amps = float(temp_str) / 1000.0
-                        voltages["amperage"] = current_amps
-                except Exception:
-                    pass
-                try:
-                    with open(
-                        f'{power_info_path}/voltage', 'r', encoding="UTF-8"
-                    ) as f:
-                        temp_str = f.read().strip()
-                        current_volt = float(temp_str) / 1000000.0
-                        voltages["core"] = current_volt
-                except Exception:
-                    pass
-            else:
-                try:
-                    power_info_path = "/sys/class/power_supply/max17042/current_now"
-                    if os.path.exists(power_info_path):
-                        with open(power_info_path, 'r', encoding="UTF-8") as f:
-                            amp_str = f.read().strip()
-                            voltages["amperage"] = float(amp_str) / 1000000.0
-                except Exception:
-                    pass
-
-                try:
-                    for name in ('core', 'sdram_c', 'sdram_i', 'sdram_p'):
-                        try:
-                            out = subprocess.run(
-                                ['vcgencmd', 'measure_volts', name],
-                                capture_output=True,
-                                text=True,
-                                check=True
-                            )
-                            v = out.stdout.strip().split('=')[-1]
-                            if v.endswith('V'):
-                                v = v[:-1]
-                            try:
-                                voltages[name] = float(v)
-                            except Exception:
-                                voltages[name] = None
-                        except Exception:
-                            voltages[name] = None
-                except Exception:
-                    voltages = {}
-    return voltages
-
-
-def get_active_ifaces(net_io_ifaces, net_if_addrs, net_if_stats):
-    """Get active network interfaces with stats."""
-    active_ifaces = {}
-    for iface, stats in net_io_ifaces.items():
-        if (iface == 'lo' or stats.bytes_sent + stats.bytes_recv == 0 or
-                iface.startswith(('veth', 'docker', 'br-'))):
-            continue
-
-        if_stats = net_if_stats.get(iface, None)
-        is_up = if_stats.isup if if_stats else False
-
-        if not is_up:
-            continue
-
-        iface_info = {
-            'bytes_sent': stats.bytes_sent,
-            'bytes_recv': stats.bytes_recv,
-            'packets_sent': stats.packets_sent,
-            'packets_recv': stats.packets_recv,
-            'speed': if_stats.speed if if_stats else None,
-            'is_up': is_up,
-            'mtu': if_stats.mtu if if_stats else None,
-        }
 
-        addresses = net_if_addrs.get(iface, [])
-        ips = [addr.address for addr in addresses
-               if addr.family in {2, 10}]
-        if ips:
-            iface_info['addresses'] = ips
+class SelfProfiler:
+    """The client's own cost: CPU time and memory, and a cProfile session."""
 
-        active_ifaces[iface] = iface_info
-    return active_ifaces
+    __slots__ = ('process', 'last_cpu', 'main_profile', 'probe_profiles')
 
+    def __init__(self):
+        # The client's own process, looked up on first use.
+        self.process = None
+        # (CPU seconds, monotonic time) at the previous sample.
+        self.last_cpu = None
+        # While profiling: the profile of the main thread and those of
+        # probe reads.
+        self.main_profile = None
+        self.probe_profiles = []
 
-def collect_metrics_once():
-    """Collect a one-off snapshot of system metrics."""
-
-    cpu_usage = psutil.cpu_percent(interval=1)
-    cpu_freq = psutil.cpu_freq()
-    cpu_frequency = f"{cpu_freq.current:.2f} MHz" if cpu_freq else "N/A"
+    def toggle(self, _signum=None, _frame=None):
+        """Start profiling, or stop and write the stats to PROFILE_FILE."""
+        if self.main_profile is None:
+            self.probe_profiles = []
+            self.main_profile = cProfile.Profile()
+            self.main_profile.enable()
+            print("Profiling started. Send SIGUSR1 again to write the stats.")
+            return
+        main_profile, self.main_profile = self.main_profile, None
+        main_profile.disable()
+        stats = pstats.Stats(main_profile)
+        for profile in self.probe_profiles:
+            stats.add(profile)
+        stats.dump_stats(PROFILE_FILE)
+        print(f"Profile written to {PROFILE_FILE}.")
+
+    def timed_read(self, read):
+        """Run a probe read; returns its value and duration in seconds."""
+        probe_profiles = self.probe_profiles
+        started = time.perf_counter()
+        if self.main_profile is None:
+            value = read()
+        else:
+            # cProfile only sees the thread that enabled it, so probe reads
+            # running in worker threads get a profile of their own.
+            profile = cProfile.Profile()
+            try:
+                value = profile.runcall(read)
+                probe_profiles.append(profile)
+            except ValueError:
+                # Another profiler is already active in this interpreter.
+                value = read()
+        return value, time.perf_counter() - started
+
+    def overhead(self, probe_seconds, collect_seconds, send_seconds):
+        """
+        Return the client_stats section of a sample: what the client itself
+        costs. send_seconds is the time taken to send the previous sample.
+        """
+        if self.process is None:
+            self.process = psutil.Process()
+        times = self.process.cpu_times()
+        cpu_seconds = times.user + times.system
+        now = time.monotonic()
+        cpu_percent = None
+        if self.last_cpu is not None and now > self.last_cpu[1]:
+            used, at = self.last_cpu
+            cpu_percent = round((cpu_seconds - used) / (now - at) * 100, 2)
+        self.last_cpu = (cpu_seconds, now)
+        return {
+            'cpu_percent': cpu_percent,
+            'cpu_seconds': round(cpu_seconds, 3),
+            'rss_mb': round(self.process.memory_info().rss / (1024**2), 2),
+            'collect_ms': round(collect_seconds * 1000, 3),
+            'send_ms': (round(send_seconds * 1000, 3)
+                        if send_seconds is not None else None),
+            'probe_ms': {name: round(seconds * 1000, 3)
+                         for name, seconds in probe_seconds.items()},
+        }
 
-    memory = psutil.virtual_memory()
-    disk = psutil.disk_usage('/')
 
-    net_io_total = psutil.net_io_counters()
-    net_io_ifaces = psutil.net_io_counters(pernic=True)
-    net_if_addrs = psutil.net_if_addrs()
-    net_if_stats = psutil.net_if_stats()
-    active_ifaces = get_active_ifaces(
-        net_io_ifaces, net_if_addrs, net_if_stats
-    )
-    throttled = get_throttle_info()
-    voltages = get_voltage_info()
-    temperature = get_temperature()
-    uptime = time.time() - psutil.boot_time()
-
-    metrics = {
-        'cpu': {'usage': cpu_usage, 'frequency': cpu_frequency},
-        'memory': {
-            'total': round(memory.total / (1024**3), 2),
-            'used': round(memory.used / (1024**3), 2),
-            'available': round(memory.available / (1024**3), 2),
-            'percentage': memory.percent
-        },
-        'disk': {
-            'total': round(disk.total / (1024**3), 2),
-            'used': round(disk.used / (1024**3), 2),
-            'free': round(disk.free / (1024**3), 2),
-            'percentage': round((disk.used / disk.total) * 100, 2)
-        },
-        'network': {
-            'total': {
-                'bytes_sent': net_io_total.bytes_sent,
-                'bytes_recv': net_io_total.bytes_recv,
-                'packets_sent': net_io_total.packets_sent,
-                'packets_recv': net_io_total.packets_recv
-            },
-            'interfaces': active_ifaces
-        },
-        'throttled': throttled,
-        'voltages': voltages,
-        'temperature': temperature,
-        'uptime': uptime
-    }
-    return metrics
+profiler = SelfProfiler()
 
 
 def load_config():
@@ -296,88 +234,229 @@ def register_client():
     headers = {'X-Client-Version': CLIENT_VERSION}
 
     try:
-        response = requests.post(
-            f"{SERVER_URL}/api/register", json=payload,
-            headers=headers, timeout=10
-        )
+        response = post_json(f"{SERVER_URL}/api/register", payload, headers)
         response.raise_for_status()
 
-        device_id = response.json().get('device_id')
+        registration = response.json()
+        device_id = registration.get('device_id')
         config_data.update({
             'device_id': device_id,
             'server_url': SERVER_URL,
             'device_uid': device_uid
         })
+        if 'udp_key' in registration:
+            config_data.update({
+                'udp_key': registration['udp_key'],
+                'udp_port': registration['udp_port']
+            })
+        if 'stream_key' in registration:
+            config_data.update({
+                'stream_key': registration['stream_key'],
+                'stream_port': registration['stream_port']
+            })
         save_config(config_data)
 
         print(f"Successfully registered with device_id: {device_id}")
         return config_data
-    except requests.exceptions.RequestException as e:
+    except (OSError, ValueError) as e:
         print(f"Error registering with server: {e}")
         return None
 
 
+class HttpError(OSError):
+    """Raised by the low-footprint transport, like requests' errors."""
+
+
+class HttpResponse:
+    """The parts of a requests response that the client uses."""
+
+    __slots__ = ('url', 'status_code', 'headers', 'content')
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        """Decode the JSON body."""
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        """Raise HttpError for 4xx and 5xx answers."""
+        if self.status_code >= 400:
+            raise HttpError(f"{self.status_code} Error for url: {self.url}")
+
+
+def close_http():
+    """Close the kept-alive connection of the low-footprint transport."""
+    if transport.http_conn is not None:
+        transport.http_conn[1].close()
+        transport.http_conn = None
+
+
+def http_post(url, body, headers, timeout):
+    """
+    POST a body over a kept-alive http.client connection. A request on a
+    reused connection that the server has closed in the meantime is sent
+    again once on a new one.
+    """
+    parts = urlparse(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+    while True:
+        reused = (transport.http_conn is not None
+                  and transport.http_conn[0] == origin)
+        if not reused:
+            close_http()
+            connection_class = (http_client.HTTPSConnection
+                                if parts.scheme == 'https'
+                                else http_client.HTTPConnection)
+            transport.http_conn = (
+                origin, connection_class(parts.netloc, timeout=timeout))
+        try:
+            connection = transport.http_conn[1]
+            connection.request('POST', path, body, headers)
+            response = connection.getresponse()
+            content = response.read()
+        except (OSError, http_client.HTTPException) as e:
+            close_http()
+            if reused and isinstance(e, ConnectionError):
+                continue
+            raise HttpError(f"{e.__class__.__name__}: {e}") from e
+        if response.will_close:
+            close_http()
+        return HttpResponse(url, response.status, response.msg, content)
+
+
+def post_json(url, payload, headers, timeout=10):
+    """
+    POST a JSON payload with requests, or with the http.client transport
+    in low-footprint mode. Both raise OSError subclasses on failure.
+    """
+    if not LOW_FOOTPRINT:
+        return requests.post(url, json=payload, headers=headers,
+                             timeout=timeout)
+    body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return http_post(url, body, dict(headers, **{
+        'Content-Type': 'application/json'
+    }), timeout)
+
+
+def retry_after_seconds(response):
+    """Return the Retry-After delay of a response in seconds."""
+    try:
+        return max(float(response.headers.get('Retry-After')), 0)
+    except (TypeError, ValueError):
+        return COLLECT_INTERVAL
+
+
+def uses_udp(config):
+    """Return True if samples should be sent as UDP datagrams."""
+    return config.get('transport') == 'udp' and 'udp_key' in config
+
+
+def send_datagram(config, metrics):
+    """
+    Send a single data point as a signed UDP datagram. This is
+    fire-and-forget: only local socket errors are reported as failures.
+    """
+    if transport.udp_socket is None:
+        transport.udp_socket = socket.socket(socket.AF_INET,
+                                             socket.SOCK_DGRAM)
+    transport.udp_sequence += 1
+    payload = zlib.compress(json.dumps(
+        {'v': CLIENT_VERSION, 'i': COLLECT_INTERVAL, 'm': metrics},
+        separators=(',', ':')
+    ).encode('utf-8'))
+    message = UDP_HEADER.pack(UDP_MAGIC, UDP_FORMAT_VERSION, UDP_FLAG_ZLIB,
+                              config['device_id'],
+                              transport.udp_sequence) + payload
+    mac = hmac.new(bytes.fromhex(config['udp_key']), message,
+                   hashlib.sha256).digest()[:UDP_MAC_SIZE]
+    address = (urlparse(config['server_url']).hostname, config['udp_port'])
+    try:
+        transport.udp_socket.sendto(message + mac, address)
+        return True
+    except OSError as e:
+        print(f"Could not send datagram to server: {e}")
+        return False
+
+
+stream = StreamChannel(transport, CLIENT_VERSION, COLLECT_INTERVAL)
+
+
 def send_data(config, metrics):
-    """Send a single data point to the server."""
+    """
+    Send a single data point to the server. Returns False if it was not
+    accepted, including while backing off after a 429/503 answer.
+    """
+    if uses_udp(config):
+        return send_datagram(config, metrics)
+    if transport.backing_off():
+        return False
     payload = {
         'device_id': config['device_id'],
+        'report_interval': COLLECT_INTERVAL,
         'metrics': metrics
     }
     headers = {'X-Client-Version': CLIENT_VERSION}
     try:
-        response = requests.post(
-            f"{config['server_url']}/api/data", json=payload,
-            headers=headers, timeout=10
-        )
+        response = post_json(f"{config['server_url']}/api/data", payload,
+                             headers)
+        if response.status_code in BACKOFF_STATUSES:
+            delay = retry_after_seconds(response)
+            transport.back_off(delay)
+            print(f"Server is busy ({response.status_code}), "
+                  f"backing off for {delay:g} s.")
+            return False
         response.raise_for_status()
         return True
-    except requests.exceptions.RequestException as e:
+    except OSError as e:
         print(f"Could not send data to server: {e}")
         return False
 
 
-def cache_data(metrics):
-    """Save metrics to the local cache."""
-    conn = sqlite3.connect(LOCAL_DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO metrics_cache (metrics_json) VALUES (?)",
-        (json.dumps(metrics),)
-    )
-    conn.commit()
-    conn.close()
-    print("Data cached locally.")
+def send_samples(config, samples):
+    """
+    Send samples, oldest first, over the configured transport and return
+    how many were accepted before the first that was not.
+    """
+    if uses_stream(config):
+        return stream.send(config, samples)
+    sent = 0
+    while sent < len(samples) and send_data(config, samples[sent]):
+        sent += 1
+    return sent
+
+
+spool = Spool()
 
 
 def send_cached_data(config):
-    """Send all cached data to the server and clear cache on success."""
-    conn = sqlite3.connect(LOCAL_DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT id, metrics_json FROM metrics_cache ORDER BY id")
-    rows = c.fetchall()
-
-    if not rows:
-        conn.close()
-        return
+    """
+    Send the cached and spooled samples to the server, oldest first, and
+    remove the ones it accepted. Returns False if one was not accepted.
+    """
+    if transport.backing_off():
+        return False
+    send = functools.partial(send_samples, config)
+    if spool.cache_pending and not spool.send_cache(send):
+        return False
+    return spool.drain(send)
 
-    print(f"Found {len(rows)} cached records. Attempting to send...")
 
-    for row in rows:
-        metrics = json.loads(row['metrics_json'])
-        if send_data(config, metrics):
-            c.execute("DELETE FROM metrics_cache WHERE id = ?", (row['id'],))
-            conn.commit()
-            print(f"Successfully sent cached record ID {row['id']}.")
-        else:
-            print("Server still unreachable. Stopping cache sending.")
-            break
-    conn.close()
+def stop(signum=None, frame=None):
+    """SIGTERM handler: exit through main()'s cleanup."""
+    raise SystemExit(0)
 
 
-def main():
-    """Main loop for the client."""
-    init_local_db()
+def load_or_register():
+    """
+    Return the client configuration, registering first if there is none
+    or if the configured transport needs a key. Returns None if a first
+    registration failed.
+    """
     config = load_config()
 
     if not config:
@@ -388,18 +467,67 @@ def main():
             Registration failed. Please check server URL and connectivity.
             Exiting.
             """)
-            return
+    elif config.get('transport') == 'udp' and 'udp_key' not in config:
+        print("UDP transport selected. Registering again to get a key...")
+        config = register_client() or config
+        if not uses_udp(config):
+            print("Server has no UDP ingest enabled. Using HTTP.")
+    elif config.get('transport') == 'stream' and 'stream_key' not in config:
+        print("Stream transport selected. Registering again to get a key...")
+        config = register_client() or config
+        if not uses_stream(config):
+            print("Server has no stream ingest enabled. Using HTTP.")
+    return config
 
-    while True:
-        send_cached_data(config)
 
-        print("Collecting new metrics...")
-        metrics = collect_metrics_once()
+def main():
+    """Main loop for the client."""
+    config = load_or_register()
+    if not config:
+        return
+
+    # The cache is only opened when it may hold samples.
+    spool.cache_pending = os.path.exists(LOCAL_DB_PATH)
+    if spool.cache_pending:
+        init_local_db()
 
-        if not send_data(config, metrics):
-            cache_data(metrics)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, profiler.toggle)
+    signal.signal(signal.SIGTERM, stop)
+    spool.configure(**config.get('spool', {}))
 
-        time.sleep(COLLECT_INTERVAL)
+    process_tracker.top_n = config.get('process_top', process_tracker.top_n)
+    disk_tracker.mounts = config.get('mounts', disk_tracker.mounts)
+    scheduler = ProbeScheduler(PROBES, config.get('probes'),
+                               profiler.timed_read)
+    send_seconds = None
+
+    try:
+        while True:
+            print("Collecting new metrics...")
+            started = time.perf_counter()
+            metrics = scheduler.collect()
+            collected = time.perf_counter()
+
+            if metrics is None:
+                print("Some probes have no reading yet. Skipping this sample.")
+            else:
+                metrics['client_stats'] = profiler.overhead(
+                    scheduler.durations, collected - started, send_seconds
+                )
+                # Samples stay in memory until they are accepted (over
+                # the stream: acknowledged); only the spool writes them.
+                if not (send_cached_data(config)
+                        and send_samples(config, [metrics])):
+                    spool.add(metrics)
+            send_seconds = time.perf_counter() - collected
+
+            time.sleep(COLLECT_INTERVAL)
+    finally:
+        # Spooled samples survive a clean shutdown in every mode.
+        stream.close()
+        scheduler.close()
+        spool.flush()
 
 
 if __name__ == '__main__':
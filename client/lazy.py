@@ -0,0 +1,26 @@
+"""
+Lazily imported modules: the client imports large modules, or ones it
+only needs some of the time, when they are first used.
+"""
+import importlib
+
+
+class LazyModule:
+    """A module that is imported when one of its attributes is first
+    used."""
+
+    __slots__ = ('name', 'module')
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def load(self):
+        """Import the module unless it was imported already; returns
+        it."""
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
@@ -0,0 +1,600 @@
+"""
+The probes of the client: metric sources read on their own schedules, in
+parallel, by a ProbeScheduler, and the sample built from their values.
+"""
+import os
+import time
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeout
+from dataclasses import dataclass, replace
+
+from lazy import LazyModule
+
+psutil = LazyModule('psutil')
+subprocess = LazyModule('subprocess')
+
+
+# Board files read by the thermal and power probes.
+DEVICE_MODEL_PATH = '/proc/device-tree/model'
+THERMAL_ZONE_PATH = '/sys/class/thermal/thermal_zone0/temp'
+BANANA_POWER_PATH = '/sys/devices/platform/soc/1c2ac00.i2c/i2c-1/1-0034/ac'
+MAX17042_CURRENT_PATH = '/sys/class/power_supply/max17042/current_now'
+
+
+def get_temperature():
+    """Get CPU temperature (tries vcgencmd then psutil sensors)."""
+    if os.path.exists(DEVICE_MODEL_PATH):
+        with open(DEVICE_MODEL_PATH, "r", encoding="UTF-8") as f:
+            model = f.read().lower()
+            if all(("banana" in model, os.path.exists(THERMAL_ZONE_PATH))):
+                with open(THERMAL_ZONE_PATH, 'r', encoding="UTF-8") as f:
+                    temp_str = f.read().strip()
+                    return float(temp_str) / 1000.0
+
+    try:
+        cmd = ['vcgencmd', 'measure_temp']
+        result = subprocess.run(
+            cmd, capture_output=True, text=True, check=True
+        )
+        temp_str = result.stdout.strip()
+        temp = float(temp_str.replace('temp=', '').replace("'C", ''))
+        return temp
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        max_temp = 0
+        if hasattr(psutil, 'sensors_temperatures'):
+            temps = psutil.sensors_temperatures()
+            if "coretemp" in temps:
+                for entry in temps["coretemp"]:
+                    max_temp = max(max_temp, entry.current)
+
+        return max_temp
+
+
+def get_throttle_info():
+    """Get throttled status using vcgencmd."""
+    throttled = None
+    try:
+        out = subprocess.run(
+            ['vcgencmd', 'get_throttled'],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        throttled = out.stdout.strip().split('=')[-1]
+    except Exception:
+        throttled = None
+
+    return throttled
+
+
+def get_voltage_info():
+    """Get voltage information using vcgencmd or sysfs for Banana Pi."""
+    voltages = {}
+
+    if os.path.exists(DEVICE_MODEL_PATH):
+        with open(DEVICE_MODEL_PATH, "r", encoding="UTF-8") as f:
+            model = f.read().lower()
+            power_info_path = BANANA_POWER_PATH
+            if "banana" in model and os.path.exists(power_info_path):
+                try:
+                    with open(
+                        f'{power_info_path}/amperage', 'r', encoding="UTF-8"
+                    ) as f:
+                        temp_str = f.read().strip()
+                        current_amps = float(temp_str) / 1000.0
+                        voltages["amperage"] = current_amps
+                except Exception:
+                    pass
+                try:
+                    with open(
+                        f'{power_info_path}/voltage', 'r', encoding="UTF-8"
+                    ) as f:
+                        temp_str = f.read().strip()
+                        current_volt = float(temp_str) / 1000000.0
+                        voltages["core"] = current_volt
+                except Exception:
+                    pass
+            else:
+                try:
+                    power_info_path = MAX17042_CURRENT_PATH
+                    if os.path.exists(power_info_path):
+                        with open(power_info_path, 'r', encoding="UTF-8") as f:
+                            amp_str = f.read().strip()
+                            voltages["amperage"] = float(amp_str) / 1000000.0
+                except Exception:
+                    pass
+
+                try:
+                    for name in ('core', 'sdram_c', 'sdram_i', 'sdram_p'):
+                        try:
+                            out = subprocess.run(
+                                ['vcgencmd', 'measure_volts', name],
+                                capture_output=True,
+                                text=True,
+                                check=True
+                            )
+                            v = out.stdout.strip().split('=')[-1]
+                            if v.endswith('V'):
+                                v = v[:-1]
+                            try:
+                                voltages[name] = float(v)
+                            except Exception:
+                                voltages[name] = None
+                        except Exception:
+                            voltages[name] = None
+                except Exception:
+                    voltages = {}
+    return voltages
+
+
+def get_active_ifaces(net_io_ifaces, net_if_addrs, net_if_stats):
+    """Get active network interfaces with stats."""
+    active_ifaces = {}
+    for iface, stats in net_io_ifaces.items():
+        if (iface == 'lo' or stats.bytes_sent + stats.bytes_recv == 0 or
+                iface.startswith(('veth', 'docker', 'br-'))):
+            continue
+
+        if_stats = net_if_stats.get(iface, None)
+        is_up = if_stats.isup if if_stats else False
+
+        if not is_up:
+            continue
+
+        iface_info = {
+            'bytes_sent': stats.bytes_sent,
+            'bytes_recv': stats.bytes_recv,
+            'packets_sent': stats.packets_sent,
+            'packets_recv': stats.packets_recv,
+            'speed': if_stats.speed if if_stats else None,
+            'is_up': is_up,
+            'mtu': if_stats.mtu if if_stats else None,
+        }
+
+        addresses = net_if_addrs.get(iface, [])
+        ips = [addr.address for addr in addresses
+               if addr.family in {2, 10}]
+        if ips:
+            iface_info['addresses'] = ips
+
+        active_ifaces[iface] = iface_info
+    return active_ifaces
+
+
+# Probes read one metric source each, on their own schedule. The interval
+# is in seconds (0 means every collection cycle); it, the timeout and
+# whether the probe runs at all can be overridden per probe with e.g.
+#     "probes": {"disk": {"interval": 120, "timeout": 5},
+#                "processes": {"enabled": true}}
+# in client_config.json.
+PROBE_TIMEOUT = 5.0
+# Probes without which no sample is sent.
+REQUIRED_PROBES = ('cpu', 'memory', 'disk', 'net')
+
+
+@dataclass
+class Probe:
+    """A metric source with its schedule; `pending` is a running read."""
+    name: str
+    read: Callable
+    interval: float = 0
+    timeout: float = PROBE_TIMEOUT
+    enabled: bool = True
+    last_run: float = None
+    pending: Future = None
+
+    def due(self, now):
+        """Return True if the probe should be read in this cycle."""
+        return self.pending is None and (
+            self.last_run is None or now - self.last_run >= self.interval
+        )
+
+
+PROBES = {}
+
+
+def probe(name, interval=0, timeout=PROBE_TIMEOUT, enabled=True):
+    """Register the decorated function as a probe."""
+    def register(read):
+        PROBES[name] = Probe(name, read, interval, timeout, enabled)
+        return read
+    return register
+
+
+@probe('cpu')
+def read_cpu():
+    """CPU usage over one second and the current frequency."""
+    cpu_freq = psutil.cpu_freq()
+    return {
+        'usage': psutil.cpu_percent(interval=1),
+        'frequency': round(cpu_freq.current, 2) if cpu_freq else None
+    }
+
+
+@probe('memory')
+def read_memory():
+    """Memory usage in GB."""
+    memory = psutil.virtual_memory()
+    return {
+        'total': round(memory.total / (1024**3), 2),
+        'used': round(memory.used / (1024**3), 2),
+        'available': round(memory.available / (1024**3), 2),
+        'percentage': memory.percent
+    }
+
+
+@probe('disk', interval=60)
+def read_disk():
+    """Root filesystem usage in GB."""
+    disk = psutil.disk_usage('/')
+    return {
+        'total': round(disk.total / (1024**3), 2),
+        'used': round(disk.used / (1024**3), 2),
+        'free': round(disk.free / (1024**3), 2),
+        'percentage': round((disk.used / disk.total) * 100, 2)
+    }
+
+
+@probe('net')
+def read_net():
+    """Network counters, in total and per interface."""
+    return (psutil.net_io_counters(), psutil.net_io_counters(pernic=True))
+
+
+@probe('net_info', interval=60)
+def read_net_info():
+    """Interface addresses and link state, which rarely change."""
+    return (psutil.net_if_addrs(), psutil.net_if_stats())
+
+
+@probe('thermal')
+def read_thermal():
+    """CPU temperature."""
+    return get_temperature()
+
+
+@probe('throttle')
+def read_throttle():
+    """Throttling flags."""
+    return get_throttle_info()
+
+
+@probe('power', interval=30)
+def read_power():
+    """Supply voltages and current."""
+    return get_voltage_info()
+
+
+@probe('boot', interval=3600)
+def read_boot():
+    """Boot time, for the uptime."""
+    return psutil.boot_time()
+
+
+class ProcessTracker:
+    """
+    Finds the processes using the most CPU and memory.
+
+    psutil.Process objects are kept across reads, so each cycle costs one
+    /proc read per process (inside oneshot()) and CPU use comes from the
+    change in each process's CPU time since the previous read. Names are
+    read once, when a process is first seen.
+    """
+
+    def __init__(self, top_n=5):
+        self.top_n = top_n
+        # pid -> [Process, name, CPU seconds at the previous read]
+        self._processes = {}
+        self._last_read = None
+
+    def read(self):
+        """Return the top processes by CPU and by resident memory."""
+        samples = self.sample()
+        by_cpu = sorted(
+            (s for s in samples if s['cpu_percent'] is not None),
+            key=lambda s: s['cpu_percent'], reverse=True
+        )[:self.top_n]
+        by_rss = sorted(samples, key=lambda s: s['rss_mb'],
+                        reverse=True)[:self.top_n]
+        top = {s['pid']: s for s in by_cpu + by_rss}
+        return list(top.values())
+
+    def sample(self):
+        """
+        Return the CPU and memory use of every process that can be read;
+        CPU use is None for the processes seen for the first time.
+        """
+        now = time.monotonic()
+        elapsed = now - self._last_read if self._last_read else None
+        self._last_read = now
+
+        pids = set(psutil.pids())
+        for pid in self._processes.keys() - pids:
+            del self._processes[pid]
+
+        return [sample for sample in (
+            self._sample(pid, elapsed) for pid in pids
+        ) if sample is not None]
+
+    def _sample(self, pid, elapsed):
+        """Read one process; returns None if it is gone or hidden."""
+        entry = self._processes.get(pid)
+        try:
+            if entry is None:
+                process = psutil.Process(pid)
+                entry = [process, process.name(), None]
+                self._processes[pid] = entry
+            process, name, previous = entry
+            with process.oneshot():
+                times = process.cpu_times()
+                rss = process.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied,
+                psutil.ZombieProcess):
+            self._processes.pop(pid, None)
+            return None
+        cpu_seconds = times.user + times.system
+        entry[2] = cpu_seconds
+        cpu_percent = None
+        # A smaller CPU time means the pid now belongs to another
+        # process; it gets a value from the next read on.
+        if elapsed and previous is not None and cpu_seconds >= previous:
+            cpu_percent = round((cpu_seconds - previous) / elapsed * 100, 2)
+        return {'pid': pid, 'name': name, 'cpu_percent': cpu_percent,
+                'rss_mb': round(rss / (1024**2), 2)}
+
+
+process_tracker = ProcessTracker()
+
+
+@probe('processes', enabled=False)
+def read_processes():
+    """Top processes by CPU and memory; enable it in client_config.json."""
+    return process_tracker.read()
+
+
+DISKSTATS_PATH = '/proc/diskstats'
+MOUNTS_PATH = '/proc/self/mounts'
+SYS_BLOCK_PATH = '/sys/block'
+# /proc/diskstats counts sectors of 512 bytes, whatever the device uses.
+SECTOR_SIZE = 512
+# Virtual block devices without real I/O behind them.
+IGNORED_DISKS = ('loop', 'ram')
+
+
+def unescape_mount(path):
+    """Undo the octal escapes (e.g. \\040 for a space) of the mount table."""
+    if '\\' not in path:
+        return path
+    parts = path.split('\\')
+    for i, part in enumerate(parts[1:], 1):
+        if len(part) >= 3 and part[:3].isdigit():
+            part = chr(int(part[:3], 8)) + part[3:]
+        parts[i] = part
+    return ''.join(parts)
+
+
+class DiskTracker:
+    """
+    Disk I/O rates and usage of the mounted filesystems.
+
+    Each read parses /proc/diskstats and the mount table once. Throughput,
+    IOPS and busy % of every whole disk come from the change in its
+    counters since the previous read, so the first read reports no disks.
+    Usage is reported for the configured mount points that are mounted.
+    """
+
+    def __init__(self, mounts=('/',)):
+        self.mounts = mounts
+        # disk name -> (reads, sectors read, writes, sectors written,
+        #               milliseconds busy) at the previous read
+        self._counters = {}
+        self._last_read = None
+
+    @staticmethod
+    def read_counters():
+        """Return the I/O counters of the whole disks."""
+        try:
+            disks = set(os.listdir(SYS_BLOCK_PATH))
+        except OSError:
+            disks = None
+        counters = {}
+        with open(DISKSTATS_PATH, 'r', encoding='ascii') as f:
+            for line in f:
+                fields = line.split()
+                name = fields[2]
+                if name.startswith(IGNORED_DISKS) or (
+                        disks is not None and name not in disks):
+                    continue
+                counters[name] = tuple(
+                    int(fields[i]) for i in (3, 5, 7, 9, 12))
+        return counters
+
+    @staticmethod
+    def read_mount_points():
+        """Return the mount points in the mount table."""
+        try:
+            with open(MOUNTS_PATH, 'r', encoding='utf-8') as f:
+                return {unescape_mount(line.split()[1]) for line in f
+                        if line.strip()}
+        except OSError:
+            return set()
+
+    def read_devices(self):
+        """Return the I/O rates of the disks since the previous read."""
+        now = time.monotonic()
+        elapsed = now - self._last_read if self._last_read else None
+        self._last_read = now
+        previous, self._counters = self._counters, self.read_counters()
+
+        devices = {}
+        if not elapsed:
+            return devices
+        for name, current in self._counters.items():
+            before = previous.get(name)
+            # Never used (e.g. an empty card reader) or not seen before.
+            if before is None or not any(current):
+                continue
+            deltas = [a - b for a, b in zip(current, before)]
+            # Smaller counters mean the device was replaced.
+            if min(deltas) < 0:
+                continue
+            reads, read_sectors, writes, write_sectors, busy_ms = deltas
+            devices[name] = {
+                'read_bps': round(read_sectors * SECTOR_SIZE / elapsed),
+                'write_bps': round(write_sectors * SECTOR_SIZE / elapsed),
+                'read_iops': round(reads / elapsed, 2),
+                'write_iops': round(writes / elapsed, 2),
+                'busy_percent': round(min(busy_ms / elapsed / 10, 100.0), 1)
+            }
+        return devices
+
+    def read_mounts(self):
+        """Return the usage of the configured mount points in GB."""
+        mounted = self.read_mount_points()
+        usage = {}
+        for path in self.mounts:
+            # Not mounted: statvfs() would report the parent filesystem.
+            if path not in mounted:
+                continue
+            try:
+                fs = os.statvfs(path)
+            except OSError:
+                continue
+            total = fs.f_blocks * fs.f_frsize
+            if not total:
+                continue
+            used = (fs.f_blocks - fs.f_bfree) * fs.f_frsize
+            usage[path] = {
+                'total': round(total / (1024**3), 2),
+                'used': round(used / (1024**3), 2),
+                'free': round(fs.f_bavail * fs.f_frsize / (1024**3), 2),
+                'percentage': round(used / total * 100, 2)
+            }
+        return usage
+
+    def read(self):
+        """Return the disk I/O rates and the mount usage."""
+        return {'devices': self.read_devices(), 'mounts': self.read_mounts()}
+
+
+disk_tracker = DiskTracker()
+
+
+@probe('disk_io')
+def read_disk_io():
+    """Per-disk I/O rates and usage of the mounts in "mounts"."""
+    return disk_tracker.read()
+
+
+def build_metrics(values):
+    """Assemble a sample from the latest probe values."""
+    net_io_total, net_io_ifaces = values['net']
+    net_if_addrs, net_if_stats = values.get('net_info') or ({}, {})
+    boot_time = values.get('boot')
+    metrics = {
+        'cpu': values['cpu'],
+        'memory': values['memory'],
+        'disk': values['disk'],
+        'network': {
+            'total': {
+                'bytes_sent': net_io_total.bytes_sent,
+                'bytes_recv': net_io_total.bytes_recv,
+                'packets_sent': net_io_total.packets_sent,
+                'packets_recv': net_io_total.packets_recv
+            },
+            'interfaces': get_active_ifaces(
+                net_io_ifaces, net_if_addrs, net_if_stats
+            )
+        },
+        'throttled': values.get('throttle'),
+        'voltages': values.get('power') or {},
+        'temperature': values.get('thermal') or 0.0,
+        'uptime': time.time() - boot_time if boot_time else 0.0
+    }
+    if values.get('processes') is not None:
+        metrics['processes'] = values['processes']
+    if values.get('disk_io') is not None:
+        metrics['disks'] = values['disk_io']
+    return metrics
+
+
+def timed_read(read):
+    """Run a probe read; returns its value and duration in seconds."""
+    started = time.perf_counter()
+    value = read()
+    return value, time.perf_counter() - started
+
+
+class ProbeScheduler:
+    """
+    Reads the probes that are due in parallel and keeps the last value of
+    each. A probe that is still running when its timeout expires keeps its
+    previous value and is not started again until it finishes, so a slow
+    probe (e.g. a hanging vcgencmd) never delays the others.
+
+    timer(read) runs a probe read and returns its value and duration in
+    seconds, like timed_read().
+    """
+
+    def __init__(self, probes, overrides=None, timer=timed_read):
+        self.timer = timer
+        overrides = overrides or {}
+        self.probes = []
+        for template in probes.values():
+            settings = overrides.get(template.name, {})
+            if not settings.get('enabled', template.enabled):
+                continue
+            self.probes.append(replace(
+                template, enabled=True,
+                interval=settings.get('interval', template.interval),
+                timeout=settings.get('timeout', template.timeout)
+            ))
+        self.executor = ThreadPoolExecutor(
+            max_workers=len(self.probes), thread_name_prefix='probe'
+        )
+        # The last value of each probe.
+        self.values = dict.fromkeys(p.name for p in self.probes)
+        # Duration in seconds of the probe reads finished in the last cycle.
+        self.durations = {}
+
+    def collect(self):
+        """
+        Read the due probes and return a sample, or None until every
+        required probe has produced a value.
+        """
+        now = time.monotonic()
+        for p in self.probes:
+            if p.due(now):
+                p.last_run = now
+                p.pending = self.executor.submit(self.timer, p.read)
+
+        self.durations = {}
+        for p in self.probes:
+            if p.pending is None:
+                continue
+            remaining = p.last_run + p.timeout - time.monotonic()
+            try:
+                result = p.pending.result(timeout=max(remaining, 0))
+            except FuturesTimeout:
+                print(f"Probe {p.name} timed out, using its last value.")
+                continue
+            except Exception as e:
+                print(f"Probe {p.name} failed: {e}")
+            else:
+                self.values[p.name], self.durations[p.name] = result
+            p.pending = None
+
+        if any(self.values.get(name) is None for name in REQUIRED_PROBES):
+            return None
+        return build_metrics(self.values)
+
+    def close(self):
+        """Stop the probe threads, leaving running reads to finish."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def collect_metrics_once():
+    """Collect a one-off snapshot of system metrics."""
+    return build_metrics({name: p.read() for name, p in PROBES.items()
+                          if p.enabled})
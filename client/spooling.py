@@ -0,0 +1,219 @@
+"""
+The local cache of the client, which keeps the samples that could not be
+sent until the server accepts them.
+"""
+import json
+import os
+import time
+import zlib
+from collections import deque
+
+from lazy import LazyModule
+
+sqlite3 = LazyModule('sqlite3')
+
+LOCAL_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'local_cache.db')
+
+# Spooling of samples that could not be sent ("spool" in
+# client_config.json). They are kept in a ring in memory and written to
+# the local cache in one compressed batch every SPOOL_FLUSH_SAMPLES samples
+# or SPOOL_FLUSH_SECONDS, whichever comes first, which bounds what a power
+# failure can lose. Durability levels:
+#   memory  only written on a clean shutdown; the oldest samples are
+#           dropped once the ring is full
+#   batch   written in batches (the default)
+#   sample  every sample is written at once (one write per sample)
+SPOOL_DURABILITY = ('memory', 'batch', 'sample')
+SPOOL_CAPACITY = 360
+SPOOL_FLUSH_SAMPLES = 60
+SPOOL_FLUSH_SECONDS = 600
+
+
+def create_cache_tables(c):
+    """Create the tables of the local cache if they do not exist."""
+    c.execute('''CREATE TABLE IF NOT EXISTS metrics_cache (
+                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                 metrics_json TEXT
+                 )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS spool_batches (
+                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 samples INTEGER,
+                 payload BLOB
+                 )''')
+
+
+def init_local_db():
+    """Initialize the local SQLite database for caching."""
+    conn = sqlite3.connect(LOCAL_DB_PATH)
+    create_cache_tables(conn.cursor())
+    conn.commit()
+    conn.close()
+
+
+class Spool:
+    """
+    Samples that could not be sent, kept in memory and written to the
+    local cache in batches (see SPOOL_DURABILITY).
+    """
+
+    __slots__ = ('durability', 'flush_samples', 'flush_seconds', 'ring',
+                 'since', 'counters', 'cache_pending')
+
+    def __init__(self, durability='batch', capacity=SPOOL_CAPACITY,
+                 flush_samples=SPOOL_FLUSH_SAMPLES,
+                 flush_seconds=SPOOL_FLUSH_SECONDS):
+        self.ring = deque()
+        self.configure(durability, capacity, flush_samples, flush_seconds)
+        # Monotonic time the oldest sample in the ring was added.
+        self.since = None
+        # Samples dropped from a full ring and writes to the local cache.
+        self.counters = {'dropped': 0, 'writes': 0}
+        # False once the local cache is known to be empty; it is only
+        # opened (and sqlite3 only imported) while there may be samples in
+        # it.
+        self.cache_pending = True
+
+    def configure(self, durability='batch', capacity=SPOOL_CAPACITY,
+                  flush_samples=SPOOL_FLUSH_SAMPLES,
+                  flush_seconds=SPOOL_FLUSH_SECONDS):
+        """Apply the "spool" section of client_config.json."""
+        if durability not in SPOOL_DURABILITY:
+            raise ValueError(
+                f"Unknown spool durability '{durability}', expected one of "
+                f"{', '.join(SPOOL_DURABILITY)}"
+            )
+        self.durability = durability
+        self.flush_samples = min(flush_samples, capacity)
+        self.flush_seconds = flush_seconds
+        self.ring = deque(self.ring, maxlen=capacity)
+
+    def add(self, metrics):
+        """Spool a sample, writing the ring out when it is due."""
+        if self.durability == 'sample':
+            self.cache(metrics)
+            self.counters['writes'] += 1
+            return
+        if len(self.ring) == self.ring.maxlen:
+            self.counters['dropped'] += 1
+        if not self.ring:
+            self.since = time.monotonic()
+        self.ring.append(metrics)
+        print(f"Data spooled in memory ({len(self.ring)} samples).")
+        if self.durability == 'batch' and (
+                len(self.ring) >= self.flush_samples
+                or time.monotonic() - self.since >= self.flush_seconds):
+            self.flush()
+
+    def cache(self, metrics):
+        """Save a single sample to the local cache."""
+        created = os.path.exists(LOCAL_DB_PATH)
+        conn = sqlite3.connect(LOCAL_DB_PATH)
+        c = conn.cursor()
+        if not created:
+            create_cache_tables(c)
+        c.execute(
+            "INSERT INTO metrics_cache (metrics_json) VALUES (?)",
+            (json.dumps(metrics),)
+        )
+        conn.commit()
+        conn.close()
+        self.cache_pending = True
+        print("Data cached locally.")
+
+    def flush(self):
+        """Write the ring to the local cache as one compressed batch."""
+        if not self.ring:
+            return
+        samples = list(self.ring)
+        conn = sqlite3.connect(LOCAL_DB_PATH)
+        try:
+            c = conn.cursor()
+            create_cache_tables(c)
+            c.execute(
+                "INSERT INTO spool_batches (samples, payload) VALUES (?, ?)",
+                (len(samples), encode_batch(samples))
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        self.ring.clear()
+        self.since = None
+        self.counters['writes'] += 1
+        self.cache_pending = True
+        print(f"Wrote {len(samples)} spooled samples to the local cache.")
+
+    def drain(self, send):
+        """Send the samples in the ring with send(samples), which returns
+        how many were accepted; returns False if one was not."""
+        if self.ring:
+            for _ in range(send(list(self.ring))):
+                self.ring.popleft()
+        if self.ring:
+            return False
+        self.since = None
+        return True
+
+    def send_cache(self, send):
+        """
+        Send the samples in the local cache with send(samples), which
+        returns how many were accepted, and clear it on success: single
+        samples first, then spooled batches. Sent samples are deleted (and
+        a batch shortened) with one write per table or batch.
+        """
+        conn = sqlite3.connect(LOCAL_DB_PATH)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute("SELECT id, metrics_json FROM metrics_cache ORDER BY id")
+        rows = c.fetchall()
+
+        if rows:
+            print(f"Found {len(rows)} cached records. Attempting to send...")
+
+            sent = send([json.loads(row['metrics_json']) for row in rows])
+            if sent:
+                c.execute("DELETE FROM metrics_cache WHERE id <= ?",
+                          (rows[sent - 1]['id'],))
+                conn.commit()
+                print(f"Successfully sent {sent} cached records.")
+            if sent < len(rows):
+                print("Server unreachable or busy. Stopping cache sending.")
+                conn.close()
+                return False
+
+        c.execute("SELECT id, payload FROM spool_batches ORDER BY id")
+        for row in c.fetchall():
+            samples = decode_batch(row['payload'])
+            sent = send(samples)
+            if sent == len(samples):
+                c.execute("DELETE FROM spool_batches WHERE id = ?",
+                          (row['id'],))
+            elif sent:
+                c.execute(
+                    "UPDATE spool_batches SET samples = ?, payload = ? "
+                    "WHERE id = ?",
+                    (len(samples) - sent, encode_batch(samples[sent:]),
+                     row['id'])
+                )
+            conn.commit()
+            print(f"Sent {sent} of {len(samples)} spooled samples "
+                  f"of batch {row['id']}.")
+            if sent < len(samples):
+                print("Server unreachable or busy. Stopping cache sending.")
+                conn.close()
+                return False
+
+        self.cache_pending = False
+        conn.close()
+        return True
+
+
+def encode_batch(samples):
+    """Compress a list of samples for the spool_batches table."""
+    return zlib.compress(json.dumps(samples, separators=(',', ':')).encode())
+
+
+def decode_batch(payload):
+    """Return the samples of a spool_batches row."""
+    return json.loads(zlib.decompress(payload))
@@ -0,0 +1,143 @@
+"""
+The optional stream transport of the client ("transport": "stream" in
+client_config.json): samples are sent over one authenticated TCP
+connection and acknowledged by the server.
+"""
+import hashlib
+import hmac
+import json
+import socket
+import struct
+import uuid
+from urllib.parse import urlparse
+
+# Frame format; must match server/stream_ingest.py.
+STREAM_FRAME_HEADER = struct.Struct('!I')
+# Samples sent before waiting for their acknowledgement.
+STREAM_BATCH = 100
+STREAM_TIMEOUT = 30
+
+
+def uses_stream(config):
+    """Return True if samples should be sent over the stream connection."""
+    return config.get('transport') == 'stream' and 'stream_key' in config
+
+
+def encode_stream_frame(message):
+    """Encode a message as one length-prefixed stream frame."""
+    payload = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    return STREAM_FRAME_HEADER.pack(len(payload)) + payload
+
+
+def read_stream_frame(reader):
+    """Read one frame from the stream."""
+    header = reader.read(STREAM_FRAME_HEADER.size)
+    if len(header) < STREAM_FRAME_HEADER.size:
+        raise ConnectionError("Stream closed by server")
+    (length,) = STREAM_FRAME_HEADER.unpack(header)
+    payload = reader.read(length)
+    if len(payload) < length:
+        raise ConnectionError("Stream closed by server")
+    message = json.loads(payload)
+    if 'error' in message:
+        raise ConnectionError(f"Stream refused: {message['error']}")
+    return message
+
+
+def open_stream(config, version, epoch):
+    """
+    Connect and authenticate the stream connection. Returns the socket, a
+    reader for it and the last sequence number the server has stored.
+    version is the client version the server checks.
+    """
+    address = (urlparse(config['server_url']).hostname,
+               config['stream_port'])
+    sock = socket.create_connection(address, timeout=STREAM_TIMEOUT)
+    reader = sock.makefile('rb')
+    try:
+        challenge = bytes.fromhex(read_stream_frame(reader)['challenge'])
+        mac = hmac.new(bytes.fromhex(config['stream_key']), challenge,
+                       hashlib.sha256).hexdigest()
+        sock.sendall(encode_stream_frame({
+            'device_id': config['device_id'], 'version': version,
+            'epoch': epoch, 'mac': mac
+        }))
+        return sock, reader, read_stream_frame(reader)['last_seq']
+    except BaseException:
+        reader.close()
+        sock.close()
+        raise
+
+
+class StreamChannel:
+    """
+    The connection of the stream transport. Samples are numbered within an
+    epoch, one per client run. The caller keeps every sample until it is
+    acknowledged and sends the unacknowledged ones again, in the same
+    order, after a dropped connection; numbering restarts from the last
+    acknowledgement, so they get the same sequence numbers again and the
+    server skips the ones it stored without the acknowledgement arriving.
+
+    transport holds the back-off the server asks for; version and
+    interval are the client version and collection interval in seconds.
+    """
+
+    __slots__ = ('transport', 'version', 'interval', 'epoch', 'sequence',
+                 'sock', 'reader')
+
+    def __init__(self, transport, version, interval):
+        self.transport = transport
+        self.version = version
+        self.interval = interval
+        self.epoch = uuid.uuid4().hex
+        # Sequence number of the last acknowledged sample.
+        self.sequence = 0
+        self.sock = None
+        self.reader = None
+
+    def close(self):
+        """Close the connection, if open."""
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+            self.sock = self.reader = None
+
+    def send(self, config, samples):
+        """
+        Send samples, oldest first, opening the connection if needed, and
+        return how many of them the server acknowledged.
+        """
+        if self.transport.backing_off():
+            return 0
+        first = self.sequence + 1
+        acked = self.sequence
+        try:
+            if self.sock is None:
+                self.sock, self.reader, _ = open_stream(
+                    config, self.version, self.epoch)
+            for start in range(0, len(samples), STREAM_BATCH):
+                batch = samples[start:start + STREAM_BATCH]
+                self.sock.sendall(b''.join(
+                    encode_stream_frame({'s': first + start + offset,
+                                         'i': self.interval, 'm': metrics})
+                    for offset, metrics in enumerate(batch)
+                ))
+                while acked < first + start + len(batch) - 1:
+                    reply = read_stream_frame(self.reader)
+                    acked = reply['ack']
+                    if 'retry_after' in reply:
+                        self.transport.back_off(reply['retry_after'])
+                        print(f"Server is busy, backing off for "
+                              f"{reply['retry_after']:g} s.")
+                        self.close()
+                        break
+                if self.sock is None:
+                    break
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not stream data to server: {e}")
+            self.close()
+        # Samples the server stored under numbers beyond these were sent
+        # before and are sent again next.
+        sent = min(max(acked - first + 1, 0), len(samples))
+        self.sequence = first - 1 + sent
+        return sent
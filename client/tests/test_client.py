@@ -1,12 +1,25 @@
 """Unit tests for the client."""
+import contextlib
+import http.server
+import hashlib
+import hmac
 import json
 import os
+import shutil
+import socket
 import sqlite3
+import tempfile
+import threading
 import unittest
+import zlib
 from unittest.mock import patch, MagicMock
 import importlib.util
 import requests
 
+import probes
+import spooling
+import streaming
+
 # Load the client module from file
 client_path = os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..', 'client.py')
@@ -113,18 +126,13 @@ class DictRow:
         return len(self._data)
 
 
-class TestClient(unittest.TestCase):
-    """Test cases for the client."""
+class ClientTestCase(unittest.TestCase):
+    """Sets up a local cache in memory."""
 
     def setUp(self):
         """Set up test environment."""
         self.real_conn = sqlite3.connect(':memory:')
-        c = self.real_conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS metrics_cache (
-                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                     metrics_json TEXT
-                     )''')
+        spooling.create_cache_tables(self.real_conn.cursor())
         self.real_conn.commit()
 
         # Create our mock connection
@@ -141,6 +149,10 @@ class TestClient(unittest.TestCase):
         self.mock_connect.stop()
         self.real_conn.close()
 
+
+class TestProbes(ClientTestCase):
+    """Test cases for metric collection."""
+
     def test_get_hostname(self):
         """Test getting the hostname."""
         with patch('subprocess.check_output') as mock_subprocess:
@@ -162,9 +174,9 @@ class TestClient(unittest.TestCase):
     @patch('psutil.net_io_counters')
     @patch('psutil.net_if_addrs')
     @patch('psutil.net_if_stats')
-    @patch.object(client, 'get_temperature')
-    @patch.object(client, 'get_throttle_info')
-    @patch.object(client, 'get_voltage_info')
+    @patch.object(probes, 'get_temperature')
+    @patch.object(probes, 'get_throttle_info')
+    @patch.object(probes, 'get_voltage_info')
     def test_collect_metrics_once(self, mock_voltage, mock_throttle,
                                   mock_temp, mock_net_stats, mock_net_addrs,
                                   mock_net_io, mock_disk, mock_mem,
@@ -185,12 +197,192 @@ class TestClient(unittest.TestCase):
         mock_throttle.return_value = '0x0'
         mock_voltage.return_value = {'core': 1.2}
 
-        metrics = client.collect_metrics_once()
+        metrics = probes.collect_metrics_once()
 
         self.assertEqual(metrics['cpu']['usage'], 50.0)
         self.assertEqual(metrics['memory']['percentage'], 25.0)
         self.assertEqual(metrics['temperature'], 45.0)
 
+    def test_probe_scheduler(self):
+        """Test per-probe intervals and that slow probes keep their last
+        value."""
+        reads = []
+        release = threading.Event()
+
+        def counter(name, value):
+            def read():
+                reads.append(name)
+                return value
+            return read
+
+        def slow():
+            release.wait(5)
+            return 'late'
+
+        templates = {
+            'fast': probes.Probe('fast', counter('fast', 1)),
+            'rare': probes.Probe('rare', counter('rare', 2), interval=3600),
+            'slow': probes.Probe('slow', slow, timeout=0.05),
+        }
+        scheduler = probes.ProbeScheduler(templates,
+                                          {'fast': {'interval': 0}})
+        self.addCleanup(scheduler.close)
+        with patch.object(probes, 'REQUIRED_PROBES', ('fast',)), \
+                patch.object(probes, 'build_metrics', dict):
+            first = scheduler.collect()
+            second = scheduler.collect()
+            release.set()
+            scheduler.probes[2].pending.result(5)
+            third = scheduler.collect()
+
+        self.assertEqual(first, {'fast': 1, 'rare': 2, 'slow': None})
+        self.assertEqual(second, first)
+        self.assertEqual(third['slow'], 'late')
+        self.assertEqual(reads.count('fast'), 3)
+        self.assertEqual(reads.count('rare'), 1)
+        self.assertEqual(set(scheduler.durations), {'fast', 'slow'})
+
+    def test_process_tracker(self):
+        """Test top-N selection from CPU time deltas and the PID cache."""
+        cpu_seconds = {1: 10.0, 2: 5.0, 3: 1.0}
+        rss = {1: 10, 2: 300, 3: 20}
+        created = []
+
+        class FakeProcess:
+            """psutil.Process reporting the values set up above."""
+
+            def __init__(self, pid):
+                created.append(pid)
+                self.pid = pid
+
+            def name(self):
+                """Return the process name."""
+                return f'proc{self.pid}'
+
+            def oneshot(self):
+                """Return a no-op context manager."""
+                return contextlib.nullcontext()
+
+            def cpu_times(self):
+                """Return the CPU times of the process."""
+                return MagicMock(user=cpu_seconds[self.pid], system=0.0)
+
+            def memory_info(self):
+                """Return the memory use of the process."""
+                return MagicMock(rss=rss[self.pid] * 1024**2)
+
+        tracker = probes.ProcessTracker(top_n=1)
+        with patch('psutil.pids', side_effect=lambda: list(cpu_seconds)), \
+                patch('psutil.Process', FakeProcess), \
+                patch('time.monotonic', side_effect=[100.0, 110.0]):
+            first = tracker.read()
+            cpu_seconds.update({1: 11.0, 2: 7.0})
+            del cpu_seconds[3]
+            second = tracker.read()
+
+        # Without a previous read only memory can be ranked.
+        self.assertEqual(first, [{'pid': 2, 'name': 'proc2',
+                                  'cpu_percent': None, 'rss_mb': 300.0}])
+        self.assertEqual([(p['pid'], p['cpu_percent']) for p in second],
+                         [(2, 20.0)])
+        self.assertEqual(sorted(created), [1, 2, 3])
+
+    def test_disk_tracker(self):
+        """Test disk I/O rates from counter deltas and mount usage."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        diskstats = os.path.join(directory, 'diskstats')
+        mounts = os.path.join(directory, 'mounts')
+        sys_block = os.path.join(directory, 'block')
+        for name in ('mmcblk0', 'sda', 'loop0'):
+            os.makedirs(os.path.join(sys_block, name))
+        with open(mounts, 'w', encoding='utf-8') as f:
+            f.write('/dev/mmcblk0p2 / ext4 rw 0 0\n'
+                    '/dev/sda1 /mnt/usb\\040ssd ext4 rw 0 0\n')
+
+        def write_diskstats(sd_sectors, sd_ticks):
+            with open(diskstats, 'w', encoding='ascii') as f:
+                f.write(
+                    f' 179 0 mmcblk0 100 0 {sd_sectors} 0 50 0 400 0 0 '
+                    f'{sd_ticks} 0\n'
+                    f' 179 2 mmcblk0p2 100 0 {sd_sectors} 0 50 0 400 0 0 '
+                    f'{sd_ticks} 0\n'
+                    '   8 0 sda 0 0 0 0 0 0 0 0 0 0 0\n'
+                    '   7 0 loop0 5 0 10 0 0 0 0 0 0 1 0\n'
+                )
+
+        usage = MagicMock(f_blocks=1000, f_bfree=250, f_bavail=200,
+                          f_frsize=1024**2)
+        tracker = probes.DiskTracker(['/', '/mnt/usb ssd', '/mnt/nfs'])
+        with patch.object(probes, 'DISKSTATS_PATH', diskstats), \
+                patch.object(probes, 'MOUNTS_PATH', mounts), \
+                patch.object(probes, 'SYS_BLOCK_PATH', sys_block), \
+                patch('os.statvfs', return_value=usage) as statvfs, \
+                patch('time.monotonic', side_effect=[100.0, 110.0]):
+            write_diskstats(2000, 1000)
+            first = tracker.read()
+            write_diskstats(4048, 6000)
+            second = tracker.read()
+
+        self.assertEqual(first['devices'], {})
+        # Partitions, loop devices and disks without any I/O are left out.
+        self.assertEqual(second['devices'], {'mmcblk0': {
+            'read_bps': 104858, 'write_bps': 0, 'read_iops': 0.0,
+            'write_iops': 0.0, 'busy_percent': 50.0}})
+        self.assertEqual(second['mounts']['/mnt/usb ssd'], {
+            'total': 0.98, 'used': 0.73, 'free': 0.2, 'percentage': 75.0})
+        # /mnt/nfs is not mounted, so its parent filesystem is not reported.
+        self.assertEqual(list(second['mounts']), ['/', '/mnt/usb ssd'])
+        self.assertEqual(statvfs.call_count, 4)
+
+    def test_client_overhead(self):
+        """Test the client_stats section and the profiling toggle."""
+        profiler = client.SelfProfiler()
+        first = profiler.overhead({'cpu': 1.0015}, 1.2, None)
+        second = profiler.overhead({}, 0.5, 0.02)
+        self.assertIsNone(first['cpu_percent'])
+        self.assertEqual(first['probe_ms'], {'cpu': 1001.5})
+        self.assertGreater(first['rss_mb'], 0)
+        self.assertIsNotNone(second['cpu_percent'])
+        self.assertEqual(second['send_ms'], 20.0)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'client.prof')
+            with patch.object(client, 'PROFILE_FILE', path):
+                profiler.toggle()
+                value, seconds = profiler.timed_read(lambda: sum(range(100)))
+                profiler.toggle()
+            self.assertEqual(value, 4950)
+            self.assertGreaterEqual(seconds, 0)
+            self.assertTrue(os.path.getsize(path))
+
+    def test_benchmarks(self):
+        """Test that the benchmarks run on fixtures and start as many
+        subprocesses as their baselines."""
+        # The cache replay benchmark needs a real database.
+        self.mock_connect.stop()
+        bench_spec = importlib.util.spec_from_file_location(
+            'bench_client',
+            os.path.join(os.path.dirname(client_path), 'benchmarks',
+                         'bench_client.py'))
+        bench = importlib.util.module_from_spec(bench_spec)
+        bench_spec.loader.exec_module(bench)
+
+        results = bench.run_benchmarks(repeat=1)
+        baselines = bench.load_baselines()
+        self.assertEqual(set(results), set(baselines))
+        for name, result in results.items():
+            self.assertEqual(result['subprocesses'],
+                             baselines[name]['subprocesses'], name)
+        self.assertEqual(results['voltage_pi4']['subprocesses'], 4)
+        self.assertEqual(bench.compare(
+            dict(results['voltage_pi4'], subprocesses=5),
+            results['voltage_pi4']), ['5 subprocesses, baseline 4'])
+
+
+class TestSending(ClientTestCase):
+    """Test cases for sending samples to the server."""
+
     @patch('requests.post')
     def test_send_data_success(self, mock_post):
         """Test sending data successfully."""
@@ -216,10 +408,141 @@ class TestClient(unittest.TestCase):
         result = client.send_data(config, metrics)
         self.assertFalse(result)
 
+    @patch('requests.post')
+    def test_send_data_backoff(self, mock_post):
+        """Test that a 429 answer pauses sending for Retry-After."""
+        mock_response = MagicMock()
+        mock_response.status_code = 429
+        mock_response.headers = {'Retry-After': '30'}
+        mock_post.return_value = mock_response
+        config = {'device_id': 'test-device',
+                  'server_url': 'http://test-server'}
+
+        with patch.object(client.transport, 'backoff_until', 0.0):
+            self.assertFalse(client.send_data(config, {}))
+            self.assertTrue(client.transport.backing_off())
+            self.assertFalse(client.send_data(config, {}))
+            mock_post.assert_called_once()
+
+    def test_send_data_low_footprint(self):
+        """Test the http.client transport and its kept-alive connection."""
+        requests_seen = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """Answers 201, then 429."""
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                """Record the request and answer it."""
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                requests_seen.append((self.client_address, self.path,
+                                      json.loads(body)))
+                status = 201 if len(requests_seen) < 3 else 429
+                self.send_response(status)
+                self.send_header('Retry-After', '30')
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        config = {'device_id': 5,
+                  'server_url': f'http://127.0.0.1:{httpd.server_port}'}
+        try:
+            with patch.object(client, 'LOW_FOOTPRINT', True), \
+                    patch.object(client.transport, 'backoff_until', 0.0), \
+                    patch('requests.post') as mock_post:
+                self.assertTrue(client.send_data(config, {'cpu': 1}))
+                self.assertTrue(client.send_data(config, {'cpu': 2}))
+                self.assertFalse(client.send_data(config, {'cpu': 3}))
+                self.assertTrue(client.transport.backing_off())
+                mock_post.assert_not_called()
+        finally:
+            client.close_http()
+            httpd.shutdown()
+            httpd.server_close()
+
+        self.assertEqual([r[2]['metrics'] for r in requests_seen],
+                         [{'cpu': 1}, {'cpu': 2}, {'cpu': 3}])
+        self.assertEqual({r[1] for r in requests_seen}, {'/api/data'})
+        # All samples went over one connection.
+        self.assertEqual(len({r[0] for r in requests_seen}), 1)
+
+        with patch.object(client, 'LOW_FOOTPRINT', True):
+            self.assertFalse(client.send_data(config, {'cpu': 4}))
+
+    def test_send_data_udp(self):
+        """Test that the UDP transport sends one signed datagram."""
+        key = bytes(range(32))
+        config = {'device_id': 5, 'server_url': 'http://127.0.0.1:5000',
+                  'transport': 'udp', 'udp_key': key.hex(),
+                  'udp_port': 5001}
+        mock_socket = MagicMock()
+        with patch.object(client.transport, 'udp_socket', mock_socket), \
+                patch.object(client.transport, 'udp_sequence', 41):
+            self.assertTrue(client.send_data(config, {'cpu': {'usage': 1}}))
+
+        datagram, address = mock_socket.sendto.call_args[0]
+        self.assertEqual(address, ('127.0.0.1', 5001))
+        message, mac = datagram[:-16], datagram[-16:]
+        self.assertEqual(client.UDP_HEADER.unpack_from(message)[3:], (5, 42))
+        self.assertEqual(
+            mac, hmac.new(key, message, hashlib.sha256).digest()[:16]
+        )
+        body = json.loads(zlib.decompress(message[client.UDP_HEADER.size:]))
+        self.assertEqual(body['m'], {'cpu': {'usage': 1}})
+
+    def test_stream_channel(self):
+        """Test that unacknowledged samples keep their sequence numbers
+        when they are sent again."""
+        received = []
+
+        def serve(sock, count, ack):
+            reader = sock.makefile('rb')
+            for _ in range(count):
+                (length,) = streaming.STREAM_FRAME_HEADER.unpack(
+                    reader.read(streaming.STREAM_FRAME_HEADER.size))
+                received.append(json.loads(reader.read(length)))
+            sock.sendall(streaming.encode_stream_frame({'ack': ack}))
+            reader.close()
+            sock.close()
+
+        def connect(count, ack):
+            ours, theirs = socket.socketpair()
+            server = threading.Thread(target=serve,
+                                      args=(theirs, count, ack))
+            server.start()
+            self.addCleanup(server.join, 5)
+            return ours, ours.makefile('rb'), ack
+
+        stream = streaming.StreamChannel(client.transport, '1.0.0', 10)
+        config = {'device_id': 5, 'transport': 'stream'}
+        samples = [{'cpu': {'usage': usage}} for usage in (10, 20, 30)]
+        # Only the first sample is acknowledged before the connection drops.
+        with patch.object(streaming, 'open_stream',
+                          return_value=connect(3, 1)):
+            self.assertEqual(stream.send(config, samples), 1)
+        self.assertIsNone(stream.sock)
+        with patch.object(streaming, 'open_stream',
+                          return_value=connect(2, 3)):
+            self.assertEqual(stream.send(config, samples[1:]), 2)
+        stream.close()
+
+        self.assertEqual([(f['s'], f['m']['cpu']['usage']) for f in received],
+                         [(1, 10), (2, 20), (3, 30), (2, 20), (3, 30)])
+        self.assertEqual(stream.sequence, 3)
+
+
+class TestSpool(ClientTestCase):
+    """Test cases for the spool and the local cache."""
+
     def test_cache_data(self):
         """Test caching data locally."""
         metrics = {'cpu': {'usage': 50.0}}
-        client.cache_data(metrics)
+        client.spool.cache(metrics)
 
         # Reset the mock connection state after the close() call
         self.mock_conn._closed = False
@@ -238,11 +561,11 @@ class TestClient(unittest.TestCase):
         metrics1 = {'cpu': {'usage': 50.0}}
         metrics2 = {'cpu': {'usage': 60.0}}
 
-        client.cache_data(metrics1)
+        client.spool.cache(metrics1)
         # Reset the mock connection state
         self.mock_conn._closed = False
 
-        client.cache_data(metrics2)
+        client.spool.cache(metrics2)
         # Reset the mock connection state
         self.mock_conn._closed = False
 
@@ -259,6 +582,97 @@ class TestClient(unittest.TestCase):
         count = c.fetchone()[0]
         self.assertEqual(count, 0)
 
+    @patch.object(client, 'send_data')
+    def test_cache_only_opened_when_pending(self, mock_send_data):
+        """Test that an empty cache is not opened again until data is
+        cached."""
+        config = {'device_id': 'test-device',
+                  'server_url': 'http://test-server'}
+        with patch.object(client.spool, 'cache_pending', True):
+            client.send_cached_data(config)
+            self.assertFalse(client.spool.cache_pending)
+            self.mock_conn._closed = False
+
+            with patch('sqlite3.connect') as mock_connect:
+                client.send_cached_data(config)
+                mock_connect.assert_not_called()
+
+            client.spool.cache({'cpu': {'usage': 50.0}})
+            self.mock_conn._closed = False
+            self.assertTrue(client.spool.cache_pending)
+            mock_send_data.return_value = True
+            client.send_cached_data(config)
+            mock_send_data.assert_called_once()
+            self.assertFalse(client.spool.cache_pending)
+
+    @patch.object(client, 'send_data')
+    def test_spool(self, mock_send_data):
+        """Test that unsent samples are written in batches and sent in
+        order."""
+        spool = spooling.Spool('batch', capacity=10, flush_samples=3)
+        spool.cache_pending = False
+        config = {'device_id': 'test-device',
+                  'server_url': 'http://test-server'}
+        with patch.object(client, 'spool', spool):
+            for usage in range(5):
+                spool.add({'cpu': {'usage': usage}})
+                self.mock_conn._closed = False
+            # One write for the first three samples, two kept in memory.
+            self.assertEqual(spool.counters['writes'], 1)
+            self.assertEqual(len(spool.ring), 2)
+            self.assertTrue(client.spool.cache_pending)
+            c = self.mock_conn.cursor()
+            c.execute("SELECT samples, payload FROM spool_batches")
+            samples, payload = c.fetchone()
+            self.assertEqual(samples, 3)
+            self.assertEqual(len(spooling.decode_batch(payload)), 3)
+
+            # The server accepts two samples, then goes away again.
+            mock_send_data.side_effect = [True, True, False]
+            self.assertFalse(client.send_cached_data(config))
+            self.mock_conn._closed = False
+            c = self.mock_conn.cursor()
+            c.execute("SELECT samples, payload FROM spool_batches")
+            samples, payload = c.fetchone()
+            self.assertEqual(samples, 1)
+            self.assertEqual(spooling.decode_batch(payload),
+                             [{'cpu': {'usage': 2}}])
+
+            mock_send_data.side_effect = None
+            mock_send_data.return_value = True
+            self.assertTrue(client.send_cached_data(config))
+            self.mock_conn._closed = False
+            sent = [call.args[1]['cpu']['usage']
+                    for call in mock_send_data.call_args_list]
+            self.assertEqual(sent, [0, 1, 2, 2, 3, 4])
+            self.assertFalse(spool.ring)
+            self.assertFalse(client.spool.cache_pending)
+            c = self.mock_conn.cursor()
+            c.execute("SELECT COUNT(*) FROM spool_batches")
+            self.assertEqual(c.fetchone()[0], 0)
+
+    def test_spool_durability(self):
+        """Test the memory and sample durability levels."""
+        with self.assertRaises(ValueError):
+            spooling.Spool('fsync')
+
+        spool = spooling.Spool('memory', capacity=2)
+        with patch('sqlite3.connect') as mock_connect:
+            for usage in range(3):
+                spool.add({'cpu': {'usage': usage}})
+            mock_connect.assert_not_called()
+        self.assertEqual(list(spool.ring),
+                         [{'cpu': {'usage': 1}}, {'cpu': {'usage': 2}}])
+        self.assertEqual(spool.counters['dropped'], 1)
+
+        spool = spooling.Spool('sample')
+        spool.add({'cpu': {'usage': 50.0}})
+        self.mock_conn._closed = False
+        c = self.mock_conn.cursor()
+        c.execute("SELECT metrics_json FROM metrics_cache")
+        self.assertEqual(json.loads(c.fetchone()[0]), {'cpu': {'usage': 50.0}})
+        self.assertFalse(spool.ring)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,136 @@
+"""
+Admission control for the ingest endpoint.
+
+Every sample must take a token from its device's bucket and from the
+global bucket, and at most `max_concurrent` samples are written at once.
+A device sending faster than its configured rate gets 429 Too Many
+Requests; when the server as a whole is over its budget new samples get
+503 Service Unavailable. Both carry a Retry-After hint that clients use to
+back off and keep the samples in their local cache, so an overloaded
+server sheds load quickly instead of tying up every worker thread.
+
+Limits apply per server process.
+"""
+import math
+import threading
+import time
+
+DEFAULT_LIMITS = {
+    # A device reporting every 10 s uses a tenth of its rate; the burst
+    # lets it replay a short outage from its cache at full speed.
+    'device_rate': 1.0,
+    'device_burst': 30,
+    'global_rate': 200.0,
+    'global_burst': 400,
+    'max_concurrent': 8,
+}
+
+
+class Rejected(Exception):
+    """Raised when a sample is not admitted."""
+
+    def __init__(self, status, retry_after, reason):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second."""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        """Add the tokens accumulated since the last refill."""
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until a token is available (0 if one is available)."""
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """Per-device and global token buckets plus a concurrency limit."""
+
+    def __init__(self, device_rate=DEFAULT_LIMITS['device_rate'],
+                 device_burst=DEFAULT_LIMITS['device_burst'],
+                 global_rate=DEFAULT_LIMITS['global_rate'],
+                 global_burst=DEFAULT_LIMITS['global_burst'],
+                 max_concurrent=DEFAULT_LIMITS['max_concurrent'],
+                 clock=time.monotonic):
+        self.device_limits = (device_rate, device_burst)
+        self.clock = clock
+        self._global = TokenBucket(global_rate, global_burst, clock())
+        self._devices = {}
+        self._lock = threading.Lock()
+        # Write slots not taken, out of max_concurrent.
+        self._free = max_concurrent
+        self.rejected = {429: 0, 503: 0}
+
+    def _reject(self, status, wait, reason):
+        self.rejected[status] += 1
+        raise Rejected(status, max(1, math.ceil(wait)), reason)
+
+    def take(self, device_id):
+        """Take a token for one sample of a device or raise Rejected."""
+        now = self.clock()
+        with self._lock:
+            bucket = self._devices.get(device_id)
+            if bucket is None:
+                bucket = self._devices[device_id] = TokenBucket(
+                    *self.device_limits, now)
+            bucket.refill(now)
+            self._global.refill(now)
+            wait = bucket.wait_time()
+            if wait:
+                self._reject(429, wait, 'Device rate limit exceeded')
+            wait = self._global.wait_time()
+            if wait:
+                self._reject(503, wait, 'Server is over its ingest budget')
+            bucket.tokens -= 1
+            self._global.tokens -= 1
+
+    def enter(self, device_id):
+        """
+        Admit one sample or raise Rejected. Rate limits are checked first,
+        so rejected samples never wait for a write slot. Every successful
+        enter() must be paired with leave().
+        """
+        self.take(device_id)
+        with self._lock:
+            if self._free:
+                self._free -= 1
+                return
+            # The sample was not written, so give its tokens back.
+            self._global.tokens += 1
+            bucket = self._devices.get(device_id)
+            if bucket is not None:
+                bucket.tokens += 1
+            self._reject(503, 1, 'Too many samples being written')
+
+    def leave(self):
+        """Release the write slot taken by enter()."""
+        with self._lock:
+            self._free += 1
+
+    def forget(self, device_id):
+        """Drop the bucket of a removed device."""
+        with self._lock:
+            self._devices.pop(device_id, None)
+
+
+def build_admission(settings):
+    """Build an AdmissionController from the "admission" config section."""
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(settings or {})
+    return AdmissionController(**limits)
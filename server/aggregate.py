@@ -0,0 +1,189 @@
+"""
+Vectorized multi-device aggregation on a common time grid.
+
+The requested columns of all devices are read with one SQL query straight
+into NumPy arrays. Samples are assigned to grid buckets with integer
+arithmetic and reduced per (device, bucket) with bincount/ufunc.at, so the
+cost is a few passes over flat arrays no matter how many devices and
+buckets are involved. Results are columnar: one shared list of bucket
+timestamps and one list of values per device and metric.
+"""
+import math
+
+import numpy as np
+
+from tsblock import archived_rows
+
+QUERY_METRICS = (
+    'cpu_usage', 'cpu_frequency', 'memory_used', 'memory_percentage',
+    'disk_used', 'disk_percentage', 'temperature', 'uptime', 'amperage'
+)
+AGGREGATIONS = ('mean', 'min', 'max', 'rate')
+
+# Upper bound on buckets per series, to keep responses bounded.
+MAX_BUCKETS = 10000
+
+
+class QueryError(Exception):
+    """Raised when a query cannot be answered with the given options."""
+
+
+def load_columns(conn, device_ids, metrics, start, end):
+    """
+    Read the samples of several devices in [start, end) (epoch seconds).
+
+    Returns (device_ids, timestamps, values): two 1-D arrays and a
+    2-D float array with one column per metric, sorted by device and time.
+    Missing values are NaN. Archived samples are included.
+    """
+    placeholders = ','.join('?' for _ in device_ids)
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(f'''
+        SELECT device_id, CAST(strftime('%s', timestamp) AS INTEGER),
+               {', '.join(metrics)}
+        FROM stats
+        WHERE device_id IN ({placeholders})
+          AND timestamp >= datetime(?, 'unixepoch')
+          AND timestamp < datetime(?, 'unixepoch')
+        ORDER BY device_id, timestamp, id
+    ''', list(device_ids) + [math.floor(start), math.ceil(end)])
+    rows = cursor.fetchall()
+    cursor.close()
+    archived = list(archived_rows(
+        conn, ['device_id', 'timestamp'] + list(metrics), device_ids,
+        math.floor(start), math.ceil(end), epoch=True))
+
+    table = np.array(archived + rows, dtype=np.float64).reshape(
+        -1, len(metrics) + 2)
+    if archived:
+        table = table[np.lexsort((table[:, 1], table[:, 0]))]
+    return (table[:, 0].astype(np.int64), table[:, 1].astype(np.int64),
+            table[:, 2:])
+
+
+def check_options(start, end, step, agg):
+    """Raise QueryError unless the grid and aggregation are usable."""
+    if agg not in AGGREGATIONS:
+        raise QueryError(
+            f"Unknown aggregation '{agg}', expected one of "
+            f"{', '.join(AGGREGATIONS)}"
+        )
+    if step <= 0:
+        raise QueryError('step must be positive')
+    if not 0 < math.ceil((end - start) / step) <= MAX_BUCKETS:
+        raise QueryError(
+            f'The range must contain between 1 and {MAX_BUCKETS} steps'
+        )
+
+
+def align_range(start, end, step):
+    """
+    Widen [start, end) to whole steps. Aligned ranges make the grid of a
+    query independent of the exact request time, so repeated queries share
+    cache entries.
+    """
+    return int(start) // step * step, math.ceil(end / step) * step
+
+
+def _reduce(groups, size, values, agg):
+    """Reduce values into `size` groups, ignoring NaN; empty groups are NaN."""
+    valid = ~np.isnan(values)
+    groups, values = groups[valid], values[valid]
+    counts = np.bincount(groups, minlength=size)
+    if agg in ('mean', 'rate'):
+        sums = np.bincount(groups, weights=values, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts
+    if agg == 'max':
+        result = np.full(size, -np.inf)
+        np.maximum.at(result, groups, values)
+    else:
+        result = np.full(size, np.inf)
+        np.minimum.at(result, groups, values)
+    result[counts == 0] = np.nan
+    return result
+
+
+def _rates(device_column, timestamps, values, rows, buckets):
+    """Per-second changes between consecutive samples of each device, with
+    the rows and buckets of the later samples."""
+    same_device = device_column[1:] == device_column[:-1]
+    elapsed = (timestamps[1:] - timestamps[:-1]).astype(np.float64)
+    usable = same_device & (elapsed > 0)
+    values = ((values[1:] - values[:-1])[usable]
+              / elapsed[usable][:, np.newaxis])
+    return values, rows[1:][usable], buckets[1:][usable]
+
+
+def aggregate(device_column, timestamps, values, device_ids, start, end,
+              step, agg):
+    """
+    Bucket samples on the grid start, start + step, ... < end and reduce
+    each (device, bucket) with `agg`.
+
+    "rate" is the mean per-second change between consecutive samples of a
+    device, assigned to the bucket of the later sample.
+
+    Returns (grid, result) where result has shape
+    (len(device_ids), n_metrics, n_buckets).
+    """
+    check_options(start, end, step, agg)
+    grid = np.arange(start, end, step, dtype=np.int64)
+
+    n_buckets = len(grid)
+    rows = np.searchsorted(np.asarray(device_ids), device_column)
+    buckets = (timestamps - start) // step
+
+    if agg == 'rate':
+        values, rows, buckets = _rates(device_column, timestamps, values,
+                                       rows, buckets)
+
+    groups = rows * n_buckets + buckets
+    size = len(device_ids) * n_buckets
+    result = np.stack([
+        _reduce(groups, size, values[:, i], agg).reshape(
+            len(device_ids), n_buckets)
+        for i in range(values.shape[1])
+    ], axis=1)
+    return grid, result
+
+
+def run_query(conn, device_ids, metrics, start, end, step, agg='mean'):
+    """
+    Answer a multi-device query and return it as columnar JSON-ready data.
+    """
+    unknown = [metric for metric in metrics if metric not in QUERY_METRICS]
+    if unknown:
+        raise QueryError(
+            f"Unknown metric '{unknown[0]}', expected one of "
+            f"{', '.join(QUERY_METRICS)}"
+        )
+    if not device_ids or not metrics:
+        raise QueryError('At least one device and one metric are required')
+
+    check_options(start, end, step, agg)
+
+    device_ids = sorted(set(device_ids))
+    start, end = align_range(start, end, step)
+    device_column, timestamps, values = load_columns(
+        conn, device_ids, metrics, start, end
+    )
+    grid, result = aggregate(device_column, timestamps, values, device_ids,
+                             start, end, step, agg)
+
+    # NaN is not valid JSON; empty buckets become null.
+    rounded = np.round(result, 4).astype(object)
+    rounded[np.isnan(result)] = None
+    return {
+        'start': int(grid[0]),
+        'step': step,
+        'agg': agg,
+        'timestamps': grid.tolist(),
+        'series': [
+            {'device_id': device_id, 'metric': metric,
+             'values': rounded[d, m].tolist()}
+            for d, device_id in enumerate(device_ids)
+            for m, metric in enumerate(metrics)
+        ],
+    }
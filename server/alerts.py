@@ -0,0 +1,488 @@
+"""
+Rule-based alerting evaluated incrementally over the stored samples.
+
+Every rule keeps a small amount of per-device state in memory (when the
+condition started holding, an optional sliding window of recent values),
+so evaluating a sample never queries the database. Rules are indexed by
+the metric they watch, which keeps the cost per sample proportional to the
+rules for the metrics it carries rather than to the size of the rule set.
+Missing-device rules are driven by the liveness tracker's deadline events.
+Notifications are handed to a background thread and delivered to pluggable
+sinks, so a slow webhook never delays ingest.
+
+Every server process evaluates the samples it ingests. The firing alerts
+are shared through alert_state: a transition is stored, logged in
+alert_log and notified only by the process whose write changed that
+table, so an alert seen by several workers is sent once.
+"""
+import json
+import logging
+import mailbox
+import operator
+import queue
+import threading
+import time
+import urllib.request
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.message import EmailMessage
+
+from timeutils import parse_time
+
+logger = logging.getLogger(__name__)
+
+RECENT_ALERTS = 100
+
+# Bits of `vcgencmd get_throttled` that describe the current state:
+# under-voltage, ARM frequency capped, throttled, soft temperature limit.
+THROTTLED_NOW_MASK = 0xF
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    'mask': lambda value, mask: bool(int(value) & int(mask)),
+}
+
+DEFAULT_RULES = [
+    {'name': 'high-temperature', 'metric': 'temperature', 'op': '>',
+     'value': 75, 'for_seconds': 120, 'severity': 'critical'},
+    {'name': 'throttled', 'metric': 'throttled', 'op': 'mask',
+     'value': THROTTLED_NOW_MASK, 'severity': 'warning'},
+    {'name': 'disk-full', 'metric': 'disk_percentage', 'op': '>',
+     'value': 90, 'severity': 'warning'},
+    {'name': 'device-missing', 'type': 'missing', 'intervals': 3,
+     'severity': 'critical'},
+]
+
+
+# Columns of the stats table rules can watch.
+VALUE_COLUMNS = ('cpu_usage', 'memory_percentage', 'disk_percentage',
+                 'temperature', 'throttled')
+
+
+def parse_throttled(value):
+    """Convert the hex string of `vcgencmd get_throttled` to an int."""
+    if isinstance(value, str):
+        try:
+            return int(value, 16)
+        except ValueError:
+            return None
+    return value
+
+
+def alert_values(metrics):
+    """Extract the values rules can watch from an ingested metrics payload."""
+    return {
+        'cpu_usage': metrics.get('cpu', {}).get('usage'),
+        'memory_percentage': metrics.get('memory', {}).get('percentage'),
+        'disk_percentage': metrics.get('disk', {}).get('percentage'),
+        'temperature': metrics.get('temperature'),
+        'throttled': parse_throttled(metrics.get('throttled')),
+    }
+
+
+@dataclass
+class RuleState:
+    """Per-device evaluation state of one rule; `alert` is the firing
+    alert."""
+    firing: bool = False
+    since: float = None
+    window: deque = None
+    total: float = 0.0
+    value: float = None
+    alert: dict = None
+
+
+@dataclass
+class ThresholdRule:
+    """
+    Fires when `metric <op> value` has held for `for_seconds`.
+
+    With `window_seconds` the comparison is made against the average over
+    a sliding time window instead of the latest sample.
+    """
+    name: str
+    metric: str
+    op: str
+    value: float
+    for_seconds: float = 0
+    window_seconds: float = 0
+    severity: str = 'warning'
+
+    def __post_init__(self):
+        if self.op not in OPERATORS:
+            raise ValueError(
+                f"Unknown operator '{self.op}' in rule '{self.name}'")
+
+    @property
+    def threshold(self):
+        """The value the metric is compared with."""
+        return self.value
+
+    def update(self, state, value, now):
+        """Fold a sample into the state and return whether the rule fires."""
+        if self.window_seconds:
+            if state.window is None:
+                state.window = deque()
+            state.window.append((now, value))
+            state.total += value
+            horizon = now - self.window_seconds
+            while state.window[0][0] < horizon:
+                state.total -= state.window.popleft()[1]
+            value = state.total / len(state.window)
+        state.value = value
+
+        if not OPERATORS[self.op](value, self.value):
+            state.since = None
+            return False
+        if state.since is None:
+            state.since = now
+        return now - state.since >= self.for_seconds
+
+
+@dataclass
+class MissingRule:
+    """
+    Fires when a device has missed `intervals` expected check-ins; the
+    expected interval is learned for every device.
+    """
+    name: str
+    intervals: int = 3
+    severity: str = 'warning'
+    # Not a field: the rule watches no metric of the samples.
+    metric = None
+
+    @property
+    def threshold(self):
+        """The missed check-ins at which the rule fires."""
+        return self.intervals
+
+
+def build_rule(spec):
+    """Create a rule from its configuration dictionary."""
+    spec = dict(spec)
+    rule_type = spec.pop('type', 'threshold')
+    if rule_type == 'missing':
+        return MissingRule(**spec)
+    if rule_type == 'threshold':
+        return ThresholdRule(**spec)
+    raise ValueError(f"Unknown alert rule type '{rule_type}'")
+
+
+@dataclass
+class LogSink:
+    """Write alerts to the server log."""
+    logger_name: str = __name__
+
+    def send(self, alert):
+        """Deliver one alert."""
+        level = logging.WARNING if alert['state'] == 'firing' else logging.INFO
+        logging.getLogger(self.logger_name).log(
+            level, "Alert %(rule)s %(state)s on device %(device_id)s "
+            "(value: %(value)s)", alert)
+
+
+@dataclass
+class WebhookSink:
+    """POST alerts as JSON to a URL."""
+    url: str
+    timeout: float = 5
+
+    def send(self, alert):
+        """Deliver one alert."""
+        req = urllib.request.Request(
+            self.url,
+            data=json.dumps(alert).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        with urllib.request.urlopen(req, timeout=self.timeout):
+            pass
+
+
+@dataclass
+class EmailSink:
+    """
+    Compose alert e-mails into an mbox outbox.
+
+    Stands in for SMTP delivery: a local MTA or a cron job can pick the
+    messages up from the outbox file.
+    """
+    to: str
+    outbox: str = 'alerts.mbox'
+    sender: str = 'rpi-monitor@localhost'
+
+    def send(self, alert):
+        """Deliver one alert."""
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = self.to
+        message['Subject'] = (f"[{alert['severity']}] {alert['rule']} "
+                              f"{alert['state']} on device "
+                              f"{alert['device_id']}")
+        message.set_content(json.dumps(alert, indent=2))
+        box = mailbox.mbox(self.outbox)
+        try:
+            box.lock()
+            box.add(message)
+            box.flush()
+        finally:
+            box.unlock()
+            box.close()
+
+
+SINK_TYPES = {
+    'log': LogSink,
+    'webhook': WebhookSink,
+    'email': EmailSink,
+}
+
+
+def build_sink(spec):
+    """Create a notification sink from its configuration dictionary."""
+    spec = dict(spec)
+    sink_type = spec.pop('type', 'log')
+    if sink_type not in SINK_TYPES:
+        raise ValueError(f"Unknown alert sink type '{sink_type}'")
+    return SINK_TYPES[sink_type](**spec)
+
+
+class Notifier:
+    """Delivers alerts to the sinks from a background thread."""
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread_started = False
+
+    def notify(self, alerts):
+        """Queue alerts for delivery."""
+        if not self._thread_started:
+            self._start_thread()
+        for alert in alerts:
+            self._queue.put(alert)
+
+    def deliver(self, alert):
+        """Send one alert to every sink; failures are logged."""
+        for sink in self.sinks:
+            try:
+                sink.send(alert)
+            except Exception as e:
+                logger.error(f"Alert sink {type(sink).__name__} "
+                             f"failed: {e}")
+
+    def _start_thread(self):
+        # Started lazily so that each gunicorn worker gets its own thread
+        # after the fork instead of inheriting a dead one from the master.
+        with self._lock:
+            if self._thread_started:
+                return
+            self._thread_started = True
+        threading.Thread(target=self._deliver_loop, daemon=True).start()
+
+    def _deliver_loop(self):
+        while True:
+            self.deliver(self._queue.get())
+
+
+class AlertEngine:
+    """
+    Evaluates alert rules against incoming samples.
+
+    Transitions are handed to store(alerts) first, and only the ones it
+    returns are notified; replace it to keep them somewhere.
+    """
+
+    def __init__(self, rules, sinks, clock=time.time):
+        self.clock = clock
+        # Rules by the metric they watch; missing-device rules watch none.
+        self._by_metric = {}
+        for rule in rules:
+            self._by_metric.setdefault(rule.metric, []).append(rule)
+        self._states = {}
+        self._recent = deque(maxlen=RECENT_ALERTS)
+        self._lock = threading.Lock()
+        self.notifier = Notifier(sinks)
+
+    @property
+    def rules(self):
+        """All rules of the engine."""
+        return [rule for rules in self._by_metric.values() for rule in rules]
+
+    @property
+    def missing_rules(self):
+        """The missing-device rules."""
+        return self._by_metric.get(None, [])
+
+    def observe(self, device_id, values, now=None):
+        """Evaluate the rules watching the metrics of one ingested sample."""
+        now = self.clock() if now is None else now
+        transitions = []
+        with self._lock:
+            for rule in self.missing_rules:
+                state = self._states.get((device_id, rule.name))
+                if state is not None and state.firing:
+                    state.firing = False
+                    transitions.append(self._transition(
+                        rule, device_id, state, now))
+
+            for metric, value in values.items():
+                if value is None:
+                    continue
+                for rule in self._by_metric.get(metric, ()):
+                    key = (device_id, rule.name)
+                    state = self._states.get(key)
+                    if state is None:
+                        state = self._states[key] = RuleState()
+                    firing = rule.update(state, value, now)
+                    if firing != state.firing:
+                        state.firing = firing
+                        transitions.append(self._transition(
+                            rule, device_id, state, now))
+        self._dispatch(transitions)
+
+    def on_liveness_event(self, event, now=None):
+        """Fire missing-device rules from a liveness tracker event."""
+        if event['state'] not in ('offline', 'missed'):
+            return
+        now = self.clock() if now is None else now
+        device_id = event['device_id']
+        transitions = []
+        with self._lock:
+            for rule in self.missing_rules:
+                if rule.intervals != event['intervals']:
+                    continue
+                key = (device_id, rule.name)
+                state = self._states.get(key)
+                if state is None:
+                    state = self._states[key] = RuleState()
+                if not state.firing:
+                    state.firing = True
+                    state.value = event['intervals']
+                    transitions.append(self._transition(
+                        rule, device_id, state, now))
+        self._dispatch(transitions)
+
+    def forget_device(self, device_id):
+        """Drop all state kept for a device."""
+        with self._lock:
+            for rule in self.rules:
+                self._states.pop((device_id, rule.name), None)
+
+    def restore(self, firing, recent):
+        """
+        Take over stored alerts: `firing` are the alerts that are firing
+        and `recent` the latest transitions, oldest first. A restored
+        alert keeps firing while its condition holds and resolves with
+        the first sample for which it does not.
+        """
+        rules = {rule.name: rule for rule in self.rules}
+        with self._lock:
+            self._recent.extend(recent)
+            for alert in firing:
+                rule = rules.get(alert['rule'])
+                if rule is None:
+                    continue
+                state = RuleState(firing=True, value=alert['value'],
+                                  alert=alert)
+                self._states[(alert['device_id'], rule.name)] = state
+                if not isinstance(rule, MissingRule):
+                    state.since = (parse_time(alert['timestamp']).timestamp()
+                                   - rule.for_seconds)
+
+    def active_alerts(self):
+        """Return the alerts that are currently firing."""
+        with self._lock:
+            return [state.alert for state in self._states.values()
+                    if state.alert is not None]
+
+    def recent_alerts(self):
+        """Return the most recent alert transitions, newest first."""
+        with self._lock:
+            return list(reversed(self._recent))
+
+    def _transition(self, rule, device_id, state, now):
+        alert = {
+            'rule': rule.name,
+            'device_id': device_id,
+            'state': 'firing' if state.firing else 'resolved',
+            'severity': rule.severity,
+            'metric': rule.metric,
+            'value': state.value,
+            'threshold': rule.threshold,
+            'timestamp': datetime.fromtimestamp(
+                now, tz=timezone.utc).isoformat(),
+        }
+        state.alert = alert if state.firing else None
+        self._recent.append(alert)
+        return alert
+
+    def _dispatch(self, alerts):
+        if alerts:
+            alerts = self.store(alerts)
+        if alerts:
+            self.notify(alerts)
+
+    def store(self, alerts):
+        """Return the transitions to notify: all of them."""
+        return alerts
+
+    def notify(self, alerts):
+        """Hand alerts to the sinks."""
+        self.notifier.notify(alerts)
+
+
+def save_alerts(conn, alerts):
+    """
+    Store alert transitions in alert_state and alert_log and return the
+    ones stored; a transition another process stored first is skipped.
+    """
+    stored = []
+    for alert in alerts:
+        key = (alert['device_id'], alert['rule'])
+        if alert['state'] == 'firing':
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO alert_state (device_id, rule, alert)
+                VALUES (?, ?, ?)
+            ''', key + (json.dumps(alert),))
+        else:
+            cursor = conn.execute(
+                'DELETE FROM alert_state WHERE device_id = ? AND rule = ?',
+                key)
+        if cursor.rowcount == 1:
+            conn.execute('INSERT INTO alert_log (alert) VALUES (?)',
+                         (json.dumps(alert),))
+            stored.append(alert)
+    if stored:
+        conn.execute('''
+            DELETE FROM alert_log
+            WHERE id <= (SELECT MAX(id) FROM alert_log) - ?
+        ''', (RECENT_ALERTS,))
+    return stored
+
+
+def load_alerts(conn):
+    """
+    Return the stored firing alerts and the latest transitions, oldest
+    first.
+    """
+    firing = [json.loads(row[0]) for row in conn.execute(
+        'SELECT alert FROM alert_state ORDER BY device_id, rule')]
+    recent = [json.loads(row[0]) for row in conn.execute(
+        'SELECT alert FROM alert_log ORDER BY id DESC LIMIT ?',
+        (RECENT_ALERTS,))]
+    recent.reverse()
+    return firing, recent
+
+
+def build_engine(alert_config):
+    """Create an AlertEngine from the "alerts" section of the config."""
+    rules = [build_rule(spec)
+             for spec in alert_config.get('rules', DEFAULT_RULES)]
+    sinks = [build_sink(spec)
+             for spec in alert_config.get('sinks', [{'type': 'log'}])]
+    return AlertEngine(rules, sinks)
@@ -0,0 +1,300 @@
+"""
+Raspberry Pi Status Monitor - ASGI entry point
+
+Serves the same routes as the WSGI app behind an event loop, e.g.
+
+    uvicorn asgi:app --uds /tmp/rpi_monitor.sock --workers 2
+
+Connections belong to the event loop, so idle keep-alive connections of
+clients and dashboards cost a socket, not a thread. A request only takes
+a thread from a bounded pool, where the Flask view and all of its SQLite
+work run, while it is being processed; finished responses are written
+back from the loop, so slow readers do not hold a thread either. Streamed
+responses (exports) are written from their thread with backpressure.
+
+/api/devices/stream is served on the loop itself: it sends liveness
+transitions as server-sent events, so an open dashboard holds no thread.
+The transitions are read from the database, where every process stores
+them, by one poller per process however many streams are open.
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from serialization import dumps
+import server
+
+# Threads running Flask views; this bounds concurrent database work.
+EXECUTOR_THREADS = 8
+MAX_BODY = 10 * 1024 * 1024
+EVENTS_PATH = '/api/devices/stream'
+# Idle event streams get a comment this often, so dead peers are noticed
+# and proxies keep the connection open.
+HEARTBEAT_SECONDS = 15
+# How often new transitions are read while any stream is open.
+EVENT_POLL_SECONDS = 1
+
+
+def build_environ(scope, body):
+    """Build the WSGI environ of an ASGI HTTP request."""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        if name != 'CONTENT_TYPE':
+            name = f'HTTP_{name}'
+        if name in environ:
+            value = f'{environ[name]},{value}'
+        environ[name] = value
+    return environ
+
+
+class EventPoller:
+    """Reads new liveness transitions for all open event streams."""
+
+    def __init__(self, events, latest_seq, executor):
+        """
+        events(since) returns the transitions with a sequence number above
+        since and latest_seq() the sequence number of the newest one; both
+        are called in the executor.
+        """
+        self.events = events
+        self.latest_seq = latest_seq
+        self.executor = executor
+        self.streams = set()
+        self._joining = asyncio.Lock()
+        self._task = None
+        self._last_seq = 0
+
+    async def join(self, queue):
+        """Queue every transition stored from now on on `queue`. A new
+        poller starts at the newest stored transition."""
+        async with self._joining:
+            if self._task is None or self._task.done():
+                self._last_seq = await asyncio.get_running_loop(
+                ).run_in_executor(self.executor, self.latest_seq)
+                self._task = asyncio.ensure_future(self._poll())
+            self.streams.add(queue)
+
+    def leave(self, queue):
+        """Stop queueing transitions on `queue`."""
+        self.streams.discard(queue)
+
+    async def _poll(self):
+        """Hand new transitions to every open stream while there are any."""
+        loop = asyncio.get_running_loop()
+        while self.streams:
+            events = await loop.run_in_executor(
+                self.executor, self.events, self._last_seq)
+            for event in events:
+                self._last_seq = event['seq']
+                for queue in list(self.streams):
+                    queue.put_nowait(event)
+            await asyncio.sleep(EVENT_POLL_SECONDS)
+
+
+class AsgiApp:
+    """ASGI application wrapping the Flask app."""
+
+    def __init__(self, wsgi_app, events, latest_seq, startup=None,
+                 threads=EXECUTOR_THREADS):
+        """
+        events(since) returns the liveness transitions to stream with a
+        sequence number above since and latest_seq() the sequence number
+        of the newest one (both are called in a thread); startup() is
+        called when the server starts.
+        """
+        self.wsgi_app = wsgi_app
+        self.startup = startup
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='wsgi')
+        self.poller = EventPoller(events, latest_seq, self.executor)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['path'] == EVENTS_PATH and scope['method'] == 'GET':
+                await self.event_stream(scope, receive, send)
+            else:
+                await self.call_wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """Run startup hooks and shut the thread pool down on exit."""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.startup is not None:
+                    await asyncio.get_running_loop().run_in_executor(
+                        self.executor, self.startup)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def read_body(receive):
+        """Read the request body; returns None if the client went away
+        or the body is larger than MAX_BODY."""
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > MAX_BODY:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def call_wsgi(self, scope, receive, send):
+        """Run a request through the Flask app in the thread pool."""
+        body = await self.read_body(receive)
+        if body is None:
+            await send({'type': 'http.response.start', 'status': 413,
+                        'headers': [(b'content-length', b'0')]})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(
+            self.executor, self._run_wsgi, build_environ(scope, body), loop,
+            send)
+        if response is not None:
+            status, headers, content = response
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': headers})
+            await send({'type': 'http.response.body', 'body': content})
+
+    def _run_wsgi(self, environ, loop, send):
+        """
+        Call the Flask app. Responses with a known length are returned as
+        (status, headers, body) for the loop to send; streamed ones are
+        sent from this thread, chunk by chunk.
+        """
+        started = []
+
+        def start_response(status, headers, _exc_info=None):
+            started[:] = [status, headers]
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            iterator = iter(result)
+            first = next(iterator, b'')
+            status = int(started[0].split(' ', 1)[0])
+            headers = [(name.lower().encode('latin1'), value.encode('latin1'))
+                       for name, value in started[1]]
+            if any(name == b'content-length' for name, _ in headers):
+                return status, headers, first + b''.join(iterator)
+
+            def call(message):
+                asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+            call({'type': 'http.response.start', 'status': status,
+                  'headers': headers})
+            chunk = first
+            while True:
+                if chunk:
+                    call({'type': 'http.response.body', 'body': chunk,
+                          'more_body': True})
+                chunk = next(iterator, None)
+                if chunk is None:
+                    break
+            call({'type': 'http.response.body', 'body': b''})
+            return None
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    async def event_stream(self, scope, receive, send):
+        """Stream liveness transitions as server-sent events."""
+        loop = asyncio.get_running_loop()
+        since = 0
+        headers = dict(scope.get('headers', ()))
+        query = dict(part.split('=', 1) for part in
+                     scope.get('query_string', b'').decode().split('&')
+                     if '=' in part)
+        try:
+            since = int(headers.get(b'last-event-id', b'')
+                        or query.get('since', 0))
+        except ValueError:
+            pass
+
+        # Joining before reading the backlog: what the poller reads from
+        # now on is queued, what it read before is part of the backlog.
+        queue = asyncio.Queue()
+        await self.poller.join(queue)
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        try:
+            for event in await loop.run_in_executor(
+                    self.executor, self.poller.events, since):
+                since = event['seq']
+                await send(self._event_message(event))
+            while not disconnected.done():
+                getter = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait(
+                    (getter, disconnected), timeout=HEARTBEAT_SECONDS,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    event = getter.result()
+                    if event['seq'] > since:
+                        since = event['seq']
+                        await send(self._event_message(event))
+                    continue
+                getter.cancel()
+                if not done:
+                    await send({'type': 'http.response.body',
+                                'body': b': ping\n\n', 'more_body': True})
+        finally:
+            self.poller.leave(queue)
+            disconnected.cancel()
+
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    @staticmethod
+    def _event_message(event):
+        body = (b'id: ' + str(event['seq']).encode() + b'\nevent: liveness\n'
+                b'data: ' + dumps(event) + b'\n\n')
+        return {'type': 'http.response.body', 'body': body, 'more_body': True}
+
+
+def on_startup():
+    """Start the ingest listeners and the archive compactor."""
+    server.ingest_listeners.start()
+    server.start_compactor()
+
+
+app = AsgiApp(server.app, server.event_store.device_events,
+              server.event_store.latest_device_event, on_startup)
@@ -18,9 +18,10 @@ except Exception as e:
 
 try:
     rows = c.execute(
-        '''SELECT id, stats_id, interface_name
-        FROM network_stats
-        ORDER BY id DESC
+        '''SELECT ns.stats_id, i.name
+        FROM network_stats ns
+        JOIN interfaces i ON i.id = ns.interface_id
+        ORDER BY ns.stats_id DESC
         LIMIT 3'''
     ).fetchall()
     print('Recent network rows:', rows)
@@ -1,22 +1,33 @@
 """Script to create the necessary database tables
 for system stats monitoring."""
+import argparse
 import sqlite3
 import os
 
-DB_PATH = os.path.join(
+from sharding import first_device_id
+
+DB_PATH = os.environ.get('RPI_MONITOR_DB', os.path.join(
     os.path.dirname(os.path.abspath(__file__)),
     'system_stats.db'
-)
+))
+
+
+def get_columns(c, table):
+    """Return the column names of a table (empty if it does not exist)."""
+    c.execute(f"PRAGMA table_info({table})")
+    return [column[1] for column in c.fetchall()]
 
 
-def create_tables(conn=None):
+def create_tables(conn=None, shard_index=None, db_path=None):
     """
     Creates the necessary database tables if they don't exist.
     Can be passed an existing connection or will create a new one.
+    With a shard index, device ids of a new database are allocated from
+    that shard's id range.
     """
     should_close = False
     if conn is None:
-        conn = sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(db_path or DB_PATH)
         should_close = True
 
     c = conn.cursor()
@@ -27,7 +38,25 @@ def create_tables(conn=None):
                  device_name TEXT,
                  hostname TEXT,
                  ip_address TEXT,
-                 last_seen DATETIME
+                 last_seen DATETIME,
+                 memory_total REAL,
+                 disk_total REAL,
+                 report_interval REAL,
+                 stream_epoch TEXT,
+                 stream_seq INTEGER NOT NULL DEFAULT 0,
+                 udp_seq INTEGER NOT NULL DEFAULT 0
+                 )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS interfaces (
+                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 device_id INTEGER NOT NULL,
+                 name TEXT NOT NULL,
+                 speed INTEGER,
+                 mtu INTEGER,
+                 is_up BOOLEAN,
+                 addresses TEXT,
+                 first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+                 FOREIGN KEY (device_id) REFERENCES devices (id)
                  )''')
 
     c.execute('''CREATE TABLE IF NOT EXISTS stats (
@@ -35,46 +64,277 @@ def create_tables(conn=None):
                  device_id INTEGER,
                  timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                  cpu_usage REAL,
-                 cpu_frequency TEXT,
+                 cpu_frequency REAL,
                  memory_used REAL,
-                 memory_total REAL,
                  memory_percentage REAL,
                  disk_used REAL,
-                 disk_total REAL,
                  disk_percentage REAL,
                  temperature REAL,
                  uptime REAL,
                  throttled TEXT,
                  voltages TEXT,
+                 amperage REAL,
                  FOREIGN KEY (device_id) REFERENCES devices (id)
                  )''')
 
     c.execute('''CREATE TABLE IF NOT EXISTS network_stats (
-                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                 stats_id INTEGER,
-                 interface_name TEXT,
+                 stats_id INTEGER NOT NULL,
+                 interface_id INTEGER NOT NULL,
                  bytes_sent INTEGER,
                  bytes_recv INTEGER,
                  packets_sent INTEGER,
                  packets_recv INTEGER,
-                 speed INTEGER,
-                 mtu INTEGER,
-                 is_up BOOLEAN,
-                 addresses TEXT,
+                 PRIMARY KEY (stats_id, interface_id),
+                 FOREIGN KEY (stats_id) REFERENCES stats (id),
+                 FOREIGN KEY (interface_id) REFERENCES interfaces (id)
+                 ) WITHOUT ROWID''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS client_stats (
+                 stats_id INTEGER PRIMARY KEY,
+                 cpu_percent REAL,
+                 cpu_seconds REAL,
+                 rss_mb REAL,
+                 collect_ms REAL,
+                 send_ms REAL,
+                 probe_ms TEXT,
                  FOREIGN KEY (stats_id) REFERENCES stats (id)
+                 ) WITHOUT ROWID''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS process_names (
+                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 name TEXT UNIQUE NOT NULL
                  )''')
 
-    c.execute("PRAGMA table_info(stats)")
-    columns = [column[1] for column in c.fetchall()]
-    if 'amperage' not in columns:
-        c.execute("ALTER TABLE stats ADD COLUMN amperage REAL")
+    c.execute('''CREATE TABLE IF NOT EXISTS process_stats (
+                 stats_id INTEGER NOT NULL,
+                 pid INTEGER NOT NULL,
+                 name_id INTEGER NOT NULL,
+                 cpu_percent REAL,
+                 rss_mb REAL,
+                 PRIMARY KEY (stats_id, pid),
+                 FOREIGN KEY (stats_id) REFERENCES stats (id),
+                 FOREIGN KEY (name_id) REFERENCES process_names (id)
+                 ) WITHOUT ROWID''')
+
+    # Block devices and mount points of all devices, stored once.
+    c.execute('''CREATE TABLE IF NOT EXISTS disk_names (
+                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 name TEXT UNIQUE NOT NULL
+                 )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS disk_stats (
+                 stats_id INTEGER NOT NULL,
+                 disk_id INTEGER NOT NULL,
+                 read_bps INTEGER,
+                 write_bps INTEGER,
+                 read_iops REAL,
+                 write_iops REAL,
+                 busy_percent REAL,
+                 PRIMARY KEY (stats_id, disk_id),
+                 FOREIGN KEY (stats_id) REFERENCES stats (id),
+                 FOREIGN KEY (disk_id) REFERENCES disk_names (id)
+                 ) WITHOUT ROWID''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS mount_stats (
+                 stats_id INTEGER NOT NULL,
+                 mount_id INTEGER NOT NULL,
+                 total REAL,
+                 used REAL,
+                 percentage REAL,
+                 PRIMARY KEY (stats_id, mount_id),
+                 FOREIGN KEY (stats_id) REFERENCES stats (id),
+                 FOREIGN KEY (mount_id) REFERENCES disk_names (id)
+                 ) WITHOUT ROWID''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS metric_sketches (
+                 device_id INTEGER NOT NULL,
+                 metric TEXT NOT NULL,
+                 bucket_start INTEGER NOT NULL,
+                 sketch TEXT NOT NULL,
+                 PRIMARY KEY (device_id, metric, bucket_start),
+                 FOREIGN KEY (device_id) REFERENCES devices (id)
+                 ) WITHOUT ROWID''')
+
+    # Samples older than a day, moved out of `stats` by the compactor
+    # (tsblock.py): one compressed block per device and hour.
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_blocks (
+                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 device_id INTEGER NOT NULL,
+                 block_start INTEGER NOT NULL,
+                 block_end INTEGER NOT NULL,
+                 first_id INTEGER NOT NULL,
+                 last_id INTEGER NOT NULL,
+                 samples INTEGER NOT NULL,
+                 payload BLOB NOT NULL,
+                 UNIQUE (device_id, block_start),
+                 FOREIGN KEY (device_id) REFERENCES devices (id)
+                 )''')
+
+    # Bumped whenever a devices row changes (other than last_seen), so
+    # every worker knows when to reload its device registry.
+    c.execute('''CREATE TABLE IF NOT EXISTS registry_state (
+                 id INTEGER PRIMARY KEY CHECK (id = 1),
+                 generation INTEGER NOT NULL
+                 )''')
+    c.execute('''INSERT OR IGNORE INTO registry_state (id, generation)
+                 VALUES (1, 0)''')
+
+    # Firing alerts, shared by the server processes.
+    c.execute('''CREATE TABLE IF NOT EXISTS alert_state (
+                 device_id INTEGER NOT NULL,
+                 rule TEXT NOT NULL,
+                 alert TEXT NOT NULL,
+                 PRIMARY KEY (device_id, rule)
+                 ) WITHOUT ROWID''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS alert_log (
+                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 alert TEXT NOT NULL
+                 )''')
+
+    # Online/offline transitions; the id is the event's sequence number.
+    c.execute('''CREATE TABLE IF NOT EXISTS device_events (
+                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 device_id INTEGER NOT NULL,
+                 state TEXT NOT NULL,
+                 timestamp TEXT NOT NULL,
+                 intervals INTEGER
+                 )''')
+
+    for column, definition in (
+            ('memory_total', 'REAL'),
+            ('disk_total', 'REAL'),
+            ('report_interval', 'REAL'),
+            ('stream_epoch', 'TEXT'),
+            ('stream_seq', 'INTEGER NOT NULL DEFAULT 0'),
+            ('udp_seq', 'INTEGER NOT NULL DEFAULT 0')):
+        if column not in get_columns(c, 'devices'):
+            c.execute(f"ALTER TABLE devices ADD COLUMN {column} {definition}")
+
+    migrated = False
+    if 'memory_total' in get_columns(c, 'stats'):
+        migrate_legacy_schema(c)
+        migrated = True
+
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_stats_device_timestamp
+                 ON stats (device_id, timestamp)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_interfaces_device_name
+                 ON interfaces (device_id, name)''')
+
+    if shard_index:
+        c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'devices'")
+        if c.fetchone() is None:
+            c.execute(
+                "INSERT INTO sqlite_sequence (name, seq) VALUES ('devices', ?)",
+                (first_device_id(shard_index),)
+            )
 
     conn.commit()
 
+    if migrated:
+        # Give the pages freed by the narrower rows back to the filesystem.
+        conn.execute("VACUUM")
+
     if should_close:
         conn.close()
-        print("Created/verified tables in system_stats.db")
+        print(f"Created/verified tables in {db_path or DB_PATH}")
+
+
+def migrate_legacy_schema(c):
+    """
+    Move a pre-normalization database to the current schema.
+
+    Static values that used to be repeated in every sample row are moved
+    out: memory/disk totals go to `devices`, interface metadata goes to
+    versioned rows in `interfaces`, and the textual CPU frequency
+    ("1500.00 MHz") becomes a number of MHz.
+    """
+    if 'amperage' not in get_columns(c, 'stats'):
+        c.execute("ALTER TABLE stats ADD COLUMN amperage REAL")
+
+    c.execute('''UPDATE devices
+                 SET memory_total = (SELECT s.memory_total FROM stats s
+                                     WHERE s.device_id = devices.id
+                                     ORDER BY s.id DESC LIMIT 1),
+                     disk_total = (SELECT s.disk_total FROM stats s
+                                   WHERE s.device_id = devices.id
+                                   ORDER BY s.id DESC LIMIT 1)''')
+
+    if 'interface_name' in get_columns(c, 'network_stats'):
+        # Every distinct metadata combination becomes one interface
+        # version, in the order it was first reported.
+        c.execute('''INSERT INTO interfaces
+                     (device_id, name, speed, mtu, is_up, addresses,
+                      first_seen)
+                     SELECT s.device_id, ns.interface_name, ns.speed, ns.mtu,
+                            ns.is_up, ns.addresses, MIN(s.timestamp)
+                     FROM network_stats ns
+                     JOIN stats s ON s.id = ns.stats_id
+                     GROUP BY s.device_id, ns.interface_name, ns.speed,
+                              ns.mtu, ns.is_up, ns.addresses
+                     ORDER BY MIN(ns.id)''')
+
+        c.execute('''CREATE TABLE network_stats_new (
+                     stats_id INTEGER NOT NULL,
+                     interface_id INTEGER NOT NULL,
+                     bytes_sent INTEGER,
+                     bytes_recv INTEGER,
+                     packets_sent INTEGER,
+                     packets_recv INTEGER,
+                     PRIMARY KEY (stats_id, interface_id),
+                     FOREIGN KEY (stats_id) REFERENCES stats (id),
+                     FOREIGN KEY (interface_id) REFERENCES interfaces (id)
+                     ) WITHOUT ROWID''')
+        c.execute('''INSERT OR IGNORE INTO network_stats_new
+                     SELECT ns.stats_id, i.id, ns.bytes_sent, ns.bytes_recv,
+                            ns.packets_sent, ns.packets_recv
+                     FROM network_stats ns
+                     JOIN stats s ON s.id = ns.stats_id
+                     JOIN interfaces i
+                       ON i.device_id = s.device_id
+                      AND i.name = ns.interface_name
+                      AND i.speed IS ns.speed
+                      AND i.mtu IS ns.mtu
+                      AND i.is_up IS ns.is_up
+                      AND i.addresses IS ns.addresses''')
+        c.execute("DROP TABLE network_stats")
+        c.execute("ALTER TABLE network_stats_new RENAME TO network_stats")
+
+    c.execute('''CREATE TABLE stats_new (
+                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 device_id INTEGER,
+                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                 cpu_usage REAL,
+                 cpu_frequency REAL,
+                 memory_used REAL,
+                 memory_percentage REAL,
+                 disk_used REAL,
+                 disk_percentage REAL,
+                 temperature REAL,
+                 uptime REAL,
+                 throttled TEXT,
+                 voltages TEXT,
+                 amperage REAL,
+                 FOREIGN KEY (device_id) REFERENCES devices (id)
+                 )''')
+    c.execute('''INSERT INTO stats_new
+                 SELECT id, device_id, timestamp, cpu_usage,
+                        CASE WHEN cpu_frequency GLOB '[0-9]*'
+                             THEN CAST(cpu_frequency AS REAL) END,
+                        memory_used, memory_percentage, disk_used,
+                        disk_percentage, temperature, uptime, throttled,
+                        voltages, amperage
+                 FROM stats''')
+    c.execute("DROP TABLE stats")
+    c.execute("ALTER TABLE stats_new RENAME TO stats")
 
 
 if __name__ == '__main__':
-    create_tables()
+    parser = argparse.ArgumentParser(
+        description='Create or migrate the server database.'
+    )
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--shard', type=int, default=None,
+                        help='shard index when running as a cluster node')
+    args = parser.parse_args()
+    create_tables(shard_index=args.shard, db_path=args.db)
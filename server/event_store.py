@@ -0,0 +1,103 @@
+"""
+Alert and liveness transitions shared by the server processes.
+
+Every process evaluates alert rules and tracks liveness for the samples
+it ingests. Their transitions are stored in alert_state and alert_log and
+in device_events, skipping the ones another process stored first, so
+each is notified once and every process serves the same ones.
+"""
+import logging
+import sqlite3
+
+from flask import jsonify, request
+
+from alerts import load_alerts, save_alerts
+from liveness import last_event_seq, load_events, save_events
+
+logger = logging.getLogger(__name__)
+
+
+class EventStore:
+    """
+    Stores and serves the transitions of a server process; connect()
+    returns a new database connection.
+    """
+
+    def __init__(self, connect):
+        self.connect = connect
+
+    def attach(self, engine, tracker):
+        """Store the transitions of an alert engine and a liveness tracker,
+        whose deadlines also drive the engine's missing-device rules."""
+        engine.store = self.store_alerts
+        tracker.subscribe(engine.on_liveness_event)
+        tracker.subscribe(self.store_device_event)
+        for rule in engine.missing_rules:
+            tracker.watch(rule.intervals)
+
+    def init_app(self, app):
+        """Register the views on a Flask app."""
+        app.add_url_rule('/api/alerts', 'api_alerts', self.api_alerts)
+        app.add_url_rule('/api/devices/events', 'get_devices_events',
+                         self.api_device_events)
+
+    def store_alerts(self, alerts):
+        """Store alert transitions and return the ones to notify."""
+        conn = self.connect()
+        try:
+            stored = save_alerts(conn, alerts)
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to store alerts: {e}")
+            return []
+        finally:
+            conn.close()
+        return stored
+
+    def store_device_event(self, event):
+        """Store an online/offline transition of the liveness tracker."""
+        # Missed-level notifications only feed the missing-device rules.
+        if event['state'] == 'missed':
+            return
+        conn = self.connect()
+        try:
+            save_events(conn, [event])
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to store a device event: {e}")
+        finally:
+            conn.close()
+
+    def device_events(self, since=0):
+        """
+        Return the stored online/offline transitions after the `since`
+        sequence number.
+        """
+        conn = self.connect()
+        try:
+            return load_events(conn, since)
+        finally:
+            conn.close()
+
+    def latest_device_event(self):
+        """Return the sequence number of the newest stored transition."""
+        conn = self.connect()
+        try:
+            return last_event_seq(conn)
+        finally:
+            conn.close()
+
+    def api_alerts(self):
+        """Return the currently firing alerts and the latest transitions."""
+        conn = self.connect()
+        try:
+            firing, recent = load_alerts(conn)
+        finally:
+            conn.close()
+        return jsonify({'active': firing, 'recent': recent[::-1]})
+
+    def api_device_events(self):
+        """Return online/offline transitions after the `since` sequence
+        number."""
+        since = request.args.get('since', 0, type=int)
+        return jsonify(self.device_events(since))
@@ -0,0 +1,281 @@
+"""
+Streaming export of historical metrics.
+
+Rows are read from SQLite in fixed-size batches and encoded one batch at a
+time, so memory use does not depend on the size of the requested range.
+Used by the /api/export endpoint and runnable as a command line tool:
+
+    python export.py --format csv --device 1 --start 2024-01-01 > out.csv
+"""
+import argparse
+import contextlib
+import csv
+import heapq
+import io
+import itertools
+import json
+import os
+import sqlite3
+import sys
+from operator import itemgetter
+
+from timeutils import parse_time, to_db_timestamp
+from tsblock import archived_rows
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+DB_PATH = os.environ.get('RPI_MONITOR_DB', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'system_stats.db'
+))
+
+BATCH_SIZE = 1000
+
+EXPORT_COLUMNS = [
+    'id', 'device_id', 'timestamp', 'cpu_usage', 'cpu_frequency',
+    'memory_used', 'memory_percentage', 'disk_used', 'disk_percentage',
+    'temperature', 'uptime', 'throttled', 'voltages', 'amperage'
+]
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+
+class ExportError(Exception):
+    """Raised when an export cannot be produced with the given options."""
+
+
+def iter_stats_batches(conn, device_id=None, start=None, end=None,
+                       batch_size=BATCH_SIZE):
+    """
+    Yield lists of stats rows (tuples in EXPORT_COLUMNS order).
+
+    A single device is read in timestamp order through the
+    (device_id, timestamp) index; a fleet export walks the table in rowid
+    order, which follows insertion time without needing a sort. Archived
+    samples are decoded block by block and merged in.
+    """
+    conditions = []
+    params = []
+    if device_id is not None:
+        conditions.append('device_id = ?')
+        params.append(device_id)
+    if start is not None:
+        conditions.append('timestamp >= ?')
+        params.append(to_db_timestamp(start))
+    if end is not None:
+        conditions.append('timestamp < ?')
+        params.append(to_db_timestamp(end))
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    order = 'timestamp, id' if device_id is not None else 'id'
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(
+        f"SELECT {', '.join(EXPORT_COLUMNS)} FROM stats {where} "
+        f"ORDER BY {order}",
+        params
+    )
+
+    def live_rows():
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+    # Stored timestamps have whole seconds, so the bounds are rounded the
+    # same way as in the SQL conditions above.
+    archived = archived_rows(
+        conn, EXPORT_COLUMNS,
+        [device_id] if device_id is not None else None,
+        int(start.timestamp()) if start is not None else None,
+        int(end.timestamp()) if end is not None else None
+    )
+    key = itemgetter(2, 0) if device_id is not None else itemgetter(0)
+    rows = heapq.merge(archived, live_rows(), key=key)
+    try:
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            yield batch
+    finally:
+        cursor.close()
+
+
+def encode_csv(batches):
+    """Encode row batches as CSV with a header line."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def encode_ndjson(batches):
+    """Encode row batches as newline-delimited JSON objects."""
+    for rows in batches:
+        yield ''.join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows
+        ).encode('utf-8')
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that hands written bytes back in chunks."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        data = bytes(b)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        """Return and forget everything written since the last drain."""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _arrow_schema():
+    """Return the Arrow schema of exported rows."""
+    return pa.schema([
+        ('id', pa.int64()),
+        ('device_id', pa.int64()),
+        ('timestamp', pa.string()),
+        ('cpu_usage', pa.float64()),
+        ('cpu_frequency', pa.float64()),
+        ('memory_used', pa.float64()),
+        ('memory_percentage', pa.float64()),
+        ('disk_used', pa.float64()),
+        ('disk_percentage', pa.float64()),
+        ('temperature', pa.float64()),
+        ('uptime', pa.float64()),
+        ('throttled', pa.string()),
+        ('voltages', pa.string()),
+        ('amperage', pa.float64()),
+    ])
+
+
+def _record_batch(schema, rows):
+    columns = list(zip(*rows))
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type)
+         for column, field in zip(columns, schema)],
+        schema=schema
+    )
+
+
+def encode_parquet(batches):
+    """Encode row batches as a Parquet file, one row group per batch."""
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    try:
+        for rows in batches:
+            writer.write_batch(_record_batch(schema, rows))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def encode_arrow(batches):
+    """Encode row batches as an Arrow IPC stream."""
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    writer = pa.ipc.new_stream(sink, schema)
+    try:
+        for rows in batches:
+            writer.write_batch(_record_batch(schema, rows))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+ENCODERS = {
+    'csv': encode_csv,
+    'ndjson': encode_ndjson,
+    'parquet': encode_parquet,
+    'arrow': encode_arrow,
+}
+
+
+def check_format(fmt):
+    """Raise ExportError unless the format can be produced here."""
+    if fmt not in ENCODERS:
+        raise ExportError(
+            f"Unknown format '{fmt}', expected one of {', '.join(ENCODERS)}"
+        )
+    if fmt in ('parquet', 'arrow') and pa is None:
+        raise ExportError(
+            'Parquet and Arrow exports require the pyarrow package'
+        )
+
+
+def export_stats(conn, fmt, device_id=None, start=None, end=None):
+    """Yield the encoded bytes of an export in the requested format."""
+    check_format(fmt)
+    return ENCODERS[fmt](iter_stats_batches(conn, device_id, start, end))
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description='Export historical metrics from the server database.'
+    )
+    parser.add_argument('--format', default='csv', choices=list(ENCODERS))
+    parser.add_argument('--device', type=int, default=None,
+                        help='device id (default: the whole fleet)')
+    parser.add_argument('--start', default=None,
+                        help='ISO-8601 time or epoch seconds (inclusive)')
+    parser.add_argument('--end', default=None,
+                        help='ISO-8601 time or epoch seconds (exclusive)')
+    parser.add_argument('--output', default='-',
+                        help='output file (default: stdout)')
+    parser.add_argument('--db', default=DB_PATH)
+    args = parser.parse_args()
+
+    try:
+        start = parse_time(args.start)
+        end = parse_time(args.end)
+        check_format(args.format)
+    except (ValueError, ExportError) as e:
+        parser.error(str(e))
+
+    with contextlib.ExitStack() as stack:
+        conn = sqlite3.connect(args.db)
+        stack.callback(conn.close)
+        out = (sys.stdout.buffer if args.output == '-'
+               else stack.enter_context(open(args.output, 'wb')))
+        for chunk in export_stats(conn, args.format, args.device, start, end):
+            out.write(chunk)
+
+
+if __name__ == '__main__':
+    main()
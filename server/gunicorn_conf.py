@@ -1,4 +1,6 @@
 """Gunicorn configuration file for RPi Monitor Server"""
+import importlib
+
 bind = "unix:/tmp/rpi_monitor.sock"
 umask = 0o007
 workers = 2
@@ -15,3 +17,13 @@ capture_output = True
 accesslog = "/var/log/rpi-monitor-server.access"
 errorlog = "/var/log/rpi-monitor-server.error"
 loglevel = "info"
+
+
+def post_fork(_arbiter, _worker):
+    """Start the optional UDP and stream ingest listeners and the archive
+    compactor in every worker."""
+    # The app is imported by the master (preload_app); this only looks it
+    # up, after the fork, so that the threads are started in the worker.
+    server = importlib.import_module('server')
+    server.ingest_listeners.start()
+    server.start_compactor()
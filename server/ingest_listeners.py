@@ -0,0 +1,129 @@
+"""
+The UDP and stream ingest transports of a server process.
+
+Each listener is only created with a "secret" in its section ("udp",
+"stream") of the config. Their samples take the storage path of the HTTP
+API; every transport keeps its sequence numbers in a column of its own.
+"""
+import functools
+import os
+
+from flask import jsonify
+
+from stream_ingest import ProtocolError, StreamListener
+from udp_ingest import UdpListener, device_key
+
+
+class IngestListeners:
+    """
+    The optional UDP and stream listeners of a server process.
+
+    ingest(device_id, metrics, report_interval, sequence, sequence_column)
+    stores a sample and returns a JSON-ready body and an HTTP status;
+    connect() returns a new database connection.
+    """
+
+    def __init__(self, config, server_version, ingest, connect):
+        self.server_version = server_version
+        self.ingest = ingest
+        self.connect = connect
+        udp_config = config.get('udp', {})
+        stream_config = config.get('stream', {})
+        # The shards of a cluster share the config but not the ports, so
+        # that the kernel never hands a device's datagrams or connections
+        # to another shard.
+        self.udp = (
+            UdpListener(udp_config['secret'], self.ingest_datagram,
+                        udp_config.get('host', '0.0.0.0'),
+                        int(os.environ.get('RPI_MONITOR_UDP_PORT',
+                                           udp_config.get('port', 5001))))
+            if udp_config.get('secret') else None
+        )
+        self.stream = (
+            StreamListener(self.open_stream, self.ingest_stream_sample,
+                           functools.partial(device_key,
+                                             stream_config['secret']),
+                           stream_config.get('host', '0.0.0.0'),
+                           int(os.environ.get(
+                               'RPI_MONITOR_STREAM_PORT',
+                               stream_config.get('port', 5002))))
+            if stream_config.get('secret') else None
+        )
+
+    def init_app(self, app):
+        """Register the listener counters on a Flask app."""
+        app.add_url_rule('/api/stream/stats', 'api_stream_stats',
+                         self.api_stream_stats)
+        app.add_url_rule('/api/udp/stats', 'api_udp_stats',
+                         self.api_udp_stats)
+
+    def start(self):
+        """Start the listeners that are configured."""
+        if self.udp is not None:
+            self.udp.start()
+        if self.stream is not None:
+            self.stream.start()
+
+    def device_settings(self, device_id):
+        """Return the ports and keys a device sends with."""
+        settings = {}
+        if self.udp is not None:
+            settings['udp_port'] = self.udp.address[1]
+            settings['udp_key'] = device_key(self.udp.secret, device_id).hex()
+        if self.stream is not None:
+            settings['stream_port'] = self.stream.address[1]
+            settings['stream_key'] = self.stream.key_for(device_id).hex()
+        return settings
+
+    def ingest_datagram(self, device_id, sequence, client_version,
+                        report_interval, metrics):
+        """Store a sample received by the UDP listener."""
+        if client_version != self.server_version:
+            return 426
+        return self.ingest(device_id, metrics, report_interval, sequence,
+                           'udp_seq')[1]
+
+    def open_stream(self, device_id, client_version, epoch):
+        """
+        Accept a stream connection and return the last sequence number
+        stored for the device. A new epoch (the client was restarted)
+        starts the sequence over.
+        """
+        if client_version != self.server_version:
+            raise ProtocolError('Client version mismatch')
+        conn = self.connect()
+        try:
+            device = conn.execute(
+                'SELECT stream_epoch, stream_seq FROM devices WHERE id = ?',
+                (device_id,)
+            ).fetchone()
+            if device is None:
+                raise ProtocolError('Device not registered')
+            if device['stream_epoch'] == epoch:
+                return device['stream_seq']
+            conn.execute('''
+                UPDATE devices SET stream_epoch = ?, stream_seq = 0
+                WHERE id = ?
+            ''', (epoch, device_id))
+            conn.commit()
+            return 0
+        finally:
+            conn.close()
+
+    def ingest_stream_sample(self, device_id, sequence, report_interval,
+                             metrics):
+        """Store a sample received on a stream connection."""
+        return self.ingest(device_id, metrics, report_interval, sequence,
+                           'stream_seq')
+
+    def api_stream_stats(self):
+        """Return the stream listener counters of the worker answering."""
+        if self.stream is None:
+            return jsonify({'error': 'Stream ingest is not enabled'}), 404
+        return jsonify(self.stream.stats())
+
+    def api_udp_stats(self):
+        """Return the UDP listener counters of the worker answering."""
+        if self.udp is None:
+            return jsonify({'error': 'UDP ingest is not enabled'}), 404
+        return jsonify(self.udp.stats())
@@ -92,6 +92,12 @@ fi
 echo "Initializing database..."
 (cd "$INSTALL_DIR" && venv/bin/python create_tables.py)
 
+echo "Building dashboard assets..."
+if ! (cd "$INSTALL_DIR" && venv/bin/python static_assets.py); then
+    echo "Error: Building the dashboard assets failed."
+    exit 1
+fi
+
 WEBSERVER=""
 
 if command_exists lighttpd; then
@@ -147,6 +153,8 @@ if [ "$WEBSERVER" = "lighttpd" ]; then
     LIGHTTPD_CONFIG_DEST="/etc/lighttpd/conf-available/10-rpi_monitor.conf"
     
     cp "$LIGHTTPD_CONFIG_SRC" "$LIGHTTPD_CONFIG_DEST"
+    mkdir -p /var/cache/lighttpd/compress
+    chown www-data:www-data /var/cache/lighttpd/compress 2>/dev/null
     ln -sfn "$LIGHTTPD_CONFIG_DEST" "/etc/lighttpd/conf-enabled/10-rpi_monitor.conf"
     
     lighty-enable-mod proxy
@@ -0,0 +1,320 @@
+"""
+Offline-device detection driven by check-in deadlines.
+
+Every device has an expected report interval, learned from the intervals
+it reports at (or announced by the client). Each check-in pushes the time
+by which the next one is due onto a min-heap, so finding devices that
+missed their deadline costs O(log n) per expired entry instead of a scan
+over all devices. Superseded entries are skipped lazily by generation.
+
+Transitions between online and offline are published to subscribers.
+Every worker tracks liveness for the status it reports and stores its
+transitions in device_events unless another worker already stored the
+same one; the events API and the event stream read them from there, so
+their sequence numbers are the same in every process.
+"""
+import heapq
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+DEFAULT_INTERVAL = 10
+GRACE_INTERVALS = 3
+MAX_EVENTS = 1000
+
+# Inter-arrival times further than this factor from the current estimate
+# (cache replays after an outage, the outage itself) do not move it, unless
+# several consecutive ones show the device really reports that slowly.
+INTERVAL_TOLERANCE = 4
+INTERVAL_SMOOTHING = 0.2
+SLOW_OUTLIERS_TO_ADOPT = 3
+
+
+@dataclass
+class DeviceLiveness:
+    """Liveness bookkeeping for one device."""
+    last_seen: float
+    interval: float
+    online: bool
+    announced: bool = False
+    generation: int = 0
+    slow_outliers: int = 0
+
+    def learn_interval(self, delta):
+        """Fold the time since the previous check-in into the interval."""
+        if delta > self.interval * INTERVAL_TOLERANCE:
+            self.slow_outliers += 1
+            if self.slow_outliers >= SLOW_OUTLIERS_TO_ADOPT:
+                self.interval = delta
+                self.slow_outliers = 0
+            return
+        self.slow_outliers = 0
+        if delta >= self.interval / INTERVAL_TOLERANCE:
+            self.interval += INTERVAL_SMOOTHING * (delta - self.interval)
+
+
+class Deadlines:
+    """
+    Check-in deadlines on a min-heap, one entry per device and watched
+    level of missed check-ins, and the thread that waits for them.
+
+    Callers hold `lock` around everything but start().
+    """
+
+    def __init__(self, grace_intervals, clock):
+        self.grace_intervals = grace_intervals
+        self.levels = (grace_intervals,)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self._wakeup = threading.Condition(self.lock)
+        self._heap = []
+        self._thread = None
+
+    def watch(self, intervals):
+        """Also schedule a deadline after `intervals` missed check-ins."""
+        self.levels = tuple(sorted(set(self.levels) | {intervals}))
+
+    def schedule(self, device_id, entry):
+        """Replace the deadlines of a device after a check-in."""
+        entry.generation += 1
+        for level in self.levels:
+            heapq.heappush(self._heap, (
+                entry.last_seen + entry.interval * level,
+                device_id, entry.generation, level
+            ))
+        self._wakeup.notify()
+
+    def expired(self, now):
+        """Remove and return the (device_id, generation, level) entries
+        whose deadline has passed."""
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            _, device_id, generation, level = heapq.heappop(self._heap)
+            expired.append((device_id, generation, level))
+        return expired
+
+    def next(self):
+        """Return the earliest pending deadline, or None."""
+        return self._heap[0][0] if self._heap else None
+
+    def start(self, expire):
+        """Start a thread that calls expire() whenever a deadline passes."""
+        with self.lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, args=(expire,),
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self, expire):
+        while True:
+            with self.lock:
+                timeout = (self._heap[0][0] - self.clock()
+                           if self._heap else None)
+                if timeout is None or timeout > 0:
+                    self._wakeup.wait(timeout)
+            expire()
+
+
+class LivenessTracker:
+    """
+    Tracks when each device is next expected to check in.
+
+    `verify(device_id)` may return the device's last check-in time as
+    recorded elsewhere (another server process); an expired deadline is
+    then re-armed instead of marking a device offline that is reporting
+    through a different worker.
+    """
+
+    def __init__(self, grace_intervals=GRACE_INTERVALS,
+                 default_interval=DEFAULT_INTERVAL, clock=time.time,
+                 verify=None):
+        self.default_interval = default_interval
+        self.clock = clock
+        self.verify = verify
+        self.seeded = False
+        self.deadlines = Deadlines(grace_intervals, clock)
+        self._devices = {}
+        self._subscribers = []
+
+    def watch(self, intervals):
+        """Also report devices that have missed `intervals` check-ins."""
+        with self.deadlines.lock:
+            self.deadlines.watch(intervals)
+
+    def subscribe(self, callback):
+        """Call `callback(event)` for every transition and missed level."""
+        self._subscribers.append(callback)
+
+    def seed(self, devices):
+        """Load (device_id, last_seen, interval) tuples known at startup."""
+        now = self.clock()
+        grace_intervals = self.deadlines.grace_intervals
+        with self.deadlines.lock:
+            for device_id, last_seen, interval in devices:
+                if last_seen is None or device_id in self._devices:
+                    continue
+                interval = interval or self.default_interval
+                online = now - last_seen <= interval * grace_intervals
+                entry = DeviceLiveness(
+                    last_seen, interval, online,
+                    announced=interval != self.default_interval)
+                self._devices[device_id] = entry
+                if online:
+                    self.deadlines.schedule(device_id, entry)
+            self.seeded = True
+
+    def observe(self, device_id, now=None, interval=None):
+        """Record a check-in, optionally with the client's own interval."""
+        now = self.clock() if now is None else now
+        with self.deadlines.lock:
+            entry = self._devices.get(device_id)
+            events = []
+            if entry is None:
+                entry = DeviceLiveness(
+                    now, interval or self.default_interval, True,
+                    announced=interval is not None)
+                self._devices[device_id] = entry
+            else:
+                if interval:
+                    entry.interval = interval
+                    entry.announced = True
+                elif not entry.announced:
+                    entry.learn_interval(now - entry.last_seen)
+                entry.last_seen = now
+                if not entry.online:
+                    entry.online = True
+                    events.append(self._event(device_id, 'online', now))
+            self.deadlines.schedule(device_id, entry)
+        self._publish(events)
+
+    def advance(self, now=None):
+        """Process every deadline that has passed and return the events."""
+        now = self.clock() if now is None else now
+        with self.deadlines.lock:
+            expired = []
+            for device_id, generation, level in self.deadlines.expired(now):
+                entry = self._devices.get(device_id)
+                if entry is not None and entry.generation == generation:
+                    expired.append((device_id, generation, level))
+
+        # verify() queries the database, so it runs without the lock;
+        # check-ins observed meanwhile change the generation.
+        seen = {}
+        if self.verify is not None:
+            for device_id in {device_id for device_id, _, _ in expired}:
+                seen[device_id] = self.verify(device_id)
+
+        events = []
+        with self.deadlines.lock:
+            for device_id, generation, level in expired:
+                entry = self._devices.get(device_id)
+                if entry is None or entry.generation != generation:
+                    continue
+                last_seen = seen.get(device_id)
+                if last_seen is not None and last_seen > entry.last_seen:
+                    entry.last_seen = last_seen
+                    self.deadlines.schedule(device_id, entry)
+                    continue
+                if level == self.deadlines.grace_intervals and entry.online:
+                    entry.online = False
+                    events.append(self._event(device_id, 'offline', now))
+                else:
+                    events.append(self._event(device_id, 'missed', now,
+                                              intervals=level))
+        self._publish(events)
+        return events
+
+    def forget(self, device_id):
+        """Stop tracking a device."""
+        with self.deadlines.lock:
+            self._devices.pop(device_id, None)
+
+    def status(self, device_id):
+        """Return the liveness of one device as a dictionary."""
+        with self.deadlines.lock:
+            entry = self._devices.get(device_id)
+            if entry is None:
+                return {'status': 'unknown', 'expected_interval': None,
+                        'next_deadline': None}
+            deadline = (entry.last_seen
+                        + entry.interval * self.deadlines.grace_intervals)
+            return {
+                'status': 'online' if entry.online else 'offline',
+                'expected_interval': round(entry.interval, 2),
+                'next_deadline': _isoformat(deadline),
+            }
+
+    def statuses(self):
+        """Return the liveness of every tracked device."""
+        with self.deadlines.lock:
+            device_ids = list(self._devices)
+        return {device_id: self.status(device_id) for device_id in device_ids}
+
+    def next_deadline(self):
+        """Return the earliest pending deadline, or None."""
+        with self.deadlines.lock:
+            return self.deadlines.next()
+
+    def start(self):
+        """Start the background thread that fires deadlines as they pass."""
+        self.deadlines.start(self.advance)
+
+    def _event(self, device_id, state, now, intervals=None):
+        return {
+            'device_id': device_id,
+            'state': state,
+            'timestamp': _isoformat(now),
+            'intervals': intervals or self.deadlines.grace_intervals,
+        }
+
+    def _publish(self, events):
+        for event in events:
+            for callback in self._subscribers:
+                callback(event)
+
+
+def save_events(conn, events):
+    """
+    Store online/offline transitions in device_events and return the ones
+    stored; a transition to the state stored last for the device is
+    skipped, as another process recorded it already.
+    """
+    stored = []
+    for event in events:
+        cursor = conn.execute('''
+            INSERT INTO device_events (device_id, state, timestamp, intervals)
+            SELECT ?, ?, ?, ?
+            WHERE ? IS NOT (SELECT state FROM device_events
+                            WHERE device_id = ? ORDER BY id DESC LIMIT 1)
+        ''', (event['device_id'], event['state'], event['timestamp'],
+              event['intervals'], event['state'], event['device_id']))
+        if cursor.rowcount == 1:
+            stored.append(dict(event, seq=cursor.lastrowid))
+    if stored:
+        conn.execute('''
+            DELETE FROM device_events
+            WHERE id <= (SELECT MAX(id) FROM device_events) - ?
+        ''', (MAX_EVENTS,))
+    return stored
+
+
+def load_events(conn, since=0):
+    """Return the stored transitions with a sequence number above since."""
+    rows = conn.execute('''
+        SELECT id, device_id, state, timestamp, intervals FROM device_events
+        WHERE id > ? ORDER BY id LIMIT ?
+    ''', (since, MAX_EVENTS)).fetchall()
+    return [{'device_id': row[1], 'state': row[2], 'timestamp': row[3],
+             'intervals': row[4], 'seq': row[0]} for row in rows]
+
+
+def last_event_seq(conn):
+    """Return the sequence number of the newest stored transition, or 0."""
+    return conn.execute(
+        'SELECT COALESCE(MAX(id), 0) FROM device_events').fetchone()[0]
+
+
+def _isoformat(epoch):
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).isoformat()
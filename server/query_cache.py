@@ -0,0 +1,94 @@
+"""
+Bounded LRU cache for query results.
+
+Results over time ranges that are still open (they reach the present, so
+new samples can change them) are stored together with the ingest
+watermark of the devices they cover and are dropped as soon as the
+watermark moves. Results over closed ranges can no longer change and are
+kept until they are evicted.
+
+The cache is shared by the request threads of one server process.
+"""
+import threading
+from collections import OrderedDict
+
+MAX_ENTRIES = 512
+
+# Ranges ending more than this many seconds ago are treated as closed; it
+# covers samples whose transaction started before the range ended but
+# committed after it.
+CLOSED_AFTER_SECONDS = 5
+
+
+class QueryCache:
+    """Thread-safe LRU cache with watermark invalidation."""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, key, watermark=None):
+        """
+        Return (True, value) for a valid cached result, else (False, None).
+
+        Entries stored with a watermark are only valid for the same
+        watermark; entries stored without one are always valid.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored, value = entry
+                if stored is None or stored == watermark:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+                self.invalidations += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, watermark=None):
+        """Store a result; pass no watermark for a closed range."""
+        with self._lock:
+            self._entries[key] = (watermark, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute, watermark=None):
+        """
+        Return the cached result for key or compute and store it.
+
+        The watermark must be read before calling, so a sample ingested
+        while the result is computed invalidates it on the next lookup.
+        """
+        found, value = self.get(key, watermark)
+        if not found:
+            value = compute()
+            self.put(key, value, watermark)
+        return value
+
+    def clear(self):
+        """Drop every entry, e.g. after old data has been deleted."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return the cache counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,286 @@
+"""
+In-memory registry of the devices table.
+
+Ingest checks device ids and the static values a sample carries (memory
+and disk totals, report interval) against memory and only writes the
+devices row when one of them changed. last_seen is kept in memory as well
+and written for all devices together every FLUSH_SECONDS.
+
+Every worker process has its own registry. Whoever changes a devices row
+(other than last_seen and the stream columns) bumps the generation in
+registry_state in the same transaction; the flush thread compares it and
+reloads the registry when another process changed something. A device id
+that is not in memory is looked up once, so devices registered through
+another worker are found at once.
+
+Writers end their transaction with commit() or rollback() of the registry:
+the in-memory copy only takes a change once it is stored.
+"""
+import atexit
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Keep this well below the report interval of the devices: liveness
+# checks of other workers read last_seen from the database.
+FLUSH_SECONDS = 2
+# Columns of the devices table kept in memory.
+FIELDS = ('device_uid', 'device_name', 'hostname', 'ip_address',
+          'memory_total', 'disk_total', 'report_interval')
+
+
+class DeviceTable:
+    """
+    Devices rows by id and by device_uid, as of a generation; a generation
+    of None means they have to be (re)loaded.
+    """
+
+    def __init__(self, rows=(), generation=None):
+        self.generation = generation
+        self.devices = {}
+        self.by_uid = {}
+        for row in rows:
+            self.put(row[0], dict(zip(FIELDS, tuple(row)[1:])))
+
+    def put(self, device_id, device):
+        """Add or replace a device."""
+        self.devices[device_id] = device
+        self.by_uid[device['device_uid']] = device_id
+
+    def pop(self, device_id):
+        """Remove a device if it is known."""
+        device = self.devices.pop(device_id, None)
+        if device is not None:
+            self.by_uid.pop(device['device_uid'], None)
+
+
+class FlushThread(threading.Thread):
+    """Calls flush() every `seconds`, and once more when stopped."""
+
+    def __init__(self, flush, seconds):
+        super().__init__(daemon=True, name='device-registry')
+        self.flush = flush
+        self.seconds = seconds
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.seconds):
+            self.flush()
+        self.flush()
+
+    def stop(self):
+        """Stop the thread after its last flush."""
+        self.stopped.set()
+        if self.ident is not None:
+            self.join()
+
+
+class DeviceRegistry:
+    """The devices table of one worker process, kept in memory."""
+
+    def __init__(self, connect, flush_seconds=FLUSH_SECONDS):
+        """connect() returns a new database connection."""
+        self.connect = connect
+        self.counters = dict.fromkeys((
+            'reloads', 'lookups', 'updates', 'flushes', 'flushed'
+        ), 0)
+        self.table = DeviceTable()
+        self._pending = {}
+        self._staged = {}
+        self._lock = threading.Lock()
+        self._flusher = FlushThread(self.flush, flush_seconds)
+
+    @staticmethod
+    def read_generation(conn):
+        """Return the generation stored in the database."""
+        row = conn.execute(
+            'SELECT generation FROM registry_state WHERE id = 1'
+        ).fetchone()
+        return row[0] if row else 0
+
+    def load(self, conn):
+        """(Re)load every device from the database."""
+        generation = self.read_generation(conn)
+        rows = conn.execute(
+            f"SELECT id, {', '.join(FIELDS)} FROM devices"
+        ).fetchall()
+        table = DeviceTable(rows, generation)
+        with self._lock:
+            self.table = table
+            self.counters['reloads'] += 1
+        self.start()
+
+    def _ensure_loaded(self, conn):
+        if self.table.generation is None:
+            self.load(conn)
+
+    def _lookup(self, conn, column, value):
+        """Find a device that is not in memory yet; returns its id."""
+        self.counters['lookups'] += 1
+        row = conn.execute(
+            f"SELECT id, {', '.join(FIELDS)} FROM devices WHERE {column} = ?",
+            (value,)
+        ).fetchone()
+        if row is None:
+            return None
+        with self._lock:
+            self.table.put(row[0], dict(zip(FIELDS, tuple(row)[1:])))
+        return row[0]
+
+    def get(self, conn, device_id):
+        """Return the stored values of a device, or None if unknown."""
+        self._ensure_loaded(conn)
+        device = self.table.devices.get(device_id)
+        if device is None and self._lookup(conn, 'id', device_id):
+            device = self.table.devices.get(device_id)
+        return device
+
+    def find(self, conn, device_uid):
+        """Return the id of the device with a device_uid, or None."""
+        self._ensure_loaded(conn)
+        device_id = self.table.by_uid.get(device_uid)
+        if device_id is None:
+            device_id = self._lookup(conn, 'device_uid', device_uid)
+        return device_id
+
+    def changes(self, device_id, values):
+        """Return the values that differ from the stored ones."""
+        device = self.table.devices.get(device_id, {})
+        return {column: value for column, value in values.items()
+                if device.get(column) != value}
+
+    def _stage(self, cursor, change):
+        """Apply change() to memory when the cursor's transaction is
+        committed through commit()."""
+        with self._lock:
+            self._staged.setdefault(cursor.connection, []).append(change)
+
+    def commit(self, conn):
+        """Commit the caller's transaction and apply its changes."""
+        try:
+            conn.commit()
+        except sqlite3.Error:
+            self.rollback(conn)
+            raise
+        with self._lock:
+            for change in self._staged.pop(conn, ()):
+                change()
+
+    def rollback(self, conn):
+        """Roll the caller's transaction back and drop its changes."""
+        with self._lock:
+            self._staged.pop(conn, None)
+        conn.rollback()
+
+    def _bump(self, cursor):
+        """Advance the generation; call inside the writing transaction."""
+        cursor.execute(
+            'UPDATE registry_state SET generation = generation + 1 '
+            'WHERE id = 1'
+        )
+        generation = self.read_generation(cursor)
+
+        def change():
+            # Unless this is the only change since the table was loaded,
+            # it is reloaded on its next use.
+            known = self.table.generation
+            if known is not None and generation == known + 1:
+                self.table.generation = generation
+            else:
+                self.table.generation = None
+        self._stage(cursor, change)
+
+    def update(self, cursor, device_id, values):
+        """Write changed values of a device in the caller's transaction."""
+        assignments = ', '.join(f'{column} = ?' for column in values)
+        cursor.execute(f'UPDATE devices SET {assignments} WHERE id = ?',
+                       (*values.values(), device_id))
+        self._bump(cursor)
+
+        def change():
+            self.table.devices.setdefault(device_id, {}).update(values)
+            self.counters['updates'] += 1
+        self._stage(cursor, change)
+
+    def add(self, cursor, values, last_seen):
+        """Insert a device in the caller's transaction; returns its id."""
+        columns = list(values) + ['last_seen']
+        cursor.execute(
+            f"INSERT INTO devices ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)})",
+            (*values.values(), last_seen)
+        )
+        device_id = cursor.lastrowid
+        self._bump(cursor)
+
+        def change():
+            self.table.put(device_id, dict(dict.fromkeys(FIELDS), **values))
+        self._stage(cursor, change)
+        return device_id
+
+    def remove(self, cursor, device_ids):
+        """Forget deleted devices; call in the deleting transaction."""
+        self._bump(cursor)
+
+        def change():
+            for device_id in device_ids:
+                self.table.pop(device_id)
+                self._pending.pop(device_id, None)
+        self._stage(cursor, change)
+
+    def touch(self, device_id, when):
+        """Record a check-in; it is written with the next flush."""
+        with self._lock:
+            self._pending[device_id] = when
+
+    def last_seen(self, device_id):
+        """Return a check-in that is not written yet, or None."""
+        return self._pending.get(device_id)
+
+    def flush(self):
+        """Write the pending check-ins and reload if another process
+        changed the devices table."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        conn = self.connect()
+        try:
+            if pending:
+                conn.executemany(
+                    'UPDATE devices SET last_seen = ? WHERE id = ?',
+                    [(when, device_id) for device_id, when in pending.items()]
+                )
+                conn.commit()
+                self.counters['flushes'] += 1
+                self.counters['flushed'] += len(pending)
+            generation = self.table.generation
+            if generation is not None and \
+                    self.read_generation(conn) != generation:
+                self.load(conn)
+        except sqlite3.Error as e:
+            logger.warning('Could not flush device check-ins: %s', e)
+            with self._lock:
+                for device_id, when in pending.items():
+                    self._pending.setdefault(device_id, when)
+        finally:
+            conn.close()
+
+    def stats(self):
+        """Return the registry counters."""
+        with self._lock:
+            return dict(self.counters, devices=len(self.table.devices),
+                        pending=len(self._pending),
+                        generation=self.table.generation)
+
+    def start(self):
+        """Start the flush thread (once)."""
+        with self._lock:
+            if self._flusher.ident is not None:
+                return
+            self._flusher.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the flush thread after writing what is pending."""
+        self._flusher.stop()
@@ -0,0 +1,311 @@
+"""
+Opt-in request profiling and slow-query logging.
+
+Request profiles are kept per route and written to a directory:
+
+    cprofile  <route>.prof     merged cProfile stats (python -m pstats,
+                               snakeviz, gprof2dot)
+    sample    <route>.folded   collapsed stacks sampled every few
+                               milliseconds (flamegraph.pl, speedscope)
+
+The sampling profiler has one thread for all requests and costs nothing
+in the request threads themselves, so it is the one to leave on in
+production. Files are rewritten at most every FLUSH_SECONDS.
+
+Connections created with TimedConnection log every statement that takes
+longer than a threshold (execution plus fetching its rows) together with
+its EXPLAIN QUERY PLAN.
+"""
+import cProfile
+import logging
+import os
+import pstats
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+MODES = ('cprofile', 'sample')
+SAMPLE_INTERVAL = 0.005
+FLUSH_SECONDS = 10
+# Deepest stack kept by the sampler, counted from the innermost frame.
+MAX_STACK_DEPTH = 64
+
+
+def route_filename(route):
+    """Turn "GET /api/latest/<int:device_id>" into a file name."""
+    return re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+
+
+class StackSampler:
+    """Samples the stacks of the threads serving requests."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = {}
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def begin(self, route):
+        """Start sampling the calling thread for a route."""
+        with self._lock:
+            self._active[threading.get_ident()] = route
+            self.stacks.setdefault(route, Counter())
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, daemon=True, name='stack-sampler')
+                self._thread.start()
+
+    def end(self):
+        """Stop sampling the calling thread."""
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+
+    def sample(self):
+        """Record the current stack of every thread being sampled."""
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, route in self._active.items():
+                frame = frames.get(ident)
+                names = []
+                while frame is not None and len(names) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    names.append(f'{os.path.basename(code.co_filename)}:'
+                                 f'{code.co_name}')
+                    frame = frame.f_back
+                if names:
+                    self.stacks[route][';'.join(reversed(names))] += 1
+
+    def _run(self):
+        # The thread ends once no request is being sampled; begin() starts
+        # a new one.
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+
+    def write(self, directory, routes):
+        """Write the collapsed stacks of some routes."""
+        for route in routes:
+            with self._lock:
+                lines = [f'{stack} {count}\n'
+                         for stack, count in self.stacks[route].items()]
+            path = os.path.join(directory, route_filename(route) + '.folded')
+            with open(path, 'w', encoding='UTF-8') as f:
+                f.writelines(lines)
+
+
+class ProfileStats:
+    """Merges the cProfile stats of the requests of each route."""
+
+    def __init__(self):
+        self.stats = {}
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def begin(self):
+        """Start profiling the calling thread; returns the profile, or None
+        if another one is active."""
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Only one cProfile can be active at a time on Python 3.12+.
+            with self._lock:
+                self.skipped += 1
+            return None
+        return profile
+
+    def end(self, route, profile):
+        """Finish a profile and merge it into the stats of its route."""
+        profile.disable()
+        with self._lock:
+            if route in self.stats:
+                self.stats[route].add(profile)
+            else:
+                self.stats[route] = pstats.Stats(profile)
+
+    def write(self, directory, routes):
+        """Write the merged stats of some routes."""
+        with self._lock:
+            for route in routes:
+                self.stats[route].dump_stats(os.path.join(
+                    directory, route_filename(route) + '.prof'))
+
+
+class RequestProfiler:
+    """Profiles requests and keeps the results per route."""
+
+    def __init__(self, directory, mode='sample'):
+        if mode not in MODES:
+            raise ValueError(
+                f"Unknown profiling mode '{mode}', expected one of "
+                f"{', '.join(MODES)}"
+            )
+        self.directory = directory
+        # One of them is None, depending on the mode.
+        self.sampler = StackSampler() if mode == 'sample' else None
+        self.profiles = ProfileStats() if mode == 'cprofile' else None
+        self.requests = Counter()
+        self._dirty = set()
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def mode(self):
+        """The profiling mode, one of MODES."""
+        return 'sample' if self.sampler is not None else 'cprofile'
+
+    @property
+    def skipped(self):
+        """The requests not profiled because another profile was active."""
+        return self.profiles.skipped if self.profiles is not None else 0
+
+    def start(self, route):
+        """Start profiling the current request; returns a handle for stop()."""
+        if self.sampler is not None:
+            self.sampler.begin(route)
+            return route, None
+        profile = self.profiles.begin()
+        return None if profile is None else (route, profile)
+
+    def stop(self, handle):
+        """Finish a profile started with start()."""
+        if handle is None:
+            return
+        route, profile = handle
+        if profile is None:
+            self.sampler.end()
+        else:
+            self.profiles.end(route, profile)
+        with self._lock:
+            self.requests[route] += 1
+            self._dirty.add(route)
+            due = time.monotonic() - self._flushed >= FLUSH_SECONDS
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write the profiles of the routes seen since the last flush."""
+        with self._lock:
+            routes, self._dirty = self._dirty, set()
+            self._flushed = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        (self.sampler or self.profiles).write(self.directory, routes)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that reports statements slower than its connection's
+    threshold. A statement's time includes fetching its rows."""
+
+    _sql = None
+    _params = ()
+    _elapsed = 0.0
+
+    def execute(self, sql, parameters=()):
+        """Run a statement, reporting the previous one if it was slow."""
+        self._finish()
+        self._sql, self._params = sql, parameters
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._elapsed = time.perf_counter() - started
+
+    def executemany(self, sql, seq_of_parameters):
+        """Run a statement once per parameter set, timed as a whole."""
+        self._finish()
+        self._sql, self._params = sql, None
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._elapsed = time.perf_counter() - started
+
+    def _timed(self, fetch, *args):
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            self._elapsed += time.perf_counter() - started
+
+    def fetchone(self):
+        """Fetch the next row."""
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        """Fetch the next `size` rows (arraysize by default)."""
+        if size is None:
+            return self._timed(super().fetchmany)
+        return self._timed(super().fetchmany, size)
+
+    def fetchall(self):
+        """Fetch the remaining rows; the statement is then complete."""
+        rows = self._timed(super().fetchall)
+        self._finish()
+        return rows
+
+    def close(self):
+        """Report the last statement if it was slow and close."""
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+    def _finish(self):
+        sql, self._sql = self._sql, None
+        if sql is None:
+            return
+        threshold = getattr(self.connection, 'slow_query_seconds', None)
+        if threshold is not None and self._elapsed >= threshold:
+            self.connection.log_slow_query(sql, self._params, self._elapsed)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements are timed by TimedCursor."""
+
+    slow_query_seconds = None
+
+    def cursor(self, factory=None):
+        """Return a new cursor, a TimedCursor unless `factory` is given."""
+        return super().cursor(factory or TimedCursor)
+
+    def execute(self, sql, parameters=()):
+        """Run a statement on a new timed cursor."""
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        """Run a statement per parameter set on a new timed cursor."""
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def query_plan(self, sql, parameters):
+        """Return the EXPLAIN QUERY PLAN lines of a statement."""
+        try:
+            plain = super().cursor(sqlite3.Cursor)
+            plain.row_factory = None
+            plain.execute(f'EXPLAIN QUERY PLAN {sql}', parameters or ())
+            plan = [row[3] for row in plain.fetchall()]
+            plain.close()
+            return plan
+        except sqlite3.Error:
+            return []
+
+    def log_slow_query(self, sql, parameters, elapsed):
+        """Log a slow statement with its query plan."""
+        plan = self.query_plan(sql, parameters)
+        logger.warning(
+            'Slow query (%.1f ms): %s\n  plan: %s', elapsed * 1000,
+            ' '.join(sql.split()), '; '.join(plan) or 'n/a'
+        )
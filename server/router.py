@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Raspberry Pi Status Monitor - Query router for multi-node mode
+
+Sits in front of several ingest shards, each a normal server process with
+its own database. A device registers again on the shard that already
+knows its device_uid; new devices are placed on a shard by consistent
+hashing of the device_uid, so adding a shard does not register existing
+devices twice. Every other per-device request goes straight to the shard
+encoded in the device id. Fleet-wide reads are fanned out to all
+shards in parallel and merged.
+
+The shard URLs come from the RPI_MONITOR_SHARDS environment variable
+(comma separated, in shard index order) or from "cluster.shards" in
+server_config.json. run_cluster.py starts a complete local cluster.
+"""
+import json
+import os
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from flask import Flask, Response, jsonify, render_template, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from settings import load_config
+from sharding import HashRing, shard_of_device
+from static_assets import init_app as init_assets
+from timeutils import parse_time
+
+app = Flask(__name__)
+init_assets(app)
+
+config = load_config()
+# Proxies in front of the router (nginx), whose X-Forwarded-For entries
+# are trusted; 0 when clients connect to the router directly.
+PROXY_HOPS = config.get('cluster', {}).get('proxy_hops', 0)
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+SERVER_VERSION = config.get('version', '0.0.0')
+PORT = int(os.environ.get('RPI_MONITOR_PORT', 5000))
+SHARD_TIMEOUT = 10
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Request headers that are passed on to the shards.
+FORWARDED_HEADERS = ('Content-Type', 'X-Client-Version')
+# Response headers of the shards that are passed back to the client.
+RELAYED_HEADERS = ('Content-Disposition', 'Retry-After')
+
+
+class ShardClient:
+    """Sends HTTP requests to the shard servers."""
+
+    def __init__(self, urls, timeout=SHARD_TIMEOUT):
+        self.urls = [url.rstrip('/') for url in urls]
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max(len(self.urls), 1))
+
+    def open(self, shard, method, path, query='', body=None, headers=None):
+        """Send a request and return the open response (also on errors)."""
+        url = f'{self.urls[shard]}{path}'
+        if query:
+            url = f'{url}?{query}'
+        req = urllib.request.Request(
+            url, data=body, headers=headers or {}, method=method
+        )
+        try:
+            return urllib.request.urlopen(req, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            return e
+
+    def request(self, shard, method, path, query='', body=None,
+                headers=None):
+        """Send a request and return (status, content type, body)."""
+        with self.open(shard, method, path, query, body, headers) as resp:
+            return (resp.status, resp.headers.get('Content-Type'),
+                    resp.read())
+
+    def map(self, fn, shard_indexes):
+        """Call fn for several shards in parallel and return the results
+        in order."""
+        return list(self._pool.map(fn, shard_indexes))
+
+    def get_all_json(self, path, query=''):
+        """GET a path from every shard in parallel; unreachable shards are
+        left out of the result."""
+        def fetch(shard):
+            try:
+                status, _, body = self.request(shard, 'GET', path, query)
+            except OSError:
+                return None
+            return json.loads(body) if status == 200 else None
+
+        return [result for result in self.map(fetch, range(len(self.urls)))
+                if result is not None]
+
+
+def load_shard_urls():
+    """Return the configured shard URLs in shard index order."""
+    urls = os.environ.get('RPI_MONITOR_SHARDS')
+    if urls:
+        return [url.strip() for url in urls.split(',') if url.strip()]
+    return config.get('cluster', {}).get('shards', [])
+
+
+shards = ShardClient(load_shard_urls())
+ring = HashRing(range(len(shards.urls))) if shards.urls else None
+
+
+def forward(shard):
+    """Pass the current request on to a shard and relay its answer."""
+    headers = {name: request.headers[name] for name in FORWARDED_HEADERS
+               if name in request.headers}
+    # Shards trust the last entry, the client address as resolved here.
+    chain = request.headers.get('X-Forwarded-For')
+    client = request.remote_addr or ''
+    headers['X-Forwarded-For'] = f'{chain}, {client}' if chain else client
+    resp = shards.open(
+        shard, request.method, request.path,
+        request.query_string.decode('utf-8'),
+        request.get_data() if request.method == 'POST' else None,
+        headers
+    )
+
+    def relay():
+        with resp:
+            while True:
+                chunk = resp.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    passed = {name: resp.headers[name]
+              for name in RELAYED_HEADERS if name in resp.headers}
+    return Response(relay(), status=resp.status,
+                    content_type=resp.headers.get('Content-Type'),
+                    headers=passed)
+
+
+def device_shard(device_id):
+    """Return the shard owning a device id, or None if there is none."""
+    shard = shard_of_device(device_id)
+    return shard if 0 <= shard < len(shards.urls) else None
+
+
+def unknown_device():
+    """Response for device ids outside every shard's range."""
+    return jsonify({'error': 'Device not registered'}), 404
+
+
+@app.route('/')
+def index():
+    """Render the main dashboard page."""
+    return render_template('index.html',
+                           app_info={'server_version': SERVER_VERSION})
+
+
+@app.route('/api/version', methods=['GET'])
+def get_version():
+    """Return the server version."""
+    return jsonify({'version': SERVER_VERSION})
+
+
+def registered_shard(device_uid):
+    """
+    Return the shard a device_uid is registered on, None if it is on no
+    shard, or -1 if a shard could not be asked.
+    """
+    query = urllib.parse.urlencode({'device_uid': device_uid})
+
+    def lookup(shard):
+        try:
+            status, _, _ = shards.request(shard, 'GET', '/api/devices/lookup',
+                                          query)
+        except OSError:
+            return None
+        return status
+
+    statuses = shards.map(lookup, range(len(shards.urls)))
+    if 200 in statuses:
+        return statuses.index(200)
+    return None if all(status == 404 for status in statuses) else -1
+
+
+@app.route('/api/register', methods=['POST'])
+def register_device():
+    """Register a device on the shard that knows its device_uid, or else
+    on the shard the device_uid hashes to."""
+    data = request.get_json(silent=True)
+    if not data or 'device_uid' not in data:
+        return jsonify({'error': 'device_uid is required'}), 400
+    device_uid = str(data['device_uid'])
+    shard = registered_shard(device_uid)
+    if shard == -1:
+        # Placing the device by hash now could register it twice.
+        return jsonify({'error': 'A shard is unavailable'}), 503
+    return forward(ring.node_for(device_uid) if shard is None else shard)
+
+
+@app.route('/api/data', methods=['POST'])
+def receive_data():
+    """Pass metrics on to the shard owning the device."""
+    data = request.get_json(silent=True)
+    if not data or 'device_id' not in data:
+        return jsonify({'error': 'device_id and metrics are required'}), 400
+    try:
+        shard = device_shard(data['device_id'])
+    except (TypeError, ValueError):
+        shard = None
+    if shard is None:
+        return unknown_device()
+    return forward(shard)
+
+
+@app.route('/api/history/<int:device_id>')
+@app.route('/api/latest/<int:device_id>')
+@app.route('/api/percentiles/<int:device_id>')
+@app.route('/api/processes/<int:device_id>')
+@app.route('/api/disks/<int:device_id>')
+def device_read(device_id):
+    """Pass a per-device read on to the shard owning the device."""
+    shard = device_shard(device_id)
+    if shard is None:
+        return unknown_device()
+    return forward(shard)
+
+
+@app.route('/api/devices', methods=['GET'])
+def get_devices():
+    """Return the devices of all shards, most recently seen first."""
+    devices = [device for result in shards.get_all_json('/api/devices')
+               for device in result]
+    devices.sort(key=lambda d: d.get('last_seen') or '', reverse=True)
+    return jsonify(devices)
+
+
+@app.route('/api/devices/status', methods=['GET'])
+def get_devices_status():
+    """Return the liveness of the devices of all shards."""
+    merged = {}
+    for result in shards.get_all_json('/api/devices/status'):
+        merged.update(result)
+    return jsonify(merged)
+
+
+@app.route('/api/devices/events', methods=['GET'])
+def get_devices_events():
+    """Return the online/offline transitions of all shards in time order.
+
+    Sequence numbers are per shard, so `since` is passed to every shard.
+    """
+    events = [event for result in shards.get_all_json(
+                  '/api/devices/events', request.query_string.decode('utf-8'))
+              for event in result]
+    events.sort(key=lambda event: event['timestamp'])
+    return jsonify(events)
+
+
+@app.route('/api/client-stats')
+def api_client_stats():
+    """Return the client overhead of the devices of all shards."""
+    merged = {}
+    for result in shards.get_all_json('/api/client-stats',
+                                      request.query_string.decode('utf-8')):
+        merged.update(result)
+    return jsonify(merged)
+
+
+@app.route('/api/alerts')
+def api_alerts():
+    """Return the alerts of all shards."""
+    results = shards.get_all_json('/api/alerts')
+    recent = [alert for result in results for alert in result['recent']]
+    recent.sort(key=lambda alert: alert['timestamp'], reverse=True)
+    return jsonify({
+        'active': [alert for result in results
+                   for alert in result['active']],
+        'recent': recent,
+    })
+
+
+@app.route('/api/query')
+def api_query():
+    """Run a multi-device query on the shards owning the devices and
+    merge their series."""
+    try:
+        device_ids = [int(device_id) for device_id in
+                      request.args.get('devices', '').split(',') if device_id]
+    except ValueError:
+        return jsonify({'error': 'devices must be a list of ids'}), 400
+    by_shard = {}
+    for device_id in device_ids:
+        shard = device_shard(device_id)
+        if shard is None:
+            return unknown_device()
+        by_shard.setdefault(shard, []).append(str(device_id))
+    if not by_shard:
+        return forward(0)
+
+    # Pin the range so every shard builds the same grid.
+    try:
+        end = parse_time(request.args.get('end')) or datetime.now(timezone.utc)
+        start = (parse_time(request.args.get('start'))
+                 or end - timedelta(hours=1))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query: {e}'}), 400
+    args = dict(request.args.to_dict(), start=str(start.timestamp()),
+                end=str(end.timestamp()))
+
+    def fetch(shard):
+        query = urllib.parse.urlencode(
+            dict(args, devices=','.join(by_shard[shard])))
+        return shards.request(shard, 'GET', '/api/query', query)
+
+    merged = None
+    for status, content_type, body in shards.map(fetch, by_shard):
+        if status != 200:
+            return Response(body, status=status, content_type=content_type)
+        result = json.loads(body)
+        if merged is None:
+            merged = result
+        else:
+            merged['series'].extend(result['series'])
+    merged['series'].sort(key=lambda series: series['device_id'])
+    return jsonify(merged)
+
+
+@app.route('/api/export')
+def api_export():
+    """Export one device from its shard, or the fleet shard by shard."""
+    device_id = request.args.get('device_id', type=int)
+    if device_id is not None:
+        shard = device_shard(device_id)
+        if shard is None:
+            return unknown_device()
+        return forward(shard)
+
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({
+            'error': 'Fleet exports through the router support csv and '
+                     'ndjson; export each device for other formats'
+        }), 400
+    query = request.query_string.decode('utf-8')
+
+    def generate():
+        for shard in range(len(shards.urls)):
+            with shards.open(shard, 'GET', '/api/export', query) as resp:
+                if resp.status != 200:
+                    continue
+                if fmt == 'csv' and shard > 0:
+                    resp.readline()  # every shard repeats the header
+                while True:
+                    chunk = resp.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+
+    extension = 'csv' if fmt == 'csv' else 'ndjson'
+    return Response(generate(), mimetype=(
+        'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    ), headers={
+        'Content-Disposition':
+            f'attachment; filename="stats-fleet.{extension}"'
+    })
+
+
+if __name__ == '__main__':
+    if not shards.urls:
+        raise SystemExit('No shards configured; set RPI_MONITOR_SHARDS')
+    print(f"Routing to {len(shards.urls)} shard(s): "
+          f"{', '.join(shards.urls)}")
+    app.run(host='0.0.0.0', port=PORT, debug=False, threaded=True)
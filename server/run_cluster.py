@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Start a local multi-node cluster for development and testing.
+
+Runs N shard servers, each with its own database under --data-dir, and a
+query router in front of them:
+
+    python run_cluster.py --shards 3 --port 5000
+
+Clients and the dashboard then talk to the router port as usual. Shard i
+serves HTTP on port + 1 + i and, if configured, UDP and stream ingest on
+port + 1 + shards + i and port + 1 + 2 * shards + i; devices learn their
+shard's ports when they register.
+"""
+import argparse
+import contextlib
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from create_tables import create_tables
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    """Start the shards and the router and wait until interrupted."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n', maxsplit=1)[0])
+    parser.add_argument('--shards', type=int, default=3)
+    parser.add_argument('--port', type=int, default=5000,
+                        help='router port; shards use the ports after it')
+    parser.add_argument('--data-dir', default=os.path.join(BASE_PATH,
+                                                           'cluster'))
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    shard_urls = []
+    commands = []
+    for shard in range(args.shards):
+        db_path = os.path.join(args.data_dir, f'shard-{shard}.db')
+        create_tables(shard_index=shard, db_path=db_path)
+        port = args.port + 1 + shard
+        shard_urls.append(f'http://127.0.0.1:{port}')
+        commands.append(('server.py', {
+            'RPI_MONITOR_DB': db_path,
+            'RPI_MONITOR_PORT': str(port),
+            'RPI_MONITOR_UDP_PORT': str(port + args.shards),
+            'RPI_MONITOR_STREAM_PORT': str(port + 2 * args.shards),
+        }))
+    commands.append(('router.py', {'RPI_MONITOR_SHARDS': ','.join(shard_urls),
+                                   'RPI_MONITOR_PORT': str(args.port)}))
+
+    def stop(_signum, _frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    processes = []
+    # Leaving the stack waits for every process.
+    with contextlib.ExitStack() as stack:
+        try:
+            for script, env in commands:
+                processes.append(stack.enter_context(subprocess.Popen(
+                    [sys.executable, os.path.join(BASE_PATH, script)],
+                    env=dict(os.environ, **env)
+                )))
+            while all(process.poll() is None for process in processes):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in processes:
+                if process.poll() is None:
+                    process.send_signal(signal.SIGTERM)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+JSON encoding and decoding for the API hot paths.
+
+orjson is used when it is installed and the standard library otherwise.
+Responses are built straight from tuple rows and a column list fixed per
+query instead of going through sqlite3.Row and dict copies, and columns
+that already hold JSON text (voltages, interface addresses) are copied
+into the output as they are instead of being decoded and encoded again.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    def dumps(obj):
+        """Encode an object as compact JSON bytes."""
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    loads = orjson.loads
+else:
+    def dumps(obj):
+        """Encode an object as compact JSON bytes."""
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    loads = json.loads
+
+
+def dumps_text(obj):
+    """Encode an object as compact JSON text, e.g. to store it."""
+    return dumps(obj).decode('utf-8')
+
+
+def _raw(value):
+    """Return stored JSON text as bytes; NULL becomes null."""
+    if value is None:
+        return b'null'
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
+
+def encode_object(fields, raw_fields):
+    """
+    Encode a dict as a JSON object, adding fields whose values are JSON
+    text already.
+    """
+    if not raw_fields:
+        return dumps(fields)
+    raw = b','.join(dumps(name) + b':' + _raw(value)
+                    for name, value in raw_fields.items())
+    head = dumps(fields)[:-1]
+    return head + (b',' if fields else b'') + raw + b'}'
+
+
+def encode_rows(columns, rows, raw_columns=()):
+    """
+    Encode tuple rows as a JSON array of objects keyed by `columns`.
+
+    Columns named in raw_columns hold JSON text, which is copied into the
+    output unchanged.
+    """
+    raw = [i for i, column in enumerate(columns) if column in raw_columns]
+    if not raw:
+        return dumps([dict(zip(columns, row)) for row in rows])
+
+    plain = [i for i in range(len(columns)) if i not in raw]
+    plain_names = [columns[i] for i in plain]
+    raw_keys = [(dumps(columns[i]) + b':', i) for i in raw]
+    parts = []
+    for row in rows:
+        head = dumps(dict(zip(plain_names, [row[i] for i in plain])))[:-1]
+        tail = b','.join(key + _raw(row[i]) for key, i in raw_keys)
+        parts.append(head + (b',' if plain else b'') + tail + b'}')
+    return b'[' + b','.join(parts) + b']'
@@ -5,38 +5,204 @@ Raspberry Pi Status Monitor - Server
 Receives data from multiple clients, stores it in SQLite,
 and serves a web interface to view the data.
 """
-import json
+import atexit
+import hmac
 import os
 import sqlite3
 import threading
 import time
 from datetime import datetime, timezone, timedelta
 
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, g, render_template, jsonify, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from admission import Rejected, build_admission
+from alerts import alert_values, build_engine, load_alerts
+from event_store import EventStore
+from ingest_listeners import IngestListeners
+from liveness import LivenessTracker
+from query_cache import CLOSED_AFTER_SECONDS, QueryCache
+from registry import FLUSH_SECONDS, DeviceRegistry
+from request_profiling import RequestProfiler, TimedConnection
+from serialization import dumps_text, loads
+from settings import BASE_PATH, load_config
+from sketches import record_sample
+from static_assets import init_app as init_assets
+from stats_api import StatsApi
+from timeutils import parse_time
+from tsblock import ARCHIVE_AFTER_HOURS, BLOCK_SECONDS, block_ids, compact
 
 app = Flask(__name__)
-
-BASE_PATH = os.path.dirname(os.path.abspath(__file__))
-CONFIG_PATH = os.path.join(BASE_PATH, 'server_config.json')
-try:
-    with open(CONFIG_PATH, 'r', encoding="UTF-8") as f:
-        config = json.load(f)
-        SERVER_VERSION = config.get('version', '0.0.0')
-except FileNotFoundError:
-    SERVER_VERSION = '0.0.0'
-
-DB_PATH = os.path.join(BASE_PATH, 'system_stats.db')
+# remote_addr is taken from the X-Forwarded-For entry added by the one
+# proxy in front (nginx or the cluster router), never from client input.
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+init_assets(app)
+
+config = load_config()
+SERVER_VERSION = config.get('version', '0.0.0')
+
+DB_PATH = os.environ.get(
+    'RPI_MONITOR_DB', os.path.join(BASE_PATH, 'system_stats.db')
+)
+PORT = int(os.environ.get('RPI_MONITOR_PORT', 5000))
 STATS_RETENTION_DAYS = 30
 INACTIVE_DEVICE_DAYS = 7
+# Tables with per-sample detail, keyed by stats_id.
+DETAIL_TABLES = ('network_stats', 'client_stats', 'process_stats',
+                 'disk_stats', 'mount_stats')
+
+alert_engine = build_engine(config.get('alerts', {}))
+query_cache = QueryCache()
+admission = build_admission(config.get('admission'))
+# Samples older than after_hours are moved into compressed blocks.
+archive_config = config.get('archive', {})
+compactor_started = threading.Event()
+
+# Profiling is opt-in: RPI_MONITOR_PROFILE=sample|cprofile profiles every
+# request, and with a "token" in the "profiling" config section a single
+# request can be profiled by sending it in an X-Profile header.
+profiling_config = config.get('profiling', {})
+PROFILE_ALL = os.environ.get('RPI_MONITOR_PROFILE')
+request_profiler = RequestProfiler(
+    profiling_config.get('directory', os.path.join(BASE_PATH, 'profiles')),
+    PROFILE_ALL or profiling_config.get('mode', 'sample')
+)
+if PROFILE_ALL:
+    atexit.register(request_profiler.flush)
+SLOW_QUERY_MS = os.environ.get('RPI_MONITOR_SLOW_QUERY_MS',
+                               profiling_config.get('slow_query_ms'))
 
 
 def get_db_conn():
     """Get a database connection."""
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    if SLOW_QUERY_MS is None:
+        conn = sqlite3.connect(
+            app.config.get('DATABASE', DB_PATH), check_same_thread=False
+        )
+    else:
+        conn = sqlite3.connect(
+            app.config.get('DATABASE', DB_PATH), check_same_thread=False,
+            factory=TimedConnection
+        )
+        conn.slow_query_seconds = float(SLOW_QUERY_MS) / 1000
     conn.row_factory = sqlite3.Row
     return conn
 
 
+registry = DeviceRegistry(
+    get_db_conn, config.get('registry', {}).get('flush_seconds', FLUSH_SECONDS)
+)
+
+
+def profiling_requested():
+    """Return True if the current request should be profiled."""
+    if PROFILE_ALL:
+        return True
+    token = profiling_config.get('token')
+    return bool(token) and hmac.compare_digest(
+        request.headers.get('X-Profile', ''), token)
+
+
+@app.before_request
+def start_profiling():
+    """Start profiling the request if asked to."""
+    if profiling_requested():
+        rule = request.url_rule.rule if request.url_rule else '<unmatched>'
+        g.profile = request_profiler.start(f'{request.method} {rule}')
+
+
+@app.teardown_request
+def stop_profiling(_exc=None):
+    """Finish the profile of the request, if any."""
+    handle = g.pop('profile', None)
+    if handle is not None:
+        request_profiler.stop(handle)
+
+
+def request_json():
+    """Decode the JSON body of the current request, or return None."""
+    if not request.is_json:
+        return None
+    try:
+        return loads(request.get_data())
+    except ValueError:
+        return None
+
+
+def to_epoch(value):
+    """Convert a stored DATETIME value to Unix epoch seconds."""
+    return parse_time(value).timestamp() if value else None
+
+
+def device_last_seen(device_id):
+    """Return when a device last checked in according to the database."""
+    conn = get_db_conn()
+    try:
+        row = conn.execute(
+            'SELECT last_seen FROM devices WHERE id = ?', (device_id,)
+        ).fetchone()
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+    return to_epoch(row['last_seen']) if row else None
+
+
+def ingest_watermark(conn, device_ids):
+    """
+    Return the ingest watermark of some devices: the registry generation,
+    which changes with every change to a devices row, and the id of each
+    device's newest sample (one index seek per device). Reading it from
+    the database keeps cached results correct when other worker processes
+    ingest.
+    """
+    watermark = [DeviceRegistry.read_generation(conn)]
+    for device_id in sorted(device_ids):
+        row = conn.execute('''
+            SELECT id FROM stats WHERE device_id = ?
+            ORDER BY timestamp DESC, id DESC LIMIT 1
+        ''', (device_id,)).fetchone()
+        watermark.append((device_id, row['id'] if row else None))
+    return tuple(watermark)
+
+
+def cached_query(conn, key, device_ids, compute, end=None):
+    """
+    Return a query result from the cache or compute it. Results whose
+    range ended before `end` plus a grace period never change and are
+    cached without a watermark.
+    """
+    closed = end is not None and end <= datetime.now(timezone.utc) - \
+        timedelta(seconds=CLOSED_AFTER_SECONDS)
+    watermark = None if closed else ingest_watermark(conn, device_ids)
+    return query_cache.get_or_compute(key, compute, watermark)
+
+
+stats_api = StatsApi(get_db_conn, cached_query)
+stats_api.init_app(app)
+
+
+liveness_tracker = LivenessTracker(verify=device_last_seen)
+event_store = EventStore(get_db_conn)
+event_store.attach(alert_engine, liveness_tracker)
+event_store.init_app(app)
+
+
+def ensure_liveness_tracking(conn):
+    """Seed the liveness tracker and the firing alerts from the database
+    on first use."""
+    if not liveness_tracker.seeded:
+        alert_engine.restore(*load_alerts(conn))
+        rows = conn.execute(
+            'SELECT id, last_seen, report_interval FROM devices'
+        ).fetchall()
+        liveness_tracker.seed(
+            (row['id'], to_epoch(row['last_seen']), row['report_interval'])
+            for row in rows
+        )
+    liveness_tracker.start()
+
+
 @app.route('/')
 def index():
     """Render the main dashboard page."""
@@ -56,13 +222,43 @@ def get_version():
 def get_devices():
     """Return a list of all registered devices."""
     conn = get_db_conn()
+    ensure_liveness_tracking(conn)
     devices = conn.execute(
         'SELECT * FROM devices ORDER BY last_seen DESC'
     ).fetchall()
-    devices_list = [dict(row) for row in devices]
+    devices_list = []
+    for row in devices:
+        device = dict(row)
+        pending = registry.last_seen(device['id'])
+        if pending is not None:
+            device['last_seen'] = str(pending)
+        device.update(liveness_tracker.status(device['id']))
+        devices_list.append(device)
     return jsonify(devices_list)
 
 
+@app.route('/api/devices/status', methods=['GET'])
+def get_devices_status():
+    """Return the online/offline state of every device from memory."""
+    return jsonify(liveness_tracker.statuses())
+
+
+@app.route('/api/devices/lookup', methods=['GET'])
+def lookup_device():
+    """Return the id of the device registered with a device_uid."""
+    device_uid = request.args.get('device_uid')
+    if not device_uid:
+        return jsonify({'error': 'device_uid is required'}), 400
+    conn = get_db_conn()
+    try:
+        device_id = registry.find(conn, device_uid)
+    finally:
+        conn.close()
+    if device_id is None:
+        return jsonify({'error': 'Device not registered'}), 404
+    return jsonify({'device_id': device_id})
+
+
 @app.route('/api/register', methods=['POST'])
 def register_device():
     """Register a new device or update an existing one."""
@@ -74,43 +270,108 @@ def register_device():
             'server_version': SERVER_VERSION
         }), 426
 
-    data = request.get_json()
+    data = request_json()
     if not data or 'device_uid' not in data:
         return jsonify({'error': 'device_uid is required'}), 400
 
     device_uid = data['device_uid']
-    device_name = data.get('device_name', 'Unnamed Device')
-    hostname = data.get('hostname')
-    ip_address = request.remote_addr
     now = datetime.now(timezone.utc)
 
     conn = get_db_conn()
     cursor = conn.cursor()
+    values = {'device_name': data.get('device_name', 'Unnamed Device'),
+              'ip_address': request.remote_addr,
+              'hostname': data.get('hostname')}
 
-    cursor.execute(
-        'SELECT id FROM devices WHERE device_uid = ?', (device_uid,)
-    )
-    device = cursor.fetchone()
-
-    if device:
-        device_id = device['id']
-        cursor.execute('''
-            UPDATE devices
-            SET device_name = ?, ip_address = ?, hostname = ?, last_seen = ?
-            WHERE id = ?
-        ''', (device_name, ip_address, hostname, now, device_id))
-        conn.commit()
-    else:
-        cursor.execute('''
-            INSERT INTO devices
-            (device_uid, device_name, ip_address, hostname, last_seen)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (device_uid, device_name, ip_address, hostname, now))
-        device_id = cursor.lastrowid
-        conn.commit()
+    # Re-registering with unchanged details does not write to the database.
+    try:
+        device_id = registry.find(conn, device_uid)
+        created = device_id is None
+        if not created:
+            changes = registry.changes(device_id, values)
+            if changes:
+                registry.update(cursor, device_id, changes)
+        else:
+            device_id = registry.add(
+                cursor, dict(values, device_uid=device_uid), now)
+        registry.commit(conn)
+        ensure_liveness_tracking(conn)
+    except sqlite3.Error as e:
+        # E.g. another worker registered the same device_uid first.
+        registry.rollback(conn)
+        return jsonify({'error': f'Database error: {e}'}), 500
+    finally:
+        conn.close()
+
+    if not created:
+        registry.touch(device_id, now)
+    liveness_tracker.observe(device_id)
+
+    body = {'status': 'success', 'device_id': device_id}
+    body.update(ingest_listeners.device_settings(device_id))
+    response = jsonify(body)
+    return response, 201 if created else 200
+
+
+def parse_frequency(value):
+    """Return a CPU frequency in MHz from a number or a "1500.00 MHz"
+    string."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.split()[0])
+        except (IndexError, ValueError):
+            return None
+    return None
 
-    response = jsonify({'status': 'success', 'device_id': device_id})
-    return response, 200 if not device else 201
+
+def get_interface_id(cursor, device_id, name, iface_stats):
+    """
+    Return the id of the current metadata version of a device interface.
+
+    A new version row is only written when speed, MTU, link state or
+    addresses differ from the last one stored for the interface.
+    """
+    metadata = (
+        iface_stats.get('speed'),
+        iface_stats.get('mtu'),
+        iface_stats.get('is_up'),
+        dumps_text(iface_stats.get('addresses', [])),
+    )
+    cursor.execute('''
+        SELECT id, speed, mtu, is_up, addresses
+        FROM interfaces
+        WHERE device_id = ? AND name = ?
+        ORDER BY id DESC
+        LIMIT 1
+    ''', (device_id, name))
+    current = cursor.fetchone()
+    if current and tuple(current)[1:] == metadata:
+        return current[0]
+
+    cursor.execute('''
+        INSERT INTO interfaces (device_id, name, speed, mtu, is_up, addresses)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (device_id, name) + metadata)
+    return cursor.lastrowid
+
+
+def get_process_name_id(cursor, name):
+    """Return the id of a process name, adding it on first use."""
+    cursor.execute('INSERT OR IGNORE INTO process_names (name) VALUES (?)',
+                   (name,))
+    cursor.execute('SELECT id FROM process_names WHERE name = ?', (name,))
+    return cursor.fetchone()[0]
+
+
+def get_disk_name_id(cursor, name):
+    """Return the id of a disk or mount point name, adding it on first
+    use."""
+    cursor.execute('INSERT OR IGNORE INTO disk_names (name) VALUES (?)',
+                   (name,))
+    cursor.execute('SELECT id FROM disk_names WHERE name = ?', (name,))
+    return cursor.fetchone()[0]
 
 
 @app.route('/api/data', methods=['POST'])
@@ -124,143 +385,239 @@ def receive_data():
             'server_version': SERVER_VERSION
         }), 426
 
-    data = request.get_json()
+    data = request_json()
 
     if not data or 'device_id' not in data or 'metrics' not in data:
         return jsonify({'error': 'device_id and metrics are required'}), 400
 
-    device_id = data['device_id']
-    metrics = data['metrics']
+    body, status = ingest_sample(data['device_id'], data['metrics'],
+                                 data.get('report_interval'))
+    response = jsonify(body)
+    if 'retry_after' in body:
+        response.headers['Retry-After'] = str(body['retry_after'])
+    return response, status
 
-    conn = get_db_conn()
-    cursor = conn.cursor()
 
-    try:
-        cursor.execute('SELECT id FROM devices WHERE id = ?', (device_id,))
-        if not cursor.fetchone():
-            return jsonify({'error': 'Device not registered'}), 404
-
-        amperage = metrics.get('voltages', {}).pop('amperage', None)
-
-        cursor.execute('''INSERT INTO stats (
-                    device_id, cpu_usage, cpu_frequency, memory_used,
-                    memory_total, memory_percentage, disk_used, disk_total,
-                    disk_percentage, temperature, uptime, throttled, voltages,
-                    amperage
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (
-            device_id,
-            metrics['cpu']['usage'],
-            metrics['cpu']['frequency'],
-            metrics['memory']['used'],
-            metrics['memory']['total'],
-            metrics['memory']['percentage'],
-            metrics['disk']['used'],
-            metrics['disk']['total'],
-            metrics['disk']['percentage'],
-            metrics.get('temperature', 0.0),
-            metrics.get('uptime', 0.0),
-            metrics.get('throttled'),
-            json.dumps(metrics.get('voltages', {})),
-            amperage,
+def claim_sequence(cursor, device_id, column, sequence):
+    """
+    Advance the sequence number a transport stored for a device
+    (devices.stream_seq or devices.udp_seq). Returns False if the stored
+    one is not below `sequence`, i.e. the sample was stored before. The
+    update takes the write lock first, which makes the check and the
+    insert of the sample in the same transaction atomic with respect to
+    every other connection and worker.
+    """
+    cursor.execute(f'''
+        UPDATE devices SET {column} = ? WHERE id = ? AND {column} < ?
+    ''', (sequence, device_id, sequence))
+    return cursor.rowcount == 1
+
+
+def insert_sample(cursor, device_id, metrics):
+    """Insert the stats row of a sample and its per-interface and
+    per-process rows; returns the stats id."""
+    amperage = metrics.get('voltages', {}).pop('amperage', None)
+
+    cursor.execute('''INSERT INTO stats (
+                device_id, cpu_usage, cpu_frequency, memory_used,
+                memory_percentage, disk_used, disk_percentage,
+                temperature, uptime, throttled, voltages, amperage
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (
+        device_id,
+        metrics['cpu']['usage'],
+        parse_frequency(metrics['cpu'].get('frequency')),
+        metrics['memory']['used'],
+        metrics['memory']['percentage'],
+        metrics['disk']['used'],
+        metrics['disk']['percentage'],
+        metrics.get('temperature', 0.0),
+        metrics.get('uptime', 0.0),
+        metrics.get('throttled'),
+        dumps_text(metrics.get('voltages', {})),
+        amperage,
+    ))
+
+    stats_id = cursor.lastrowid
+
+    for iface, iface_stats in metrics['network']['interfaces'].items():
+        cursor.execute('''INSERT OR REPLACE INTO network_stats (
+                    stats_id, interface_id, bytes_sent, bytes_recv,
+                    packets_sent, packets_recv
+                    ) VALUES (?, ?, ?, ?, ?, ?)''', (
+            stats_id,
+            get_interface_id(cursor, device_id, iface, iface_stats),
+            iface_stats['bytes_sent'],
+            iface_stats['bytes_recv'],
+            iface_stats['packets_sent'],
+            iface_stats['packets_recv'],
         ))
 
-        stats_id = cursor.lastrowid
-
-        for iface, iface_stats in metrics['network']['interfaces'].items():
-            cursor.execute('''INSERT INTO network_stats (
-                        stats_id, interface_name, bytes_sent, bytes_recv,
-                        packets_sent, packets_recv, speed, mtu, is_up,
-                        addresses
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (
-                stats_id,
-                iface,
-                iface_stats['bytes_sent'],
-                iface_stats['bytes_recv'],
-                iface_stats['packets_sent'],
-                iface_stats['packets_recv'],
-                iface_stats['speed'],
-                iface_stats['mtu'],
-                iface_stats['is_up'],
-                json.dumps(iface_stats.get('addresses', []))
-            ))
-
-        cursor.execute(
-            'UPDATE devices SET last_seen = ? WHERE id = ?',
-            (datetime.now(timezone.utc), device_id)
-        )
-
-        conn.commit()
-    except sqlite3.Error as e:
-        conn.rollback()
-        return jsonify({'error': f'Database error: {e}'}), 500
+    for process in metrics.get('processes') or ():
+        cursor.execute('''INSERT OR REPLACE INTO process_stats (
+                    stats_id, pid, name_id, cpu_percent, rss_mb
+                    ) VALUES (?, ?, ?, ?, ?)''', (
+            stats_id,
+            process['pid'],
+            get_process_name_id(cursor, process['name']),
+            process.get('cpu_percent'),
+            process.get('rss_mb'),
+        ))
+    return stats_id
+
+
+def insert_disk_stats(cursor, stats_id, disks):
+    """Insert the per-disk and per-mount rows of a sample."""
+    for name, disk in (disks.get('devices') or {}).items():
+        cursor.execute('''INSERT OR REPLACE INTO disk_stats (
+                    stats_id, disk_id, read_bps, write_bps, read_iops,
+                    write_iops, busy_percent
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?)''', (
+            stats_id,
+            get_disk_name_id(cursor, name),
+            disk.get('read_bps'),
+            disk.get('write_bps'),
+            disk.get('read_iops'),
+            disk.get('write_iops'),
+            disk.get('busy_percent'),
+        ))
+    for path, mount in (disks.get('mounts') or {}).items():
+        cursor.execute('''INSERT OR REPLACE INTO mount_stats (
+                    stats_id, mount_id, total, used, percentage
+                    ) VALUES (?, ?, ?, ?, ?)''', (
+            stats_id,
+            get_disk_name_id(cursor, path),
+            mount.get('total'),
+            mount.get('used'),
+            mount.get('percentage'),
+        ))
 
-    return jsonify({'status': 'success'}), 201
 
+def insert_client_stats(cursor, stats_id, client_stats):
+    """Insert the overhead the client reported with a sample."""
+    cursor.execute('''INSERT INTO client_stats (
+                stats_id, cpu_percent, cpu_seconds, rss_mb,
+                collect_ms, send_ms, probe_ms
+                ) VALUES (?, ?, ?, ?, ?, ?, ?)''', (
+        stats_id,
+        client_stats.get('cpu_percent'),
+        client_stats.get('cpu_seconds'),
+        client_stats.get('rss_mb'),
+        client_stats.get('collect_ms'),
+        client_stats.get('send_ms'),
+        dumps_text(client_stats.get('probe_ms') or {}),
+    ))
+
+
+def ingest_sample(device_id, metrics, report_interval=None, sequence=None,
+                  sequence_column='stream_seq'):
+    """
+    Store one sample and feed it to liveness tracking and alerting.
 
-@app.route('/api/history/<int:device_id>')
-def api_history(device_id):
-    """Return recent historical points for a specific device."""
-    conn = get_db_conn()
-    c = conn.cursor()
+    This is the storage path of every ingest transport. Returns a
+    JSON-ready body and an HTTP status; samples shed by admission control
+    get 429/503 and a retry_after in seconds. With a sequence number, a
+    sample at or below the device's stored one (in sequence_column) is a
+    resend or a replay and is skipped with status 200.
+    """
+    values = alert_values(metrics)
 
     try:
-        c.execute('''
-            SELECT timestamp, cpu_usage, cpu_frequency, memory_percentage,
-                   disk_percentage, temperature, voltages, uptime, amperage
-            FROM stats
-            WHERE device_id = ?
-            ORDER BY timestamp DESC
-            LIMIT 100
-        ''', (device_id,))
-        rows = c.fetchall()
-    except:
-        rows = []
-
-    history = [dict(row) for row in rows]
-    return jsonify(history)
-
-
-@app.route('/api/latest/<int:device_id>')
-def api_latest(device_id):
-    """Return the latest metrics for a specific device."""
+        admission.enter(device_id)
+    except Rejected as e:
+        return {'error': e.reason, 'retry_after': e.retry_after}, e.status
+
+    now = datetime.now(timezone.utc)
     conn = get_db_conn()
-    c = conn.cursor()
+    cursor = conn.cursor()
 
     try:
-        c.execute('''
-            SELECT s.*, d.device_name, d.hostname, d.ip_address, s.amperage
-            FROM stats s
-            JOIN devices d ON s.device_id = d.id
-            WHERE s.device_id = ?
-            ORDER BY s.timestamp DESC
-            LIMIT 1
-        ''', (device_id,))
-        latest = c.fetchone()
-
-        if not latest:
-            return jsonify({'error': 'No data for this device'}), 404
-
-        latest_dict = dict(latest)
-
-        c.execute('''
-            SELECT interface_name,
-                   bytes_sent,
-                   bytes_recv,
-                   packets_sent,
-                   packets_recv,
-                   speed
-            FROM network_stats
-            WHERE stats_id = ?
-        ''', (latest_dict['id'],))
-        network_rows = c.fetchall()
-        network_stats = {
-            row['interface_name']: dict(row) for row in network_rows
-        }
-        latest_dict['network_stats'] = network_stats
-
-        return jsonify(latest_dict)
-    except sqlite3.Error:
-        return jsonify({'error': 'Database error occurred'}), 500
+        ensure_liveness_tracking(conn)
+        if registry.get(conn, device_id) is None:
+            admission.forget(device_id)
+            return {'error': 'Device not registered'}, 404
+
+        if sequence is not None and not claim_sequence(
+                cursor, device_id, sequence_column, sequence):
+            conn.rollback()
+            return {'status': 'duplicate'}, 200
+
+        stats_id = insert_sample(cursor, device_id, metrics)
+        insert_disk_stats(cursor, stats_id, metrics.get('disks') or {})
+        if metrics.get('client_stats'):
+            insert_client_stats(cursor, stats_id, metrics['client_stats'])
+
+        record_sample(cursor, device_id, values, now.timestamp())
+
+        # The devices row is only written when a static value changed;
+        # last_seen is written by the registry's periodic flush.
+        device_values = {'memory_total': metrics['memory']['total'],
+                         'disk_total': metrics['disk']['total']}
+        if report_interval is not None:
+            device_values['report_interval'] = report_interval
+        changes = registry.changes(device_id, device_values)
+        if changes:
+            registry.update(cursor, device_id, changes)
+
+        registry.commit(conn)
+    except sqlite3.Error as e:
+        registry.rollback(conn)
+        return {'error': f'Database error: {e}'}, 500
+    finally:
+        admission.leave()
+        conn.close()
+
+    registry.touch(device_id, now)
+    liveness_tracker.observe(device_id, interval=report_interval)
+    alert_engine.observe(device_id, values)
+
+    return {'status': 'success'}, 201
+
+
+ingest_listeners = IngestListeners(config, SERVER_VERSION, ingest_sample,
+                                   get_db_conn)
+ingest_listeners.init_app(app)
+
+
+@app.route('/api/profiling')
+def api_profiling():
+    """
+    Write the collected profiles now and return the profiling counters of
+    the worker answering.
+    """
+    if not profiling_requested():
+        return jsonify({'error': 'Profiling is not enabled'}), 404
+    request_profiler.flush()
+    return jsonify({
+        'mode': request_profiler.mode,
+        'directory': request_profiler.directory,
+        'requests': dict(request_profiler.requests),
+        'skipped': request_profiler.skipped,
+    })
+
+
+@app.route('/api/registry/stats')
+def api_registry_stats():
+    """Return the device registry counters of the worker answering."""
+    return jsonify(registry.stats())
+
+
+@app.route('/api/cache/stats')
+def api_cache_stats():
+    """Return the query cache counters of the worker answering."""
+    return jsonify(query_cache.stats())
+
+
+def delete_archived(conn, condition, params):
+    """
+    Delete the archive blocks matching a condition together with the
+    per-sample detail (DETAIL_TABLES) of their samples. Returns the number
+    of samples deleted.
+    """
+    ids = [(stats_id,) for stats_id in block_ids(conn, condition, params)]
+    for table in DETAIL_TABLES:
+        conn.executemany(f"DELETE FROM {table} WHERE stats_id = ?", ids)
+    conn.execute(f"DELETE FROM stats_blocks WHERE {condition}", params)
+    return len(ids)
 
 
 def prune_old_stats(conn):
@@ -286,10 +643,31 @@ def prune_old_stats(conn):
         )
         deleted_net_stats = c.rowcount
 
+        c.execute(
+            """DELETE FROM client_stats
+             WHERE stats_id IN (SELECT id FROM stats
+                                WHERE timestamp < ?)""",
+            (cutoff_date,)
+        )
+        for table in ('process_stats', 'disk_stats', 'mount_stats'):
+            c.execute(
+                f"""DELETE FROM {table}
+                 WHERE stats_id IN (SELECT id FROM stats
+                                    WHERE timestamp < ?)""",
+                (cutoff_date,)
+            )
+
         c.execute("DELETE FROM stats WHERE timestamp < ?", (cutoff_date,))
         deleted_stats = c.rowcount
+        # Blocks go once all of their samples are past the retention.
+        deleted_stats += delete_archived(
+            conn, 'block_end <= ?', (int(cutoff_date.timestamp()),))
+
+        c.execute("DELETE FROM metric_sketches WHERE bucket_start < ?",
+                  (int(cutoff_date.timestamp()),))
 
         conn.commit()
+        query_cache.clear()
         app.logger.info(f"""Pruned {deleted_stats} records from 'stats' and
                         {deleted_net_stats} records from 'network_stats'.""")
 
@@ -331,15 +709,48 @@ def prune_inactive_devices(conn):
                                    WHERE device_id IN ({placeholders}))""",
             inactive_ids
         )
+        c.execute(
+            f"""DELETE FROM client_stats
+                WHERE stats_id IN (SELECT id
+                                   FROM stats
+                                   WHERE device_id IN ({placeholders}))""",
+            inactive_ids
+        )
+        for table in ('process_stats', 'disk_stats', 'mount_stats'):
+            c.execute(
+                f"""DELETE FROM {table}
+                    WHERE stats_id IN (SELECT id
+                                       FROM stats
+                                       WHERE device_id IN ({placeholders}))""",
+                inactive_ids
+            )
         c.execute(
             f"DELETE FROM stats WHERE device_id IN ({placeholders})",
             inactive_ids
         )
+        c.execute(
+            f"DELETE FROM interfaces WHERE device_id IN ({placeholders})",
+            inactive_ids
+        )
+        c.execute(
+            f"DELETE FROM metric_sketches WHERE device_id IN ({placeholders})",
+            inactive_ids
+        )
+        c.execute(
+            f"DELETE FROM alert_state WHERE device_id IN ({placeholders})",
+            inactive_ids
+        )
+        delete_archived(conn, f"device_id IN ({placeholders})", inactive_ids)
         c.execute(
             f"DELETE FROM devices WHERE id IN ({placeholders})", inactive_ids
         )
+        registry.remove(c, inactive_ids)
 
-        conn.commit()
+        registry.commit(conn)
+        for device_id in inactive_ids:
+            liveness_tracker.forget(device_id)
+            alert_engine.forget_device(device_id)
+            admission.forget(device_id)
         app.logger.info(
             f"Successfully pruned {len(inactive_ids)} inactive device(s)."
         )
@@ -348,13 +759,14 @@ def prune_inactive_devices(conn):
         app.logger.error(
             f"An error occurred while pruning inactive devices: {e}"
         )
-        conn.rollback()
+        registry.rollback(conn)
 
 
 def cleanup_loop():
     """Endless loop that runs cleanup tasks periodically."""
     while True:
         app.logger.info("DB cleanup thread waking up.")
+        profile = request_profiler.start('cleanup') if PROFILE_ALL else None
         conn = get_db_conn()
         if conn:
             try:
@@ -362,11 +774,52 @@ def cleanup_loop():
                 prune_inactive_devices(conn)
             finally:
                 conn.close()
+                request_profiler.stop(profile)
 
         # Sleep for 24 hours
         time.sleep(24 * 60 * 60)
 
 
+def compact_stats():
+    """Move the samples older than the configured age into blocks."""
+    conn = get_db_conn()
+    try:
+        archived = compact(
+            conn,
+            time.time() - archive_config.get(
+                'after_hours', ARCHIVE_AFTER_HOURS) * 3600,
+            archive_config.get('block_seconds', BLOCK_SECONDS)
+        )
+    except sqlite3.Error as e:
+        app.logger.error(f"An error occurred while archiving stats: {e}")
+        return 0
+    finally:
+        conn.close()
+    if archived:
+        app.logger.info(f"Archived {archived} samples.")
+    return archived
+
+
+def compaction_loop():
+    """Endless loop that archives aged samples once per block."""
+    while True:
+        compact_stats()
+        time.sleep(archive_config.get('block_seconds', BLOCK_SECONDS))
+
+
+def start_compactor():
+    """
+    Start the background compactor, once per process, unless archiving is
+    disabled. Several processes may run it: each block is written under
+    the database write lock.
+    """
+    if compactor_started.is_set() or not archive_config.get('enabled', True):
+        return
+    compactor_started.set()
+    threading.Thread(target=compaction_loop, daemon=True,
+                     name='compactor').start()
+
+
 def start_cleanup_thread():
     """Start the background cleanup thread."""
     cleanup_thread = threading.Thread(target=cleanup_loop, daemon=True)
@@ -376,9 +829,11 @@ def start_cleanup_thread():
 
 if __name__ == '__main__':
     start_cleanup_thread()
+    start_compactor()
+    ingest_listeners.start()
     app.run(
         host='0.0.0.0',
-        port=5000,
+        port=PORT,
         debug=False,
         threaded=True
     )
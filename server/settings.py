@@ -0,0 +1,20 @@
+"""
+Configuration shared by the server and the cluster router.
+
+Both read server_config.json next to this file; a missing file means
+the defaults.
+"""
+import json
+import os
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+CONFIG_PATH = os.path.join(BASE_PATH, 'server_config.json')
+
+
+def load_config(path=CONFIG_PATH):
+    """Return the parsed configuration file, or {} if there is none."""
+    try:
+        with open(path, 'r', encoding="UTF-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
@@ -0,0 +1,58 @@
+"""
+Helpers for running the server as several ingest shards.
+
+Devices are placed on shards by consistent hashing of their `device_uid`,
+so adding a shard only moves the share of new registrations that land on
+it. Each shard allocates device ids from its own range (the shard index
+in the high bits), which lets the query router find the shard owning any
+device id without a lookup table.
+"""
+import bisect
+import hashlib
+from dataclasses import dataclass
+
+# Device ids of shard n start above n << SHARD_ID_BITS. 2**32 devices per
+# shard and up to 2**21 shards keep ids below 2**53, so they stay exact in
+# JavaScript.
+SHARD_ID_BITS = 32
+VIRTUAL_NODES = 64
+
+
+def _hash(key):
+    return int.from_bytes(
+        hashlib.md5(key.encode('utf-8')).digest()[:8], 'big'
+    )
+
+
+@dataclass
+class HashRing:
+    """Consistent hash ring with virtual nodes."""
+    nodes: list
+    virtual_nodes: int = VIRTUAL_NODES
+
+    def __post_init__(self):
+        self.nodes = list(self.nodes)
+        if not self.nodes:
+            raise ValueError('A hash ring needs at least one node')
+        ring = sorted(
+            (_hash(f'{node}#{replica}'), node)
+            for node in self.nodes
+            for replica in range(self.virtual_nodes)
+        )
+        self._points = [point for point, _ in ring]
+        self._owners = [node for _, node in ring]
+
+    def node_for(self, key):
+        """Return the node that owns a key."""
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[index]
+
+
+def first_device_id(shard_index):
+    """Return the value device ids of a shard are allocated after."""
+    return shard_index << SHARD_ID_BITS
+
+
+def shard_of_device(device_id):
+    """Return the index of the shard that allocated a device id."""
+    return int(device_id) >> SHARD_ID_BITS
@@ -0,0 +1,182 @@
+"""
+Mergeable quantile sketches for percentile queries.
+
+Ingest adds every sample to a DDSketch per device, metric and fixed time
+bucket. A DDSketch maps each value to a logarithmically sized bin, so any
+quantile it returns is within RELATIVE_ACCURACY of the true value, and two
+sketches merge by adding bin counts. A percentile over an arbitrary window
+is answered by merging the window's bucket sketches, at a cost that depends
+on the number of buckets rather than the number of samples.
+"""
+import json
+import math
+
+RELATIVE_ACCURACY = 0.01
+BUCKET_SECONDS = 900
+
+# Values closer to zero than this are counted in the zero bin.
+MIN_INDEXABLE_VALUE = 1e-9
+
+SKETCH_METRICS = (
+    'cpu_usage', 'memory_percentage', 'disk_percentage', 'temperature'
+)
+
+
+class DDSketch:
+    """
+    Quantile sketch with relative-error guarantees (DDSketch).
+
+    Values near zero are counted in the zero bin, which holds whatever
+    the positive and negative bins do not.
+    """
+
+    __slots__ = ('relative_accuracy', 'positive', 'negative', 'count', 'min',
+                 'max', 'sum')
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.positive = {}
+        self.negative = {}
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sum = 0.0
+
+    @property
+    def gamma(self):
+        """The ratio between the bounds of a bin."""
+        return (1 + self.relative_accuracy) / (1 - self.relative_accuracy)
+
+    @property
+    def zero_count(self):
+        """The number of values in the zero bin."""
+        return (self.count - sum(self.positive.values())
+                - sum(self.negative.values()))
+
+    def _key(self, value):
+        return math.ceil(math.log(value, self.gamma))
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        """Add a value to the sketch."""
+        if value > MIN_INDEXABLE_VALUE:
+            key = self._key(value)
+            self.positive[key] = self.positive.get(key, 0) + count
+        elif value < -MIN_INDEXABLE_VALUE:
+            key = self._key(-value)
+            self.negative[key] = self.negative.get(key, 0) + count
+        self.count += count
+        self.sum += value * count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Add the contents of another sketch with the same accuracy."""
+        if other.gamma != self.gamma:
+            raise ValueError('Cannot merge sketches of different accuracy')
+        for key, count in other.positive.items():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in other.negative.items():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Return the approximate q-quantile (0 <= q <= 1), or None if the
+        sketch is empty."""
+        if not 0 <= q <= 1:
+            raise ValueError('Quantiles must be between 0 and 1')
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return max(-self._value(key), self.min)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return min(self._value(key), self.max)
+        return self.max
+
+    def to_json(self):
+        """Serialize the sketch for storage."""
+        return json.dumps({
+            'a': self.relative_accuracy,
+            'p': self.positive,
+            'n': self.negative,
+            'z': self.zero_count,
+            'c': self.count,
+            'min': self.min,
+            'max': self.max,
+            's': self.sum,
+        }, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        """Load a sketch stored with to_json()."""
+        data = json.loads(text)
+        sketch = cls(data['a'])
+        sketch.positive = {int(k): v for k, v in data['p'].items()}
+        sketch.negative = {int(k): v for k, v in data['n'].items()}
+        sketch.count = data['c']
+        sketch.min = data['min']
+        sketch.max = data['max']
+        sketch.sum = data['s']
+        return sketch
+
+
+def bucket_start(timestamp):
+    """Return the start (epoch seconds) of the bucket holding a time."""
+    return int(timestamp // BUCKET_SECONDS * BUCKET_SECONDS)
+
+
+def record_sample(cursor, device_id, values, timestamp):
+    """
+    Add one sample's values to the device's sketches for its time bucket.
+
+    Runs inside the ingest transaction after the sample row has been
+    written, so the database write lock is already held and concurrent
+    workers cannot lose each other's updates.
+    """
+    bucket = bucket_start(timestamp)
+    for metric in SKETCH_METRICS:
+        value = values.get(metric)
+        if value is None:
+            continue
+        cursor.execute('''
+            SELECT sketch FROM metric_sketches
+            WHERE device_id = ? AND metric = ? AND bucket_start = ?
+        ''', (device_id, metric, bucket))
+        row = cursor.fetchone()
+        sketch = DDSketch.from_json(row[0]) if row else DDSketch()
+        sketch.add(float(value))
+        cursor.execute('''
+            INSERT OR REPLACE INTO metric_sketches
+            (device_id, metric, bucket_start, sketch)
+            VALUES (?, ?, ?, ?)
+        ''', (device_id, metric, bucket, sketch.to_json()))
+
+
+def window_sketch(conn, device_id, metric, start, end):
+    """
+    Merge the sketches of every bucket overlapping [start, end) (epoch
+    seconds). The window is widened to whole buckets.
+    """
+    sketch = DDSketch()
+    cursor = conn.execute('''
+        SELECT sketch FROM metric_sketches
+        WHERE device_id = ? AND metric = ?
+          AND bucket_start >= ? AND bucket_start < ?
+    ''', (device_id, metric, bucket_start(start), end))
+    for row in cursor:
+        sketch.merge(DDSketch.from_json(row[0]))
+    return sketch
@@ -9,8 +9,12 @@ document.addEventListener('DOMContentLoaded', () => {
     let diskChart = null;
     let tempChart = null;
     let voltageChart = null;
+    // Id of the newest stats row on the charts; later fetches only ask for
+    // rows after it.
+    let historyCursor = null;
 
     const PREFERRED_DEVICE_KEY = 'preferredDeviceId';
+    const HISTORY_WINDOW = 100;
 
     const updateText = (id, value) => {
         const elements = document.getElementsByClassName(id);
@@ -54,16 +58,18 @@ document.addEventListener('DOMContentLoaded', () => {
         updateText('cpu-usage', cpuUsage + ' %');
         updateProgressBar('cpu-bar', cpuUsage);
 
-        let [cpuFreq, _] = (data.cpu_frequency || '0 0').split(' ');
-        cpuFreq = parseFloat(cpuFreq).toFixed(2);
-        let freqUnit = 'MHz';
-        if (cpuFreq >= 1024) {
-            cpuFreq = (cpuFreq / 1024).toFixed(2);
-            freqUnit = 'GHz';
+        let cpuFreq = parseFloat(data.cpu_frequency);
+        if (isNaN(cpuFreq)) {
+            updateText('cpu-frequency', 'N/A');
+        } else {
+            let freqUnit = 'MHz';
+            if (cpuFreq >= 1024) {
+                cpuFreq = cpuFreq / 1024;
+                freqUnit = 'GHz';
+            }
+            updateText('cpu-frequency', cpuFreq.toFixed(2) + ' ' + freqUnit);
         }
 
-        updateText('cpu-frequency', cpuFreq + ' ' + freqUnit || 'N/A');
-
         const memPerc = parseFloat(data.memory_percentage).toFixed(1);
         updateText('memory-usage', memPerc + ' %');
         updateProgressBar('memory-bar', memPerc);
@@ -116,6 +122,29 @@ document.addEventListener('DOMContentLoaded', () => {
         document.getElementById('amperage').textContent = data.amperage ? data.amperage.toFixed(3) + ' A' : 'N/A';
         
         updateNetworkStats(data.network_stats);
+        updateClientStats(data.client_stats);
+    };
+
+    const formatMs = (value) => value == null ? 'N/A' : value.toFixed(1) + ' ms';
+
+    const updateClientStats = (stats) => {
+        if (!stats) {
+            ['client-cpu', 'client-rss', 'client-collect', 'client-send',
+             'client-slowest-probe'].forEach(id => updateText(id, 'N/A'));
+            return;
+        }
+        updateText('client-cpu', stats.cpu_percent == null ? 'N/A' : stats.cpu_percent.toFixed(2) + ' %');
+        updateText('client-rss', stats.rss_mb == null ? 'N/A' : stats.rss_mb.toFixed(1) + ' MB');
+        updateText('client-collect', formatMs(stats.collect_ms));
+        updateText('client-send', formatMs(stats.send_ms));
+
+        const probes = Object.entries(stats.probe_ms || {});
+        if (probes.length) {
+            const [name, ms] = probes.reduce((a, b) => (b[1] > a[1] ? b : a));
+            updateText('client-slowest-probe', `${name} (${formatMs(ms)})`);
+        } else {
+            updateText('client-slowest-probe', 'N/A');
+        }
     };
 
     const updateNetworkStats = (interfaces) => {
@@ -270,23 +299,23 @@ document.addEventListener('DOMContentLoaded', () => {
         tempChart = createOrUpdateChart(tempChart, 'temp-chart', labels, datasets, options);
     };
 
+    const getVoltageProperty = (data, property) => {
+        if (!data.voltages) return null;
+        let voltageObj = data.voltages;
+        if (typeof voltageObj === 'string') {
+            try {
+                voltageObj = JSON.parse(voltageObj);
+            } catch (e) {
+                console.error(`Error parsing voltage string: ${voltageObj}`, e);
+                return null;
+            }
+        }
+        return voltageObj ? voltageObj[property] : null;
+    };
+
     const updateVoltageChart = (historyData) => {
         const labels = historyData.map(d => new Date(d.timestamp + 'Z').toLocaleTimeString()).reverse();
 
-        const getVoltageProperty = (data, property) => {
-            if (!data.voltages) return null;
-            let voltageObj = data.voltages;
-            if (typeof voltageObj === 'string') {
-                try {
-                    voltageObj = JSON.parse(voltageObj);
-                } catch (e) {
-                    console.error(`Error parsing voltage string: ${voltageObj}`, e);
-                    return null;
-                }
-            }
-            return voltageObj ? voltageObj[property] : null;
-        };
-
         const voltageData = {
             core: historyData.map(d => getVoltageProperty(d, 'core')).reverse(),
             sdram_c: historyData.map(d => getVoltageProperty(d, 'sdram_c')).reverse(),
@@ -316,24 +345,100 @@ document.addEventListener('DOMContentLoaded', () => {
         updateVoltageChart(historyData);
     };
 
+    const timeLabel = (row) => new Date(row.timestamp + 'Z').toLocaleTimeString();
+
+    // Values of each dataset of each chart, in dataset order.
+    const chartSeries = () => [
+        [cpuChart, [d => d.cpu_usage]],
+        [memoryChart, [d => d.memory_percentage]],
+        [diskChart, [d => d.disk_percentage]],
+        [tempChart, [d => d.temperature]],
+        [voltageChart, [
+            d => getVoltageProperty(d, 'core'),
+            d => getVoltageProperty(d, 'sdram_c'),
+            d => getVoltageProperty(d, 'sdram_i'),
+            d => getVoltageProperty(d, 'sdram_p'),
+            d => d.amperage,
+        ]],
+    ];
+
+    // Append new rows (oldest first) to the charts and drop the points that
+    // fall out of the window, instead of rebuilding every dataset.
+    const appendToCharts = (rows) => {
+        const labels = rows.map(timeLabel);
+        for (const [chart, extractors] of chartSeries()) {
+            if (!chart) continue;
+            chart.data.labels.push(...labels);
+            const excess = Math.max(chart.data.labels.length - HISTORY_WINDOW, 0);
+            chart.data.labels.splice(0, excess);
+            chart.data.datasets.forEach((dataset, i) => {
+                dataset.data.push(...rows.map(extractors[i]));
+                dataset.data.splice(0, excess);
+            });
+            chart.update('none');
+        }
+    };
+
+    // historyData is newest first, as returned by /api/history.
+    const updateHistory = (historyData) => {
+        if (historyCursor === null || historyData.length >= HISTORY_WINDOW) {
+            updateAllCharts(historyData);
+        } else {
+            const newRows = historyData.filter(d => d.id > historyCursor).reverse();
+            if (newRows.length === 0) return;
+            appendToCharts(newRows);
+        }
+        if (historyData.length > 0) {
+            historyCursor = Math.max(historyCursor || 0, historyData[0].id);
+        }
+    };
+
+    const updateConnectionStatus = (statuses) => {
+        const indicator = document.getElementById('connection-status');
+        if (!indicator) return;
+        const liveness = statuses[selectedDeviceId];
+        indicator.classList.remove('status-good', 'status-warning', 'status-critical');
+        if (!liveness || liveness.status === 'unknown') {
+            indicator.classList.add('status-warning');
+            indicator.title = 'Status unknown';
+        } else if (liveness.status === 'online') {
+            indicator.classList.add('status-good');
+            indicator.title = `Online (reports every ${liveness.expected_interval} s)`;
+        } else {
+            indicator.classList.add('status-critical');
+            indicator.title = 'Offline';
+        }
+    };
+
     const fetchData = async () => {
         if (selectedDeviceId === null || selectedDeviceId === undefined) {
             return;
         }
+        const deviceId = selectedDeviceId;
+        const historyUrl = historyCursor === null
+            ? `/api/history/${deviceId}`
+            : `/api/history/${deviceId}?since_id=${historyCursor}`;
         try {
-            const [latestRes, historyRes] = await Promise.all([
-                fetch(`/api/latest/${selectedDeviceId}`),
-                fetch(`/api/history/${selectedDeviceId}`)
+            const [latestRes, historyRes, statusRes] = await Promise.all([
+                fetch(`/api/latest/${deviceId}`),
+                fetch(historyUrl),
+                fetch('/api/devices/status')
             ]);
+            if (statusRes.ok) {
+                updateConnectionStatus(await statusRes.json());
+            }
             if (!latestRes.ok || !historyRes.ok) {
                 console.error('Failed to fetch data for device', selectedDeviceId);
                 return;
             }
             const latestData = await latestRes.json();
             const historyData = await historyRes.json();
-            
+            if (deviceId !== selectedDeviceId) {
+                return;  // the device was switched while this was in flight
+            }
+
             updateLatestMetrics(latestData);
-            updateAllCharts(historyData);
+            updateHistory(historyData);
 
         } catch (error) {
             console.error('Error fetching data:', error);
@@ -382,6 +487,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (updateInterval) {
             clearInterval(updateInterval);
         }
+        historyCursor = null;
         fetchData();
         updateInterval = setInterval(fetchData, 5000);
     };
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Fingerprinted and precompressed dashboard assets.
+
+    python static_assets.py
+
+copies the files in ASSETS from static/ to static/dist/ under names that
+contain a hash of their content (main.js becomes main.<hash>.js), writes
+gzip compressed copies next to them (.gz) and records the names in
+static/dist/manifest.json. Pages link the fingerprinted names, so browsers
+and proxies can cache them forever (Cache-Control: immutable) and pick up
+a new build with the next page load.
+
+Third-party files are committed under static/vendor/ with their licenses
+(Chart.js 4.4.1), so the dashboard loads without internet access. A
+missing source fails the build, and asset_url() raises for it, instead of
+a page that silently depends on a CDN.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+from flask import request, send_from_directory, url_for
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_PATH, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_FILE = 'manifest.json'
+
+# Source files below static/ that are built.
+ASSETS = ('style.css', 'main.js', 'logo.ico', 'vendor/chart.umd.js')
+# Only these are compressed; compressed copies that are not smaller than
+# the original are not kept.
+COMPRESSIBLE = ('.css', '.js', '.ico', '.svg', '.json')
+HASH_LENGTH = 10
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# Content-Encoding -> file suffix of the precompressed copies.
+ENCODINGS = (('gzip', '.gz'),)
+
+
+def fingerprint(name, content):
+    """Return the name of a file with the hash of its content in it."""
+    root, ext = os.path.splitext(name)
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    return f'{root}.{digest}{ext}'
+
+
+def compress(content):
+    """Return the compressed variants of some content: {suffix: bytes}."""
+    variants = {'.gz': gzip.compress(content, 9, mtime=0)}
+    return {suffix: data for suffix, data in variants.items()
+            if len(data) < len(content)}
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def build(static_dir=STATIC_DIR, dist_dir=None):
+    """
+    Build the fingerprinted and compressed copies of ASSETS and return the
+    manifest. Raises FileNotFoundError if a source is missing. Files of
+    earlier builds are removed.
+    """
+    dist_dir = dist_dir or os.path.join(static_dir, 'dist')
+    os.makedirs(dist_dir, exist_ok=True)
+    manifest = {}
+    written = {MANIFEST_FILE}
+    for name in ASSETS:
+        source = os.path.join(static_dir, name)
+        if not os.path.exists(source):
+            raise FileNotFoundError(f'Dashboard asset {source} is missing')
+        with open(source, 'rb') as f:
+            content = f.read()
+        target = fingerprint(name, content)
+        manifest[name] = target
+        _write(os.path.join(dist_dir, target), content)
+        written.add(os.path.normpath(target))
+        if name.endswith(COMPRESSIBLE):
+            for suffix, data in compress(content).items():
+                _write(os.path.join(dist_dir, target + suffix), data)
+                written.add(os.path.normpath(target + suffix))
+
+    for root, _, files in os.walk(dist_dir):
+        for file_name in files:
+            path = os.path.join(root, file_name)
+            if os.path.relpath(path, dist_dir) not in written:
+                os.remove(path)
+    with open(os.path.join(dist_dir, MANIFEST_FILE + '.tmp'), 'w',
+              encoding='UTF-8') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(os.path.join(dist_dir, MANIFEST_FILE + '.tmp'),
+               os.path.join(dist_dir, MANIFEST_FILE))
+    return manifest
+
+
+def load_manifest(dist_dir=DIST_DIR):
+    """Return the manifest of the last build, or {} if there is none."""
+    try:
+        with open(os.path.join(dist_dir, MANIFEST_FILE), 'r',
+                  encoding='UTF-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def init_app(app, dist_dir=DIST_DIR):
+    """
+    Add asset_url() to the templates of a Flask app and serve the built
+    assets with immutable caching, precompressed when the browser accepts
+    it. (Behind nginx or lighttpd the web server serves them itself.)
+    """
+    manifest = load_manifest(dist_dir)
+
+    def asset_url(name):
+        """URL of an asset: its built copy if there is one, else the
+        source file."""
+        if name in manifest:
+            return url_for('dist_asset', filename=manifest[name])
+        if os.path.exists(os.path.join(app.static_folder, name)):
+            return url_for('static', filename=name)
+        raise FileNotFoundError(f'Dashboard asset {name} is missing')
+
+    def dist_asset(filename):
+        """Serve a built asset."""
+        response = None
+        for encoding, suffix in ENCODINGS:
+            if encoding in request.accept_encodings and os.path.isfile(
+                    os.path.join(dist_dir, filename + suffix)):
+                response = send_from_directory(
+                    dist_dir, filename + suffix,
+                    mimetype=mimetypes.guess_type(filename)[0])
+                response.headers['Content-Encoding'] = encoding
+                break
+        if response is None:
+            response = send_from_directory(dist_dir, filename)
+        response.headers['Cache-Control'] = IMMUTABLE
+        response.vary.add('Accept-Encoding')
+        return response
+
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.add_url_rule('/static/dist/<path:filename>', 'dist_asset',
+                     dist_asset)
+    return manifest
+
+
+def main():
+    """Command line entry point."""
+    argparse.ArgumentParser(
+        description='Build the fingerprinted dashboard assets.'
+    ).parse_args()
+    manifest = build()
+    for name, target in sorted(manifest.items()):
+        print(f'{name} -> dist/{target}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,559 @@
+"""
+The read-only stats API: history, latest sample, processes, disks, client
+overhead, percentiles, aggregate queries and exports.
+
+Views that read a range the clients keep polling answer from the query
+cache of the server process.
+"""
+import heapq
+import itertools
+import json
+import math
+import sqlite3
+from datetime import datetime, timezone, timedelta
+from operator import itemgetter
+
+from flask import Response, jsonify, request, stream_with_context
+
+from aggregate import QueryError, align_range, check_options, run_query
+from export import FORMATS, ExportError, check_format, export_stats
+from serialization import encode_object, encode_rows, loads
+from sketches import (
+    BUCKET_SECONDS, SKETCH_METRICS, bucket_start, window_sketch
+)
+from timeutils import parse_time, to_db_timestamp
+from tsblock import STATS_COLUMNS, archived_rows
+
+HISTORY_LIMIT = 100
+HISTORY_COLUMNS = (
+    'id', 'timestamp', 'cpu_usage', 'cpu_frequency', 'memory_percentage',
+    'disk_percentage', 'temperature', 'voltages', 'uptime', 'amperage'
+)
+# Columns stored as JSON text, sent to clients without decoding them.
+RAW_JSON_COLUMNS = ('voltages',)
+# Columns of /api/disks.
+DISK_COLUMNS = ('read_bps', 'write_bps', 'read_iops', 'write_iops',
+                'busy_percent')
+MOUNT_COLUMNS = ('total', 'used', 'percentage')
+
+
+def json_response(body, status=200):
+    """Return already encoded JSON as a response."""
+    return Response(body, status=status, mimetype='application/json')
+
+
+class StatsApi:
+    """
+    Serves the stats API of a Flask app. connect() returns a new database
+    connection; cached_query(conn, key, device_ids, compute, end=None)
+    returns a result from the query cache or computes it.
+    """
+
+    def __init__(self, connect, cached_query):
+        self.connect = connect
+        self.cached_query = cached_query
+
+    def init_app(self, app):
+        """Register the views on a Flask app."""
+        for rule, endpoint, view in (
+            ('/api/history/<int:device_id>', 'api_history', self.history),
+            ('/api/latest/<int:device_id>', 'api_latest', self.latest),
+            ('/api/processes/<int:device_id>', 'api_processes',
+             self.processes),
+            ('/api/disks/<int:device_id>', 'api_disks', self.disks),
+            ('/api/client-stats', 'api_client_stats', self.client_stats),
+            ('/api/percentiles/<int:device_id>', 'api_percentiles',
+             self.percentiles),
+            ('/api/query', 'api_query', self.query),
+            ('/api/export', 'api_export', self.export),
+        ):
+            app.add_url_rule(rule, endpoint, view)
+
+    def history(self, device_id):
+        """
+        Return recent historical points for a specific device, newest first.
+
+        With `since_id` (a stats id) or `since` (a timestamp) only the points
+        recorded after that cursor are returned, so a dashboard that already
+        holds the window only downloads new samples.
+        """
+        conditions = ['device_id = ?']
+        params = [device_id]
+        try:
+            since_id = request.args.get('since_id', type=int)
+            since = parse_time(request.args.get('since'))
+        except ValueError as e:
+            return jsonify({'error': f'Invalid cursor: {e}'}), 400
+        if since_id is not None:
+            conditions.append('id > ?')
+            params.append(since_id)
+        if since is not None:
+            conditions.append('timestamp > ?')
+            params.append(to_db_timestamp(since))
+
+        def compute():
+            c = conn.cursor()
+            c.row_factory = None
+            try:
+                c.execute(f'''
+                    SELECT {', '.join(HISTORY_COLUMNS)}
+                    FROM stats
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT ?
+                ''', params + [HISTORY_LIMIT])
+                rows = c.fetchall()
+            except:
+                rows = []
+            if len(rows) < HISTORY_LIMIT:
+                # A device that has been quiet for a while may only have
+                # archived samples left in the window.
+                archived = archived_rows(
+                    conn, HISTORY_COLUMNS, [device_id],
+                    int(since.timestamp()) + 1 if since is not None else None,
+                    descending=True
+                )
+                if since_id is not None:
+                    archived = itertools.takewhile(
+                        lambda row: row[0] > since_id, archived)
+                rows = list(itertools.islice(
+                    heapq.merge(rows, archived, key=itemgetter(1, 0),
+                                reverse=True),
+                    HISTORY_LIMIT
+                ))
+            return encode_rows(HISTORY_COLUMNS, rows, RAW_JSON_COLUMNS)
+
+        conn = self.connect()
+        try:
+            history = self.cached_query(
+                conn, ('history', device_id, since_id, since), [device_id],
+                compute)
+        except sqlite3.Error:
+            return jsonify({'error': 'Database error occurred'}), 500
+        finally:
+            conn.close()
+        return json_response(history)
+
+    def latest(self, device_id):
+        """Return the latest metrics for a specific device."""
+        def compute():
+            c = conn.cursor()
+            c.execute('''
+                SELECT s.*, d.device_name, d.hostname, d.ip_address,
+                       d.memory_total, d.disk_total
+                FROM stats s
+                JOIN devices d ON s.device_id = d.id
+                WHERE s.device_id = ?
+                ORDER BY s.timestamp DESC
+                LIMIT 1
+            ''', (device_id,))
+            latest = c.fetchone()
+
+            if latest:
+                latest_dict = dict(latest)
+            else:
+                archived = next(archived_rows(conn, STATS_COLUMNS, [device_id],
+                                              descending=True), None)
+                c.execute('''
+                    SELECT device_name, hostname, ip_address, memory_total,
+                           disk_total
+                    FROM devices WHERE id = ?
+                ''', (device_id,))
+                device = c.fetchone()
+                if archived is None or device is None:
+                    return None
+                latest_dict = dict(zip(STATS_COLUMNS, archived))
+                latest_dict.update(dict(device))
+            raw_fields = {column: latest_dict.pop(column)
+                          for column in RAW_JSON_COLUMNS}
+
+            c.execute('''
+                SELECT i.name AS interface_name,
+                       ns.bytes_sent,
+                       ns.bytes_recv,
+                       ns.packets_sent,
+                       ns.packets_recv,
+                       i.speed
+                FROM network_stats ns
+                JOIN interfaces i ON i.id = ns.interface_id
+                WHERE ns.stats_id = ?
+            ''', (latest_dict['id'],))
+            network_rows = c.fetchall()
+            network_stats = {
+                row['interface_name']: dict(row) for row in network_rows
+            }
+            latest_dict['network_stats'] = network_stats
+
+            c.execute('''
+                SELECT cpu_percent, cpu_seconds, rss_mb, collect_ms, send_ms,
+                       probe_ms
+                FROM client_stats
+                WHERE stats_id = ?
+            ''', (latest_dict['id'],))
+            client_stats = c.fetchone()
+            if client_stats:
+                client_stats = dict(client_stats)
+                client_stats['probe_ms'] = loads(client_stats['probe_ms'])
+            latest_dict['client_stats'] = client_stats
+            return encode_object(latest_dict, raw_fields)
+
+        conn = self.connect()
+        try:
+            latest = self.cached_query(conn, ('latest', device_id),
+                                       [device_id], compute)
+        except sqlite3.Error:
+            return jsonify({'error': 'Database error occurred'}), 500
+        finally:
+            conn.close()
+
+        if latest is None:
+            return jsonify({'error': 'No data for this device'}), 404
+        return json_response(latest)
+
+    def processes(self, device_id):
+        """
+        Return the top processes of a device.
+
+        Without a window these are the processes of the latest sample that
+        has any. With `start` and/or `end` every process seen in the window is
+        summarised by name, busiest first; `limit` caps the list (default 10).
+        """
+        try:
+            start = parse_time(request.args.get('start'))
+            end = parse_time(request.args.get('end'))
+            limit = request.args.get('limit', 10, type=int)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid query: {e}'}), 400
+
+        if start is None and end is None:
+            def compute():
+                sample = conn.execute('''
+                    SELECT s.id, s.timestamp FROM stats s
+                    WHERE s.device_id = ? AND EXISTS (
+                        SELECT 1 FROM process_stats p WHERE p.stats_id = s.id)
+                    ORDER BY s.timestamp DESC, s.id DESC
+                    LIMIT 1
+                ''', (device_id,)).fetchone()
+                if sample is None:
+                    return {'device_id': device_id, 'timestamp': None,
+                            'processes': []}
+                rows = conn.execute('''
+                    SELECT p.pid, n.name, p.cpu_percent, p.rss_mb
+                    FROM process_stats p
+                    JOIN process_names n ON n.id = p.name_id
+                    WHERE p.stats_id = ?
+                    ORDER BY p.cpu_percent DESC, p.rss_mb DESC
+                ''', (sample['id'],)).fetchall()
+                return {'device_id': device_id,
+                        'timestamp': sample['timestamp'],
+                        'processes': [dict(row) for row in rows]}
+
+            key = ('processes', device_id)
+        else:
+            # Windows reaching up to "now" move with every request and are
+            # not worth caching.
+            key = ('processes', device_id, start, end, limit) if end else None
+            end = end or datetime.now(timezone.utc)
+            start = start or end - timedelta(hours=24)
+
+            def compute():
+                rows = conn.execute('''
+                    SELECT n.name, COUNT(*) AS samples,
+                           ROUND(AVG(p.cpu_percent), 2) AS cpu_percent_avg,
+                           MAX(p.cpu_percent) AS cpu_percent_max,
+                           MAX(p.rss_mb) AS rss_mb_max
+                    FROM stats s
+                    JOIN process_stats p ON p.stats_id = s.id
+                    JOIN process_names n ON n.id = p.name_id
+                    WHERE s.device_id = ? AND s.timestamp BETWEEN ? AND ?
+                    GROUP BY n.name
+                    ORDER BY cpu_percent_avg DESC, rss_mb_max DESC
+                    LIMIT ?
+                ''', (device_id, to_db_timestamp(start), to_db_timestamp(end),
+                      limit)).fetchall()
+                return {'device_id': device_id, 'start': start.isoformat(),
+                        'end': end.isoformat(),
+                        'processes': [dict(row) for row in rows]}
+
+        conn = self.connect()
+        try:
+            result = (self.cached_query(conn, key, [device_id], compute, end)
+                      if key else compute())
+        except sqlite3.Error as e:
+            return jsonify({'error': f'Database error: {e}'}), 500
+        finally:
+            conn.close()
+        return jsonify(result)
+
+    def disks(self, device_id):
+        """
+        Return the disk history of a device over a window (default: the last
+        hour), oldest first: throughput, IOPS and busy % of every disk and the
+        usage of every reported mount point, as a list of values per column
+        with the sample timestamps in `timestamp`.
+        """
+        try:
+            start = parse_time(request.args.get('start'))
+            end = parse_time(request.args.get('end'))
+        except ValueError as e:
+            return jsonify({'error': f'Invalid query: {e}'}), 400
+        key = ('disks', device_id, start, end) if end else None
+        end = end or datetime.now(timezone.utc)
+        start = start or end - timedelta(hours=1)
+
+        def series(table, name_column, columns, timestamps):
+            result = {}
+            rows = conn.execute(f'''
+                SELECT t.stats_id, n.name,
+                       {', '.join('t.' + c for c in columns)}
+                FROM {table} t
+                JOIN disk_names n ON n.id = t.{name_column}
+                WHERE t.stats_id IN (SELECT value FROM json_each(?))
+                ORDER BY t.stats_id
+            ''', (json.dumps(list(timestamps)),))
+            for row in rows:
+                entry = result.setdefault(row['name'], {
+                    column: [] for column in ('timestamp',) + columns})
+                entry['timestamp'].append(timestamps[row['stats_id']])
+                for column in columns:
+                    entry[column].append(row[column])
+            return result
+
+        def compute():
+            rows = conn.execute('''
+                SELECT id, timestamp FROM stats
+                WHERE device_id = ? AND timestamp BETWEEN ? AND ?
+            ''', (device_id, to_db_timestamp(start),
+                  to_db_timestamp(end))).fetchall()
+            timestamps = {row['id']: row['timestamp'] for row in rows}
+            # Archived samples keep their disk rows under their stats ids.
+            timestamps.update(archived_rows(
+                conn, ('id', 'timestamp'), [device_id], start.timestamp(),
+                int(end.timestamp()) + 1))
+            return {
+                'device_id': device_id, 'start': start.isoformat(),
+                'end': end.isoformat(),
+                'disks': series('disk_stats', 'disk_id', DISK_COLUMNS,
+                                timestamps),
+                'mounts': series('mount_stats', 'mount_id', MOUNT_COLUMNS,
+                                 timestamps),
+            }
+
+        conn = self.connect()
+        try:
+            result = (self.cached_query(conn, key, [device_id], compute, end)
+                      if key else compute())
+        except sqlite3.Error as e:
+            return jsonify({'error': f'Database error: {e}'}), 500
+        finally:
+            conn.close()
+        return jsonify(result)
+
+    def client_stats(self):
+        """
+        Return what the monitoring client costs on each device over a window
+        (default: the last 24 hours): its CPU and memory use, the time spent
+        collecting and sending samples and the mean duration of every probe.
+        """
+        try:
+            end = (parse_time(request.args.get('end'))
+                   or datetime.now(timezone.utc))
+            start = (parse_time(request.args.get('start'))
+                     or end - timedelta(hours=24))
+        except ValueError as e:
+            return jsonify({'error': f'Invalid query: {e}'}), 400
+        window = (to_db_timestamp(start), to_db_timestamp(end))
+
+        conn = self.connect()
+        try:
+            totals = conn.execute('''
+                SELECT s.device_id, COUNT(*) AS samples,
+                       AVG(c.cpu_percent) AS cpu_percent_avg,
+                       MAX(c.cpu_percent) AS cpu_percent_max,
+                       AVG(c.rss_mb) AS rss_mb_avg,
+                       MAX(c.rss_mb) AS rss_mb_max,
+                       AVG(c.collect_ms) AS collect_ms_avg,
+                       AVG(c.send_ms) AS send_ms_avg
+                FROM client_stats c
+                JOIN stats s ON s.id = c.stats_id
+                WHERE s.timestamp BETWEEN ? AND ?
+                GROUP BY s.device_id
+            ''', window).fetchall()
+            probes = conn.execute('''
+                SELECT s.device_id, p.key AS probe, AVG(p.value) AS ms
+                FROM client_stats c
+                JOIN stats s ON s.id = c.stats_id,
+                     json_each(c.probe_ms) p
+                WHERE s.timestamp BETWEEN ? AND ?
+                GROUP BY s.device_id, p.key
+            ''', window).fetchall()
+        except sqlite3.Error as e:
+            return jsonify({'error': f'Database error: {e}'}), 500
+        finally:
+            conn.close()
+
+        result = {}
+        for row in totals:
+            entry = {key: round(value, 3) if isinstance(value, float)
+                     else value for key, value in dict(row).items()}
+            entry['probe_ms_avg'] = {}
+            result[entry.pop('device_id')] = entry
+        for row in probes:
+            result[row['device_id']]['probe_ms_avg'][row['probe']] = round(
+                row['ms'], 3)
+        return jsonify(result)
+
+    def percentiles(self, device_id):
+        """
+        Return percentiles of one or more metrics over a window (default: the
+        last 24 hours), merged from the per-bucket quantile sketches.
+
+        Query parameters: metric (comma separated), q (comma separated
+        quantiles, default 0.5,0.95,0.99), start and end.
+        """
+        metrics = request.args.get('metric', 'cpu_usage').split(',')
+        unknown = [metric for metric in metrics
+                   if metric not in SKETCH_METRICS]
+        if unknown:
+            return jsonify({
+                'error': f"Unknown metric '{unknown[0]}', expected one of "
+                         f"{', '.join(SKETCH_METRICS)}"
+            }), 400
+        try:
+            quantiles = [float(q) for q in
+                         request.args.get('q', '0.5,0.95,0.99').split(',')]
+            if not all(0 <= q <= 1 for q in quantiles):
+                raise ValueError('quantiles must be between 0 and 1')
+            end = (parse_time(request.args.get('end'))
+                   or datetime.now(timezone.utc))
+            start = (parse_time(request.args.get('start'))
+                     or end - timedelta(hours=24))
+        except ValueError as e:
+            return jsonify({'error': f'Invalid query: {e}'}), 400
+
+        def compute():
+            result = {}
+            for metric in metrics:
+                sketch = window_sketch(conn, device_id, metric,
+                                       start.timestamp(), end.timestamp())
+                result[metric] = {
+                    'count': sketch.count,
+                    'min': sketch.min if sketch.count else None,
+                    'max': sketch.max if sketch.count else None,
+                    'percentiles': {
+                        f'p{q * 100:g}': sketch.quantile(q) for q in quantiles
+                    },
+                }
+            return result
+
+        # The result only depends on the buckets the window touches, and the
+        # last of them keeps changing until it is over.
+        first_bucket = bucket_start(start.timestamp())
+        buckets_end = (math.ceil(end.timestamp() / BUCKET_SECONDS)
+                       * BUCKET_SECONDS)
+        conn = self.connect()
+        try:
+            result = self.cached_query(
+                conn, ('percentiles', device_id, tuple(metrics),
+                       tuple(quantiles), first_bucket, buckets_end),
+                [device_id], compute,
+                datetime.fromtimestamp(buckets_end, timezone.utc)
+            )
+        except sqlite3.Error as e:
+            return jsonify({'error': f'Database error: {e}'}), 500
+        finally:
+            conn.close()
+
+        return jsonify({
+            'device_id': device_id,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'metrics': result,
+        })
+
+    def query(self):
+        """
+        Aggregate metrics of several devices on a common time grid.
+
+        Query parameters: devices and metrics (comma separated), start and end
+        (default: the last hour), step in seconds (default 60) and agg (mean,
+        min, max or rate).
+        """
+        try:
+            device_ids = [
+                int(device_id) for device_id in
+                request.args.get('devices', '').split(',') if device_id
+            ]
+            metrics = [metric for metric in
+                       request.args.get('metrics', 'cpu_usage').split(',')
+                       if metric]
+            step = request.args.get('step', 60, type=int)
+            end = (parse_time(request.args.get('end'))
+                   or datetime.now(timezone.utc))
+            start = (parse_time(request.args.get('start'))
+                     or end - timedelta(hours=1))
+        except ValueError as e:
+            return jsonify({'error': f'Invalid query: {e}'}), 400
+
+        agg = request.args.get('agg', 'mean')
+        try:
+            check_options(start.timestamp(), end.timestamp(), step, agg)
+        except QueryError as e:
+            return jsonify({'error': str(e)}), 400
+        start, end = align_range(start.timestamp(), end.timestamp(), step)
+        device_ids = sorted(set(device_ids))
+
+        conn = self.connect()
+        try:
+            result = self.cached_query(
+                conn, ('query', tuple(device_ids), tuple(metrics), start, end,
+                       step, agg),
+                device_ids,
+                lambda: run_query(conn, device_ids, metrics, start, end, step,
+                                  agg),
+                datetime.fromtimestamp(end, timezone.utc)
+            )
+        except QueryError as e:
+            return jsonify({'error': str(e)}), 400
+        except sqlite3.Error as e:
+            return jsonify({'error': f'Database error: {e}'}), 500
+        finally:
+            conn.close()
+        return jsonify(result)
+
+    def export(self):
+        """
+        Stream stats for one device (device_id) or the whole fleet over an
+        optional [start, end) range as CSV, NDJSON, Parquet or Arrow.
+        """
+        fmt = request.args.get('format', 'csv')
+        if fmt not in FORMATS:
+            return jsonify({'error': f"Unknown export format '{fmt}'"}), 400
+        device_id = request.args.get('device_id', type=int)
+        try:
+            start = parse_time(request.args.get('start'))
+            end = parse_time(request.args.get('end'))
+        except ValueError as e:
+            return jsonify({'error': f'Invalid time range: {e}'}), 400
+        try:
+            check_format(fmt)
+        except ExportError as e:
+            return jsonify({'error': str(e)}), 501
+
+        def generate():
+            conn = self.connect()
+            try:
+                yield from export_stats(conn, fmt, device_id, start, end)
+            finally:
+                conn.close()
+
+        mimetype, extension = FORMATS[fmt]
+        scope = f'device-{device_id}' if device_id is not None else 'fleet'
+        return Response(
+            stream_with_context(generate()),
+            mimetype=mimetype,
+            headers={
+                'Content-Disposition':
+                    f'attachment; filename="stats-{scope}.{extension}"'
+            }
+        )
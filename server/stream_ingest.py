@@ -0,0 +1,250 @@
+"""
+Optional persistent TCP stream for sample upload.
+
+A client opens one connection and keeps it for as long as it runs, so a
+sample costs only its payload instead of a full HTTP request. Every frame
+is a 4-byte big-endian length followed by a JSON object:
+
+    server -> client  {"challenge": hex}
+    client -> server  {"device_id": id, "version": v, "epoch": e,
+                       "mac": hex HMAC-SHA256(device key, challenge)}
+    server -> client  {"last_seq": n}          (or {"error": ...} and close)
+    client -> server  {"s": seq, "i": report interval, "m": metrics} ...
+    server -> client  {"ack": seq}             (cumulative)
+
+Samples carry increasing sequence numbers within an epoch (one per client
+run). The server stores the last sequence number it has written for a
+device in the same transaction as the sample, so a sample resent after a
+reconnect is never stored twice. Acknowledgements are cumulative and sent
+once per batch of frames that arrived together. When admission control
+sheds a sample, the server acknowledges what it has stored, sends
+retry_after and closes the connection.
+
+Like the UDP listener, every worker process listens on the port with
+SO_REUSEPORT and handles its connections in their own threads.
+"""
+import hashlib
+import hmac
+import itertools
+import logging
+import os
+import socket
+import struct
+import threading
+
+from serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME = 1024 * 1024
+HANDSHAKE_TIMEOUT = 10
+# Connections idle for longer than this are closed.
+IDLE_TIMEOUT = 600
+MAX_CONNECTIONS = 256
+
+
+class ProtocolError(Exception):
+    """Raised when a peer violates the stream protocol."""
+
+
+def encode_frame(message):
+    """Encode a JSON-serializable message as one frame."""
+    payload = dumps(message)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def pop_frames(buffer):
+    """Remove the complete frames at the start of a buffer and return
+    them."""
+    frames = []
+    while len(buffer) >= FRAME_HEADER.size:
+        (length,) = FRAME_HEADER.unpack_from(buffer)
+        if length > MAX_FRAME:
+            raise ProtocolError(f'Frame of {length} bytes is too large')
+        end = FRAME_HEADER.size + length
+        if len(buffer) < end:
+            break
+        try:
+            frames.append(loads(buffer[FRAME_HEADER.size:end]))
+        except ValueError as e:
+            raise ProtocolError(f'Invalid frame: {e}') from e
+        del buffer[:end]
+    return frames
+
+
+def read_batches(sock):
+    """
+    Yield the frames received on a socket, every complete frame received
+    so far at a time, until the peer closes the connection.
+    """
+    buffer = bytearray()
+    while True:
+        frames = pop_frames(buffer)
+        if frames:
+            yield frames
+            continue
+        data = sock.recv(65536)
+        if not data:
+            return
+        buffer += data
+
+
+class StreamListener:
+    """Accepts stream connections and stores the samples they carry."""
+
+    def __init__(self, open_stream, store, key_for, host='0.0.0.0',
+                 port=5002):
+        """
+        open_stream(device_id, version, epoch) returns the last sequence
+        number stored for the device's epoch or raises ProtocolError;
+        store(device_id, sequence, report_interval, metrics) returns the
+        ingest status and body; key_for(device_id) returns the device's
+        key.
+        """
+        self.open_stream = open_stream
+        self.store = store
+        self.key_for = key_for
+        self.address = (host, port)
+        # 'active' is the number of connections being served.
+        self.counters = dict.fromkeys((
+            'connections', 'rejected_connections', 'samples', 'duplicates',
+            'acks', 'shed', 'active'
+        ), 0)
+        self.sock = None
+        self._lock = threading.Lock()
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def handshake(self, conn, batches):
+        """
+        Authenticate a connection; returns (device_id, last_seq, frames),
+        where frames were sent right behind the hello.
+        """
+        challenge = os.urandom(16)
+        conn.sendall(encode_frame({'challenge': challenge.hex()}))
+        frames = next(batches, None)
+        if not frames:
+            raise ProtocolError('Connection closed during handshake')
+        hello = frames[0]
+        try:
+            device_id = int(hello['device_id'])
+            mac = bytes.fromhex(hello['mac'])
+            epoch = str(hello['epoch'])
+        except (KeyError, TypeError, ValueError) as e:
+            raise ProtocolError('Invalid hello') from e
+        expected = hmac.new(self.key_for(device_id), challenge,
+                            hashlib.sha256).digest()
+        if not hmac.compare_digest(mac, expected):
+            raise ProtocolError('Authentication failed')
+        last_seq = self.open_stream(device_id, hello.get('version'), epoch)
+        conn.sendall(encode_frame({'last_seq': last_seq}))
+        return device_id, last_seq, frames[1:]
+
+    def serve(self, conn):
+        """Run one connection until the peer closes it."""
+        batches = read_batches(conn)
+        conn.settimeout(HANDSHAKE_TIMEOUT)
+        try:
+            device_id, acked, frames = self.handshake(conn, batches)
+            conn.settimeout(IDLE_TIMEOUT)
+            if frames:
+                batches = itertools.chain([frames], batches)
+            for frames in batches:
+                acked, retry_after = self._store_batch(device_id, frames,
+                                                       acked)
+                reply = {'ack': acked}
+                if retry_after is not None:
+                    reply['retry_after'] = retry_after
+                conn.sendall(encode_frame(reply))
+                self._count('acks')
+                if retry_after is not None:
+                    return
+        except ProtocolError as e:
+            logger.info('Closing stream connection: %s', e)
+            try:
+                conn.sendall(encode_frame({'error': str(e)}))
+            except OSError:
+                pass
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def _store_batch(self, device_id, frames, acked):
+        """Store a batch of sample frames; returns (acked, retry_after)."""
+        for frame in frames:
+            try:
+                sequence = int(frame['s'])
+                metrics = frame['m']
+            except (KeyError, TypeError, ValueError) as e:
+                raise ProtocolError('Invalid sample frame') from e
+            if sequence <= acked:
+                self._count('duplicates')
+                continue
+            try:
+                body, status = self.store(device_id, sequence, frame.get('i'),
+                                          metrics)
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                raise ProtocolError(f'Invalid sample {sequence}') from e
+            if status in (429, 503):
+                self._count('shed')
+                return acked, body.get('retry_after', 1)
+            if status == 200:
+                self._count('duplicates')
+            elif status == 201:
+                self._count('samples')
+            else:
+                raise ProtocolError(body.get('error', f'Status {status}'))
+            acked = sequence
+        return acked, None
+
+    def stats(self):
+        """Return the listener counters."""
+        with self._lock:
+            return dict(self.counters)
+
+    def start(self):
+        """Bind the socket and start accepting (once per process)."""
+        with self._lock:
+            if self.sock is not None:
+                return
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(self.address)
+            sock.listen()
+            self.sock = sock
+            threading.Thread(target=self._accept_loop, daemon=True,
+                             name='stream-accept').start()
+        logger.info('Listening for sample streams on %s:%s',
+                    *self.address)
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with self._lock:
+                admitted = self.counters['active'] < MAX_CONNECTIONS
+                if admitted:
+                    self.counters['active'] += 1
+            if not admitted:
+                self._count('rejected_connections')
+                conn.close()
+                continue
+            self._count('connections')
+            threading.Thread(target=self._run_connection, args=(conn,),
+                             daemon=True).start()
+
+    def _run_connection(self, conn):
+        try:
+            self.serve(conn)
+        except Exception:
+            logger.exception('Stream connection failed')
+        finally:
+            self._count('active', -1)
@@ -0,0 +1,56 @@
+"""Unit tests for ingest admission control."""
+import unittest
+
+from admission import AdmissionController, Rejected
+
+
+class TestAdmissionController(unittest.TestCase):
+    """Test cases for admission control."""
+
+    def setUp(self):
+        """Set up a controller with small limits."""
+        self.now = 0.0
+        self.controller = AdmissionController(
+            device_rate=0.5, device_burst=2, global_rate=1, global_burst=3,
+            max_concurrent=1, clock=lambda: self.now
+        )
+
+    def admit(self, device_id):
+        """Admit and immediately finish one sample."""
+        self.controller.enter(device_id)
+        self.controller.leave()
+
+    def test_device_rate_limit(self):
+        """Test that a device beyond its burst is told when to retry."""
+        self.admit(1)
+        self.admit(1)
+        with self.assertRaises(Rejected) as caught:
+            self.admit(1)
+        self.assertEqual((caught.exception.status,
+                          caught.exception.retry_after), (429, 2))
+        self.now = 2
+        self.admit(1)
+
+    def test_global_rate_limit(self):
+        """Test that the fleet as a whole is limited."""
+        for device_id in (1, 2, 3):
+            self.admit(device_id)
+        with self.assertRaises(Rejected) as caught:
+            self.admit(4)
+        self.assertEqual(caught.exception.status, 503)
+        self.assertEqual(self.controller.rejected, {429: 0, 503: 1})
+
+    def test_concurrency_limit(self):
+        """Test that writes beyond the concurrency limit are shed."""
+        self.controller.enter(1)
+        with self.assertRaises(Rejected) as caught:
+            self.controller.enter(2)
+        self.assertEqual(caught.exception.status, 503)
+        self.controller.leave()
+        # The shed sample's tokens were given back.
+        self.admit(2)
+        self.admit(2)
+
+
+if __name__ == '__main__':
+    unittest.main()
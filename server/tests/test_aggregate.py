@@ -0,0 +1,83 @@
+"""Unit tests for the aggregation engine."""
+import sqlite3
+import unittest
+from datetime import datetime, timezone
+
+import numpy as np
+
+from aggregate import QueryError, aggregate, run_query
+from create_tables import create_tables
+
+START = int(datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp())
+
+
+class TestAggregate(unittest.TestCase):
+    """Test cases for the aggregation engine."""
+
+    def setUp(self):
+        """Store ten minutes of samples every 20 s for two devices."""
+        self.conn = sqlite3.connect(':memory:')
+        create_tables(self.conn)
+        for device_id, offset in ((1, 0.0), (2, 100.0)):
+            for i in range(30):
+                timestamp = datetime.fromtimestamp(START + 20 * i,
+                                                   timezone.utc)
+                self.conn.execute(
+                    'INSERT INTO stats (device_id, timestamp, cpu_usage, '
+                    'uptime) VALUES (?, ?, ?, ?)',
+                    (device_id, timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                     offset + i, 20 * i)
+                )
+        self.conn.commit()
+
+    def tearDown(self):
+        """Close the database."""
+        self.conn.close()
+
+    def test_mean_and_max_are_aligned(self):
+        """Test bucketing of several devices on one grid."""
+        result = run_query(self.conn, [2, 1], ['cpu_usage'], START + 30,
+                           START + 600, 60, 'mean')
+        self.assertEqual(result['timestamps'],
+                         [START + 60 * i for i in range(10)])
+        series = {s['device_id']: s['values'] for s in result['series']}
+        self.assertEqual(series[1][:2], [1.0, 4.0])
+        self.assertEqual(series[2][-1], 128.0)
+
+        result = run_query(self.conn, [1], ['cpu_usage', 'uptime'], START,
+                           START + 1200, 300, 'max')
+        self.assertEqual([s['values'] for s in result['series']],
+                         [[14.0, 29.0, None, None],
+                          [280.0, 580.0, None, None]])
+
+    def test_rate(self):
+        """Test the per-second rate between consecutive samples."""
+        result = run_query(self.conn, [1, 2], ['uptime'], START, START + 600,
+                           300, 'rate')
+        self.assertEqual([s['values'] for s in result['series']],
+                         [[1.0, 1.0], [1.0, 1.0]])
+
+    def test_nan_values_are_ignored(self):
+        """Test that missing values do not poison a bucket."""
+        _, result = aggregate(
+            np.array([1, 1, 1]), np.array([0, 10, 20]),
+            np.array([[1.0], [np.nan], [3.0]]), [1], 0, 30, 30, 'mean'
+        )
+        self.assertEqual(result.tolist(), [[[2.0]]])
+
+    def test_invalid_queries(self):
+        """Test that bad options raise QueryError."""
+        with self.assertRaises(QueryError):
+            run_query(self.conn, [1], ['voltages'], START, START + 60, 60)
+        with self.assertRaises(QueryError):
+            run_query(self.conn, [1], ['cpu_usage'], START, START + 60, 60,
+                      'median')
+        with self.assertRaises(QueryError):
+            run_query(self.conn, [1], ['cpu_usage'], START, START + 10 ** 8,
+                      1)
+        with self.assertRaises(QueryError):
+            run_query(self.conn, [], ['cpu_usage'], START, START + 60, 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+"""Unit tests for the alerting engine."""
+import mailbox
+import os
+import tempfile
+import unittest
+
+from alerts import (
+    AlertEngine,
+    EmailSink,
+    MissingRule,
+    ThresholdRule,
+    alert_values,
+    build_engine
+)
+
+
+class TestAlertEngine(unittest.TestCase):
+    """Test cases for the alerting engine."""
+
+    def setUp(self):
+        """Set up an engine whose transitions can be inspected."""
+        self.rules = [
+            ThresholdRule('hot', 'temperature', '>', 75, for_seconds=120),
+            ThresholdRule('throttled', 'throttled', 'mask', 0xF),
+            ThresholdRule('busy', 'cpu_usage', '>', 80, window_seconds=30),
+            MissingRule('missing', intervals=3),
+        ]
+        self.engine = AlertEngine(self.rules, [])
+        # Collect notifications instead of starting the delivery thread.
+        self.notified = []
+        self.engine.notify = self.notified.extend
+
+    def transitions(self):
+        """Return (rule, state) pairs of the transitions so far."""
+        return [(a['rule'], a['state'])
+                for a in reversed(self.engine.recent_alerts())]
+
+    def test_threshold_must_hold_for_duration(self):
+        """Test that a threshold only fires once held long enough."""
+        self.engine.observe(1, {'temperature': 80}, now=0)
+        self.engine.observe(1, {'temperature': 80}, now=60)
+        self.assertEqual(self.transitions(), [])
+        self.engine.observe(1, {'temperature': 80}, now=120)
+        self.assertEqual(self.transitions(), [('hot', 'firing')])
+        self.engine.observe(1, {'temperature': 70}, now=130)
+        self.assertEqual(self.transitions(),
+                         [('hot', 'firing'), ('hot', 'resolved')])
+        self.assertEqual(self.engine.active_alerts(), [])
+
+    def test_state_is_per_device(self):
+        """Test that devices do not share sliding-window state."""
+        self.engine.observe(1, {'temperature': 80}, now=0)
+        self.engine.observe(2, {'temperature': 80}, now=100)
+        self.engine.observe(2, {'temperature': 80}, now=150)
+        self.assertEqual(self.transitions(), [])
+        self.engine.observe(1, {'temperature': 80}, now=150)
+        self.assertEqual([a['device_id'] for a in
+                          self.engine.active_alerts()], [1])
+
+    def test_throttle_bits_and_window_average(self):
+        """Test the bit-mask operator and the windowed average."""
+        self.engine.observe(1, {'throttled': 0x50000}, now=0)
+        self.engine.observe(1, {'throttled': 0x50005}, now=10)
+        self.engine.observe(1, {'cpu_usage': 70}, now=0)
+        self.engine.observe(1, {'cpu_usage': 100}, now=10)
+        self.assertEqual(self.transitions(), [('throttled', 'firing'),
+                                              ('busy', 'firing')])
+        self.engine.observe(1, {'cpu_usage': 50}, now=45)
+        self.assertEqual(self.transitions()[-1], ('busy', 'resolved'))
+
+    def test_missing_device(self):
+        """Test that liveness events fire missing rules until a sample."""
+        self.engine.on_liveness_event(
+            {'device_id': 1, 'state': 'missed', 'intervals': 2}, now=20)
+        self.assertEqual(self.transitions(), [])
+        self.engine.on_liveness_event(
+            {'device_id': 1, 'state': 'offline', 'intervals': 3}, now=30)
+        self.engine.on_liveness_event(
+            {'device_id': 1, 'state': 'missed', 'intervals': 3}, now=40)
+        self.assertEqual(self.transitions(), [('missing', 'firing')])
+        self.engine.observe(1, {}, now=41)
+        self.assertEqual(self.transitions()[-1], ('missing', 'resolved'))
+
+    def test_restore(self):
+        """Test that restored alerts keep firing until their condition
+        stops holding."""
+        firing = [{'rule': 'hot', 'device_id': 1, 'state': 'firing',
+                   'value': 80, 'timestamp': '1970-01-01T00:02:00+00:00'},
+                  {'rule': 'gone', 'device_id': 1, 'state': 'firing',
+                   'value': 1, 'timestamp': '1970-01-01T00:02:00+00:00'}]
+        self.engine.restore(firing, firing[:1])
+        self.assertEqual([a['rule'] for a in self.engine.active_alerts()],
+                         ['hot'])
+        self.engine.observe(1, {'temperature': 80}, now=130)
+        self.assertEqual(self.transitions(), [('hot', 'firing')])
+        self.engine.observe(1, {'temperature': 70}, now=140)
+        self.assertEqual(self.transitions(),
+                         [('hot', 'firing'), ('hot', 'resolved')])
+
+    def test_alert_values(self):
+        """Test extracting watched values from a payload."""
+        values = alert_values({'cpu': {'usage': 5.0}, 'throttled': '0x50005',
+                               'temperature': 40.0})
+        self.assertEqual(values['throttled'], 0x50005)
+        self.assertEqual(values['cpu_usage'], 5.0)
+        self.assertIsNone(values['disk_percentage'])
+
+    def test_build_engine_and_email_sink(self):
+        """Test building rules and sinks from configuration."""
+        fd, outbox = tempfile.mkstemp()
+        os.close(fd)
+        engine = build_engine({
+            'rules': [{'name': 'disk', 'metric': 'disk_percentage',
+                       'op': '>', 'value': 90}],
+            'sinks': [{'type': 'email', 'to': 'ops@example.com',
+                       'outbox': outbox}],
+        })
+        engine.notify = self.notified.extend
+        engine.observe(1, {'disk_percentage': 95}, now=0)
+        engine.notifier.deliver(self.notified[0])
+
+        self.assertIsInstance(engine.notifier.sinks[0], EmailSink)
+        box = mailbox.mbox(outbox)
+        self.assertEqual(len(box), 1)
+        self.assertIn('disk firing', box[0]['Subject'])
+        box.close()
+        os.unlink(outbox)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+"""Unit tests for the ASGI entry point."""
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from admission import AdmissionController
+from asgi import EVENTS_PATH, AsgiApp, build_environ
+from create_tables import create_tables
+from liveness import save_events
+from registry import DeviceRegistry
+import server
+
+with open(os.path.join(os.path.dirname(__file__), '..', 'server_config.json'),
+          'r', encoding='UTF-8') as f:
+    SERVER_VERSION = json.load(f).get('version', '0.0.0')
+
+
+def scope_for(method, path, query=b'', headers=()):
+    """Build the ASGI scope of an HTTP request."""
+    return {'type': 'http', 'method': method, 'path': path,
+            'query_string': query, 'headers': list(headers),
+            'http_version': '1.1', 'scheme': 'http',
+            'server': ('testserver', 80), 'client': ('10.0.0.5', 1234)}
+
+
+class TestAsgi(unittest.TestCase):
+    """Test cases for the ASGI entry point."""
+
+    def setUp(self):
+        """Set up a database and an ASGI app."""
+        db_fd, db_path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, db_path)
+        self.addCleanup(os.close, db_fd)
+        server.app.config['DATABASE'] = db_path
+        conn = server.get_db_conn()
+        create_tables(conn)
+        conn.close()
+        admission_patch = patch.object(server, 'admission',
+                                       AdmissionController())
+        admission_patch.start()
+        self.addCleanup(admission_patch.stop)
+        registry = DeviceRegistry(server.get_db_conn)
+        registry_patch = patch.object(server, 'registry', registry)
+        registry_patch.start()
+        self.addCleanup(registry_patch.stop)
+        self.addCleanup(registry.stop)
+
+        self.since = []
+
+        def events(since):
+            self.since.append(since)
+            return server.event_store.device_events(since)
+
+        self.asgi = AsgiApp(server.app, events,
+                            server.event_store.latest_device_event, threads=2)
+        self.addCleanup(self.asgi.executor.shutdown)
+
+    def request(self, method, path, body=b'', query=b'', headers=()):
+        """Send one request; returns (status, headers, body messages)."""
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body,
+                    'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.asgi(scope_for(method, path, query, headers),
+                              receive, send))
+        start, bodies = sent[0], sent[1:]
+        return start['status'], dict(start['headers']), bodies
+
+    def register(self, uid):
+        """Register a device through the ASGI app and return its id."""
+        status, _, bodies = self.request(
+            'POST', '/api/register',
+            json.dumps({'device_uid': uid}).encode(),
+            headers=[(b'content-type', b'application/json'),
+                     (b'x-client-version', SERVER_VERSION.encode())])
+        self.assertEqual(status, 201)
+        return json.loads(bodies[0]['body'])['device_id']
+
+    def test_wsgi_routes(self):
+        """Test that requests reach the Flask views with their bodies."""
+        status, headers, bodies = self.request('GET', '/api/version')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-type'], b'application/json')
+        self.assertEqual(json.loads(bodies[0]['body']),
+                         {'version': SERVER_VERSION})
+
+        device_id = self.register('asgi-uid')
+        status, _, bodies = self.request('GET', '/api/devices')
+        self.assertEqual([d['id'] for d in json.loads(bodies[0]['body'])],
+                         [device_id])
+
+    def test_streamed_response(self):
+        """Test that responses without a length are sent in chunks."""
+        self.register('asgi-uid')
+        status, headers, bodies = self.request('GET', '/api/export',
+                                               query=b'format=csv')
+        self.assertEqual(status, 200)
+        self.assertNotIn(b'content-length', headers)
+        self.assertFalse(bodies[-1].get('more_body'))
+        self.assertTrue(all(m['more_body'] for m in bodies[:-1]))
+        self.assertTrue(b''.join(m['body'] for m in bodies)
+                        .startswith(b'id,device_id'))
+
+    @staticmethod
+    def store_event(device_id, state):
+        """Store a transition the way a server process does."""
+        conn = server.get_db_conn()
+        save_events(conn, [{'device_id': device_id, 'state': state,
+                            'timestamp': '2026-01-01T00:00:00+00:00',
+                            'intervals': 3}])
+        conn.commit()
+        conn.close()
+
+    @patch('asgi.EVENT_POLL_SECONDS', 0.01)
+    def test_event_stream(self):
+        """Test that stored liveness events are pushed as server-sent
+        events."""
+        self.store_event(1, 'offline')
+        sent = []
+
+        async def run():
+            disconnect = asyncio.Event()
+
+            async def receive():
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                if len(sent) == 3:
+                    disconnect.set()
+
+            task = asyncio.ensure_future(self.asgi(
+                scope_for('GET', EVENTS_PATH), receive, send))
+            while len(sent) < 2:
+                await asyncio.sleep(0.01)
+            # Stored by another process.
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.store_event, 1, 'online')
+            await asyncio.wait_for(task, 5)
+
+        asyncio.run(run())
+        self.assertEqual(sent[0]['status'], 200)
+        events = [m['body'].decode() for m in sent[1:]]
+        self.assertIn('"state":"offline"', events[0])
+        self.assertTrue(events[1].startswith('id: 2\nevent: liveness\n'))
+        self.assertIn('"state":"online"', events[1])
+        # Only the backlog is read from the start; the poller begins at
+        # the newest transition stored when the stream opened.
+        self.assertEqual(self.since.count(0), 1)
+
+    def test_build_environ(self):
+        """Test the mapping of ASGI headers to the WSGI environ."""
+        environ = build_environ(scope_for(
+            'POST', '/api/data', b'a=1', [
+                (b'content-type', b'application/json'),
+                (b'x-forwarded-for', b'1.1.1.1'),
+                (b'x-forwarded-for', b'2.2.2.2'),
+            ]), b'{}')
+        self.assertEqual(environ['CONTENT_TYPE'], 'application/json')
+        self.assertEqual(environ['CONTENT_LENGTH'], '2')
+        self.assertEqual(environ['QUERY_STRING'], 'a=1')
+        self.assertEqual(environ['HTTP_X_FORWARDED_FOR'], '1.1.1.1,2.2.2.2')
+        self.assertEqual(environ['REMOTE_ADDR'], '10.0.0.5')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""Unit tests for deadline-based offline detection."""
+import unittest
+
+from liveness import LivenessTracker
+
+
+class TestLivenessTracker(unittest.TestCase):
+    """Test cases for the liveness tracker."""
+
+    def setUp(self):
+        """Set up a tracker with a 10 s default interval and 3 s of grace."""
+        self.tracker = LivenessTracker(grace_intervals=3, default_interval=10)
+        self.seen = []
+        self.tracker.subscribe(self.seen.append)
+
+    def states(self):
+        """Return the (device, state) pairs published so far."""
+        return [(event['device_id'], event['state']) for event in self.seen]
+
+    def test_offline_after_missed_deadline(self):
+        """Test that a device goes offline after its grace period only."""
+        self.tracker.observe(1, now=0)
+        self.tracker.observe(2, now=20)
+        self.assertEqual(self.tracker.advance(now=29), [])
+        self.tracker.advance(now=30)
+        self.assertEqual(self.states(), [(1, 'offline')])
+        self.assertEqual(self.tracker.status(1)['status'], 'offline')
+        self.assertEqual(self.tracker.status(2)['status'], 'online')
+
+        self.tracker.observe(1, now=35)
+        self.assertEqual(self.states(), [(1, 'offline'), (1, 'online')])
+
+    def test_check_in_supersedes_deadline(self):
+        """Test that a check-in re-arms the deadline."""
+        self.tracker.observe(1, now=0)
+        self.tracker.observe(1, now=10)
+        self.tracker.advance(now=35)
+        self.assertEqual(self.states(), [])
+        self.assertEqual(self.tracker.next_deadline(), 40)
+
+    def test_learns_and_accepts_intervals(self):
+        """Test interval learning, outlier rejection and announcements."""
+        for now in (0, 15, 30, 45, 60, 60.1, 60.2, 60.3):
+            self.tracker.observe(1, now=now)
+        self.assertGreater(self.tracker.status(1)['expected_interval'], 12)
+
+        for now in (0, 60, 120, 180):
+            self.tracker.observe(3, now=now)
+        self.assertEqual(self.tracker.status(3)['expected_interval'], 60)
+
+        self.tracker.observe(2, now=0, interval=60)
+        self.tracker.observe(2, now=0.5)
+        self.assertEqual(self.tracker.status(2)['expected_interval'], 60)
+        self.tracker.advance(now=179)
+        self.assertNotIn((2, 'offline'), self.states())
+
+    def test_watched_levels_and_verify(self):
+        """Test extra miss levels and re-arming from another worker."""
+        remote_seen = {1: None}
+        tracker = LivenessTracker(grace_intervals=3, default_interval=10,
+                                  verify=remote_seen.get)
+        tracker.watch(2)
+        events = []
+        tracker.subscribe(events.append)
+
+        tracker.observe(1, now=0)
+        tracker.advance(now=20)
+        self.assertEqual([(e['state'], e['intervals']) for e in events],
+                         [('missed', 2)])
+
+        remote_seen[1] = 25
+        tracker.advance(now=30)
+        self.assertEqual(tracker.status(1)['status'], 'online')
+        tracker.advance(now=55)
+        self.assertEqual(tracker.status(1)['status'], 'offline')
+
+    def test_verify_runs_without_lock(self):
+        """Test that the database is not queried while holding the lock."""
+        locked = []
+
+        def verify(_device_id):
+            locked.append(self.tracker.deadlines.lock.locked())
+
+        self.tracker.verify = verify
+        self.tracker.observe(1, now=0)
+        self.tracker.advance(now=30)
+        self.assertEqual(locked, [False])
+        self.assertEqual(self.states(), [(1, 'offline')])
+
+    def test_seed(self):
+        """Test seeding from stored last_seen values."""
+        self.tracker.clock = lambda: 100
+        self.tracker.seed([(1, 95, None), (2, 0, 10), (3, None, None)])
+        self.assertEqual(self.tracker.status(1)['status'], 'online')
+        self.assertEqual(self.tracker.status(2)['status'], 'offline')
+        self.assertEqual(self.tracker.status(3)['status'], 'unknown')
+        self.assertTrue(self.tracker.seeded)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+"""Unit tests for the query result cache."""
+import unittest
+
+from query_cache import QueryCache
+
+
+class TestQueryCache(unittest.TestCase):
+    """Test cases for the query result cache."""
+
+    def test_watermark_invalidation(self):
+        """Test that open results are only valid for their watermark."""
+        cache = QueryCache()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(cache.get_or_compute('open', compute, (1, 'a')), 1)
+        self.assertEqual(cache.get_or_compute('open', compute, (1, 'a')), 1)
+        self.assertEqual(cache.get_or_compute('open', compute, (1, 'b')), 2)
+        self.assertEqual(cache.get_or_compute('closed', compute), 3)
+        self.assertEqual(cache.get_or_compute('closed', compute), 3)
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'],
+                          stats['invalidations']), (2, 3, 1))
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entry is evicted."""
+        cache = QueryCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+"""Unit tests for the in-memory device registry."""
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from create_tables import create_tables
+from registry import DeviceRegistry
+
+
+class TestDeviceRegistry(unittest.TestCase):
+    """Test cases for the device registry."""
+
+    def setUp(self):
+        """Create a database and two registries, as two workers would."""
+        db_fd, self.db_path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, self.db_path)
+        self.addCleanup(os.close, db_fd)
+        create_tables(db_path=self.db_path)
+        self.registry = DeviceRegistry(self.connect, flush_seconds=60)
+        self.other = DeviceRegistry(self.connect, flush_seconds=60)
+        self.addCleanup(self.registry.stop)
+        self.addCleanup(self.other.stop)
+
+    def connect(self):
+        """Open a connection to the test database."""
+        return sqlite3.connect(self.db_path)
+
+    def add(self, registry, device_uid):
+        """Add a device through a registry."""
+        conn = self.connect()
+        registry.get(conn, 0)
+        device_id = registry.add(conn.cursor(), {
+            'device_uid': device_uid, 'device_name': device_uid
+        }, '2026-01-01 00:00:00')
+        registry.commit(conn)
+        conn.close()
+        return device_id
+
+    def test_lookup_and_changes(self):
+        """Test that devices added elsewhere are found and only changed
+        values are reported."""
+        device_id = self.add(self.other, 'uid-1')
+        conn = self.connect()
+        self.assertEqual(self.registry.find(conn, 'uid-1'), device_id)
+        self.assertIsNone(self.registry.get(conn, device_id + 1))
+        self.assertEqual(
+            self.registry.changes(device_id, {'device_name': 'uid-1',
+                                              'memory_total': 512.0}),
+            {'memory_total': 512.0}
+        )
+        conn.close()
+
+    def test_flush_last_seen(self):
+        """Test that check-ins are written together on flush."""
+        first = self.add(self.registry, 'uid-1')
+        second = self.add(self.registry, 'uid-2')
+        self.registry.touch(first, '2026-01-02 00:00:00')
+        self.registry.touch(second, '2026-01-03 00:00:00')
+        self.registry.touch(first, '2026-01-04 00:00:00')
+        self.assertEqual(self.registry.last_seen(first), '2026-01-04 00:00:00')
+
+        conn = self.connect()
+        rows = conn.execute('SELECT last_seen FROM devices ORDER BY id')
+        self.assertEqual([row[0] for row in rows],
+                         ['2026-01-01 00:00:00'] * 2)
+        self.registry.flush()
+        rows = conn.execute('SELECT last_seen FROM devices ORDER BY id')
+        self.assertEqual([row[0] for row in rows],
+                         ['2026-01-04 00:00:00', '2026-01-03 00:00:00'])
+        conn.close()
+        self.assertIsNone(self.registry.last_seen(first))
+        self.assertEqual(self.registry.stats()['flushes'], 1)
+        self.assertEqual(self.registry.stats()['flushed'], 2)
+
+    def test_reload_on_generation_change(self):
+        """Test that changes made by another worker are picked up."""
+        device_id = self.add(self.registry, 'uid-1')
+        conn = self.connect()
+        self.other.get(conn, device_id)
+        self.other.update(conn.cursor(), device_id, {'disk_total': 32.0})
+        self.other.commit(conn)
+
+        self.assertEqual(self.registry.changes(device_id,
+                                               {'disk_total': 32.0}),
+                         {'disk_total': 32.0})
+        self.registry.flush()
+        self.assertEqual(self.registry.changes(device_id,
+                                               {'disk_total': 32.0}), {})
+
+        # Our own writes do not make us reload.
+        reloads = self.registry.stats()['reloads']
+        self.registry.update(conn.cursor(), device_id, {'disk_total': 64.0})
+        self.registry.commit(conn)
+        self.registry.flush()
+        self.assertEqual(self.registry.stats()['reloads'], reloads)
+
+        self.other.remove(conn.cursor(), [device_id])
+        conn.execute('DELETE FROM devices WHERE id = ?', (device_id,))
+        self.other.commit(conn)
+        self.registry.flush()
+        self.assertIsNone(self.registry.get(conn, device_id))
+        conn.close()
+
+    def test_rollback_keeps_memory(self):
+        """Test that changes of a failed transaction never reach memory."""
+        device_id = self.add(self.registry, 'uid-1')
+        conn = self.connect()
+        self.registry.update(conn.cursor(), device_id, {'disk_total': 32.0})
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.registry.add(conn.cursor(), {'device_uid': 'uid-1'},
+                              '2026-01-01 00:00:00')
+        self.registry.rollback(conn)
+        self.assertEqual(self.registry.changes(device_id,
+                                               {'disk_total': 32.0}),
+                         {'disk_total': 32.0})
+
+        self.registry.add(conn.cursor(), {'device_uid': 'uid-2'},
+                          '2026-01-01 00:00:00')
+        self.registry.rollback(conn)
+        self.assertIsNone(self.registry.find(conn, 'uid-2'))
+        generation = self.registry.stats()['generation']
+        self.assertEqual(self.registry.read_generation(conn), generation)
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
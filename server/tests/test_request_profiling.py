@@ -0,0 +1,88 @@
+"""Unit tests for request profiling and slow-query logging."""
+import os
+import pstats
+import sqlite3
+import tempfile
+import unittest
+
+from request_profiling import (
+    RequestProfiler, StackSampler, TimedConnection, route_filename
+)
+
+
+def busy():
+    """Burn a little CPU."""
+    return sum(i * i for i in range(20000))
+
+
+class TestProfiling(unittest.TestCase):
+    """Test cases for request profiling and slow-query logging."""
+
+    def setUp(self):
+        """Create a directory for profiles."""
+        self.directory = tempfile.mkdtemp()
+
+    def test_cprofile_per_route(self):
+        """Test that profiles of a route are merged into one file."""
+        profiler = RequestProfiler(self.directory, 'cprofile')
+        for _ in range(2):
+            handle = profiler.start('GET /api/latest/<int:device_id>')
+            busy()
+            profiler.stop(handle)
+        profiler.flush()
+        path = os.path.join(self.directory, 'GET_api_latest_int_device_id.prof')
+        stats = pstats.Stats(path)
+        calls = [value[1] for key, value in stats.stats.items()
+                 if key[2] == 'busy']
+        self.assertEqual(calls, [2])
+        self.assertEqual(profiler.requests['GET /api/latest/<int:device_id>'],
+                         2)
+
+    def test_stack_sampler(self):
+        """Test collapsed stack output of the sampler."""
+        sampler = StackSampler()
+        sampler.begin('GET /')
+        sampler.sample()
+        sampler.end()
+        sampler.sample()
+        sampler.write(self.directory, ['GET /'])
+        with open(os.path.join(self.directory, 'GET.folded'),
+                  encoding='UTF-8') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 1)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertEqual(count, '1')
+        self.assertTrue(stack.endswith(
+            'test_request_profiling.py:test_stack_sampler'
+            ';request_profiling.py:sample'))
+
+    def test_route_filename(self):
+        """Test file names of routes."""
+        self.assertEqual(route_filename('GET /'), 'GET')
+        self.assertEqual(route_filename(''), 'root')
+
+    def test_slow_query_log(self):
+        """Test that slow statements are logged with their query plan."""
+        conn = sqlite3.connect(':memory:', factory=TimedConnection)
+        conn.execute('CREATE TABLE stats (id INTEGER PRIMARY KEY, '
+                     'device_id INTEGER)')
+        conn.slow_query_seconds = 0
+        with self.assertLogs('request_profiling', 'WARNING') as logs:
+            conn.execute('SELECT * FROM stats WHERE device_id = ?',
+                         (1,)).fetchall()
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('SELECT * FROM stats WHERE device_id = ?',
+                      logs.output[0])
+        self.assertIn('plan: SCAN stats', logs.output[0])
+
+        conn.slow_query_seconds = 60
+        with self.assertNoLogs('request_profiling', 'WARNING'):
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM stats')
+            cursor.fetchone()
+            cursor.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
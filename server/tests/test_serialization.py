@@ -0,0 +1,46 @@
+"""Unit tests for the JSON serialization helpers."""
+import json
+import unittest
+
+from serialization import dumps_text, encode_object, encode_rows
+
+COLUMNS = ('id', 'timestamp', 'voltages', 'amperage')
+
+
+class TestSerialization(unittest.TestCase):
+    """Test cases for the JSON serialization helpers."""
+
+    def test_rows_with_raw_columns(self):
+        """Test that stored JSON text ends up as nested JSON."""
+        rows = [(2, '2024-01-01 00:00:10', '{"core": 1.2}', 0.5),
+                (1, '2024-01-01 00:00:00', None, None)]
+        encoded = encode_rows(COLUMNS, rows, ('voltages',))
+        self.assertEqual(json.loads(encoded), [
+            {'id': 2, 'timestamp': '2024-01-01 00:00:10',
+             'voltages': {'core': 1.2}, 'amperage': 0.5},
+            {'id': 1, 'timestamp': '2024-01-01 00:00:00',
+             'voltages': None, 'amperage': None},
+        ])
+        self.assertEqual(encode_rows(COLUMNS, [], ('voltages',)), b'[]')
+
+    def test_rows_without_raw_columns(self):
+        """Test plain rows and rows made of raw columns only."""
+        self.assertEqual(json.loads(encode_rows(('a', 'b'), [(1, 'x')])),
+                         [{'a': 1, 'b': 'x'}])
+        self.assertEqual(json.loads(encode_rows(('v',), [('[1]',)], ('v',))),
+                         [{'v': [1]}])
+
+    def test_encode_object(self):
+        """Test objects with raw fields and non-string keys."""
+        self.assertEqual(
+            json.loads(encode_object({'id': 1}, {'voltages': '{"a":1}'})),
+            {'id': 1, 'voltages': {'a': 1}}
+        )
+        self.assertEqual(json.loads(encode_object({}, {'v': None})),
+                         {'v': None})
+        self.assertEqual(json.loads(encode_object({7: 'x'}, {})), {'7': 'x'})
+        self.assertEqual(dumps_text({'core': 1.2}), '{"core":1.2}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,24 @@
 """Unit tests for the server."""
+import io
 import json
 import os
+import sqlite3
 import sys
 import tempfile
 import unittest
 from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
 
+from admission import AdmissionController
+from alerts import build_engine
 from create_tables import create_tables
+from export import pq
+from liveness import LivenessTracker
+from query_cache import QueryCache
+from registry import DeviceRegistry
+from stream_ingest import ProtocolError
+from udp_ingest import UdpListener, encode_datagram
+import server
 from server import (
     app,
     get_db_conn,
@@ -26,8 +38,8 @@ with open(CONFIG_PATH, 'r', encoding="UTF-8") as f:
     SERVER_VERSION = config.get('version', '0.0.0')
 
 
-class TestServer(unittest.TestCase):
-    """Test cases for the server."""
+class ServerTestCase(unittest.TestCase):
+    """Sets up a server on a temporary database."""
 
     def setUp(self):
         """Set up test environment."""
@@ -35,6 +47,19 @@ class TestServer(unittest.TestCase):
         app.config['TESTING'] = True
         app.config['DATABASE'] = self.db_path
         self.app = app.test_client()
+        admission_patch = patch.object(server, 'admission',
+                                       AdmissionController())
+        admission_patch.start()
+        self.addCleanup(admission_patch.stop)
+        self.registry = DeviceRegistry(server.get_db_conn)
+        registry_patch = patch.object(server, 'registry', self.registry)
+        registry_patch.start()
+        self.addCleanup(registry_patch.stop)
+        self.notified = []
+        self.alert_engine = self.worker_engine()
+        engine_patch = patch.object(server, 'alert_engine', self.alert_engine)
+        engine_patch.start()
+        self.addCleanup(engine_patch.stop)
 
         # Initialize the database with the schema from create_tables.py
         with app.app_context():
@@ -44,9 +69,62 @@ class TestServer(unittest.TestCase):
 
     def tearDown(self):
         """Tear down test environment."""
+        self.registry.stop()
         os.close(self.db_fd)
         os.unlink(self.db_path)
 
+    def worker_engine(self):
+        """Create the alert engine of a server process whose
+        notifications are recorded."""
+        engine = build_engine({})
+        engine.store = server.event_store.store_alerts
+        engine.notify = self.notified.extend
+        return engine
+
+    def _register(self, device_uid='test-uid'):
+        """Register a device and return its id."""
+        response = self.app.post(
+            '/api/register',
+            data=json.dumps({'device_uid': device_uid}),
+            content_type='application/json',
+            headers={'X-Client-Version': SERVER_VERSION}
+        )
+        return json.loads(response.data)['device_id']
+
+    def _send(self, device_id, **overrides):
+        """Post one sample for a device and return the response."""
+        metrics = {
+            'cpu': {'usage': 50.0, 'frequency': 1000.0},
+            'memory': {
+                'total': 4, 'used': 1, 'available': 3, 'percentage': 25.0
+            },
+            'disk': {'total': 100, 'used': 20, 'free': 80, 'percentage': 20.0},
+            'network': {'interfaces': {}},
+            'temperature': 45.0,
+            'uptime': 3600,
+            'throttled': '0x0',
+            'voltages': {'core': 1.2}
+        }
+        metrics.update(overrides)
+        return self.app.post(
+            '/api/data',
+            data=json.dumps({'device_id': device_id, 'metrics': metrics}),
+            content_type='application/json',
+            headers={'X-Client-Version': SERVER_VERSION}
+        )
+
+    def _set_last_seen(self, last_seen):
+        """Overwrite last_seen of every device in the database."""
+        with app.app_context():
+            conn = get_db_conn()
+            conn.execute("UPDATE devices SET last_seen = ?", (last_seen,))
+            conn.commit()
+            conn.close()
+
+
+class TestDevices(ServerTestCase):
+    """Test cases for device registration and liveness."""
+
     def test_register_device(self):
         """Test device registration."""
         # First registration
@@ -62,15 +140,177 @@ class TestServer(unittest.TestCase):
         self.assertEqual(data['status'], 'success')
         self.assertEqual(data['device_id'], 1)
 
-        # Second registration of the same device
+        # Second registration of the same device, through a proxy
         response = self.app.post('/api/register',
                                  data=json.dumps({
                                      'device_uid': 'test-uid',
                                      'device_name': 'test-device-renamed'
                                  }),
                                  content_type='application/json',
-                                 headers={'X-Client-Version': SERVER_VERSION})
+                                 headers={
+                                     'X-Client-Version': SERVER_VERSION,
+                                     'X-Forwarded-For': '6.6.6.6, 10.0.0.7'
+                                 })
+        self.assertEqual(response.status_code, 200)
+        # Only the address added by the proxy itself is trusted.
+        devices = json.loads(self.app.get('/api/devices').data)
+        self.assertEqual(devices[0]['ip_address'], '10.0.0.7')
+
+        response = self.app.get('/api/devices/lookup?device_uid=test-uid')
+        self.assertEqual(json.loads(response.data), {'device_id': 1})
+        response = self.app.get('/api/devices/lookup?device_uid=other')
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_devices(self):
+        """Test getting the list of devices."""
+        # Register two devices
+        self.app.post('/api/register',
+                      data=json.dumps({'device_uid': 'test-uid-1'}),
+                      content_type='application/json',
+                      headers={'X-Client-Version': SERVER_VERSION})
+        self.app.post('/api/register',
+                      data=json.dumps({'device_uid': 'test-uid-2'}),
+                      content_type='application/json',
+                      headers={'X-Client-Version': SERVER_VERSION})
+
+        response = self.app.get('/api/devices')
         self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(len(data), 2)
+
+    def test_device_liveness(self):
+        """Test that check-ins are reflected in the liveness endpoints."""
+        tracker = LivenessTracker(verify=server.device_last_seen)
+        with patch.object(server, 'liveness_tracker', tracker):
+            device_id = self._register()
+            self._send(device_id)
+            devices = json.loads(self.app.get('/api/devices').data)
+            self.assertEqual(devices[0]['status'], 'online')
+            self.assertEqual(devices[0]['expected_interval'], 10)
+
+            # Another worker records a later check-in: the deadline is
+            # re-armed instead of the device going offline.
+            self._set_last_seen(datetime.now(timezone.utc)
+                                + timedelta(seconds=100))
+            tracker.advance(now=tracker.next_deadline() + 60)
+            statuses = json.loads(self.app.get('/api/devices/status').data)
+            self.assertEqual(statuses[str(device_id)]['status'], 'online')
+
+            self._set_last_seen(datetime.now(timezone.utc)
+                                - timedelta(hours=1))
+            tracker.advance(now=tracker.next_deadline() + 60)
+            statuses = json.loads(self.app.get('/api/devices/status').data)
+            self.assertEqual(statuses[str(device_id)]['status'], 'offline')
+
+    def test_device_events(self):
+        """Test that the transitions of every process's tracker are
+        stored once and served with their stored sequence numbers."""
+        now = [datetime.now(timezone.utc).timestamp()]
+        trackers = [LivenessTracker(clock=lambda: now[0]) for _ in range(2)]
+        for tracker in trackers:
+            tracker.subscribe(server.event_store.store_device_event)
+        device_id = self._register()
+        with patch.object(server, 'liveness_tracker', trackers[0]):
+            self._send(device_id)
+        trackers[1].observe(device_id, interval=10)
+        now[0] += 60
+        for tracker in trackers:
+            tracker.advance()
+        events = json.loads(self.app.get('/api/devices/events').data)
+        self.assertEqual([(e['device_id'], e['state']) for e in events],
+                         [(device_id, 'offline')])
+
+        for tracker in trackers:
+            tracker.observe(device_id)
+        events = json.loads(self.app.get(
+            f"/api/devices/events?since={events[-1]['seq']}").data)
+        self.assertEqual([(e['device_id'], e['state']) for e in events],
+                         [(device_id, 'online')])
+
+    def test_prune_inactive_devices(self):
+        """Test pruning inactive devices."""
+        with app.app_context():
+            conn = get_db_conn()
+            c = conn.cursor()
+            # Add an inactive device
+            old_date = datetime.now(timezone.utc) - timedelta(days=8)
+            c.execute("""
+                INSERT INTO devices (device_uid, device_name, last_seen)
+                VALUES (?, ?, ?)
+            """, ('inactive-uid-prune', 'inactive-device', old_date))
+            # Add an active device
+            c.execute("""
+                INSERT INTO devices (device_uid, device_name)
+                VALUES (?, ?)
+            """, ('active-uid-prune', 'active-device'))
+            conn.commit()
+
+            prune_inactive_devices(conn)
+
+            c.execute("SELECT COUNT(*) FROM devices")
+            count = c.fetchone()[0]
+            self.assertEqual(count, 1)
+            conn.close()
+
+    def test_migrate_legacy_schema(self):
+        """Test moving a pre-normalization database to the new schema."""
+        fd, legacy_path = tempfile.mkstemp()
+        os.close(fd)
+        conn = sqlite3.connect(legacy_path)
+        conn.executescript('''
+            CREATE TABLE devices (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_uid TEXT UNIQUE NOT NULL, device_name TEXT,
+                hostname TEXT, ip_address TEXT, last_seen DATETIME);
+            CREATE TABLE stats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, device_id INTEGER,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, cpu_usage REAL,
+                cpu_frequency TEXT, memory_used REAL, memory_total REAL,
+                memory_percentage REAL, disk_used REAL, disk_total REAL,
+                disk_percentage REAL, temperature REAL, uptime REAL,
+                throttled TEXT, voltages TEXT);
+            CREATE TABLE network_stats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, stats_id INTEGER,
+                interface_name TEXT, bytes_sent INTEGER, bytes_recv INTEGER,
+                packets_sent INTEGER, packets_recv INTEGER, speed INTEGER,
+                mtu INTEGER, is_up BOOLEAN, addresses TEXT);
+            INSERT INTO devices (device_uid) VALUES ('legacy-uid');
+            INSERT INTO stats (device_id, cpu_frequency, memory_total,
+                               disk_total)
+            VALUES (1, '1500.00 MHz', 4, 32), (1, 'N/A', 4, 64);
+            INSERT INTO network_stats (stats_id, interface_name, bytes_sent,
+                                       speed, mtu, is_up, addresses)
+            VALUES (1, 'eth0', 10, 100, 1500, 1, '[]'),
+                   (2, 'eth0', 20, 100, 1500, 1, '[]');
+        ''')
+        conn.commit()
+
+        create_tables(conn)
+
+        self.assertEqual(
+            conn.execute("SELECT cpu_frequency FROM stats ORDER BY id")
+            .fetchall(), [(1500.0,), (None,)]
+        )
+        self.assertEqual(
+            conn.execute("SELECT memory_total, disk_total FROM devices")
+            .fetchone(), (4, 64)
+        )
+        self.assertEqual(
+            conn.execute("SELECT COUNT(*) FROM interfaces").fetchone()[0], 1
+        )
+        self.assertEqual(
+            conn.execute('''SELECT ns.stats_id, i.name, ns.bytes_sent
+                            FROM network_stats ns
+                            JOIN interfaces i ON i.id = ns.interface_id
+                            ORDER BY ns.stats_id''').fetchall(),
+            [(1, 'eth0', 10), (2, 'eth0', 20)]
+        )
+        conn.close()
+        os.unlink(legacy_path)
+
+
+class TestIngest(ServerTestCase):
+    """Test cases for sample ingest."""
 
     def test_receive_data(self):
         """Test receiving data from a client."""
@@ -108,22 +348,482 @@ class TestServer(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(data['status'], 'success')
 
-    def test_get_devices(self):
-        """Test getting the list of devices."""
-        # Register two devices
-        self.app.post('/api/register',
-                      data=json.dumps({'device_uid': 'test-uid-1'}),
-                      content_type='application/json',
-                      headers={'X-Client-Version': SERVER_VERSION})
-        self.app.post('/api/register',
-                      data=json.dumps({'device_uid': 'test-uid-2'}),
-                      content_type='application/json',
-                      headers={'X-Client-Version': SERVER_VERSION})
+    def test_receive_data_normalizes_interfaces(self):
+        """Test that static values are stored once, not per sample."""
+        response = self.app.post(
+            '/api/register',
+            data=json.dumps({'device_uid': 'test-uid'}),
+            content_type='application/json',
+            headers={'X-Client-Version': SERVER_VERSION}
+        )
+        device_id = json.loads(response.data)['device_id']
 
-        response = self.app.get('/api/devices')
+        iface = {
+            'bytes_sent': 100, 'bytes_recv': 200, 'packets_sent': 1,
+            'packets_recv': 2, 'speed': 1000, 'mtu': 1500, 'is_up': True,
+            'addresses': ['192.168.1.10']
+        }
+        metrics = {
+            'cpu': {'usage': 50.0, 'frequency': '1500.00 MHz'},
+            'memory': {
+                'total': 4, 'used': 1, 'available': 3, 'percentage': 25.0
+            },
+            'disk': {'total': 100, 'used': 20, 'free': 80, 'percentage': 20.0},
+            'network': {'interfaces': {'eth0': iface}},
+        }
+        for mtu in (1500, 1500, 9000):
+            iface['mtu'] = mtu
+            response = self.app.post(
+                '/api/data',
+                data=json.dumps({'device_id': device_id, 'metrics': metrics}),
+                content_type='application/json',
+                headers={'X-Client-Version': SERVER_VERSION}
+            )
+            self.assertEqual(response.status_code, 201)
+
+        with app.app_context():
+            conn = get_db_conn()
+            versions = conn.execute(
+                "SELECT mtu FROM interfaces WHERE device_id = ? ORDER BY id",
+                (device_id,)
+            ).fetchall()
+            self.assertEqual([row['mtu'] for row in versions], [1500, 9000])
+            self.assertEqual(
+                conn.execute("SELECT COUNT(*) FROM network_stats")
+                .fetchone()[0], 3
+            )
+            conn.close()
+
+        response = self.app.get(f'/api/latest/{device_id}')
+        latest = json.loads(response.data)
+        self.assertEqual(latest['cpu_frequency'], 1500.0)
+        self.assertEqual(latest['memory_total'], 4)
+        self.assertEqual(latest['disk_total'], 100)
+        self.assertEqual(latest['network_stats']['eth0']['bytes_sent'], 100)
+
+    def test_client_stats(self):
+        """Test that client overhead is stored and summarised per device."""
+        device_id = self._register()
+        for cpu_percent, thermal_ms in ((1.0, 30.0), (3.0, 50.0)):
+            self._send(device_id, client_stats={
+                'cpu_percent': cpu_percent, 'cpu_seconds': 12.5,
+                'rss_mb': 21.0, 'collect_ms': 1004.0, 'send_ms': 12.0,
+                'probe_ms': {'cpu': 1001.0, 'thermal': thermal_ms},
+            })
+        self._send(device_id)
+
+        latest = json.loads(self.app.get(f'/api/latest/{device_id}').data)
+        self.assertIsNone(latest['client_stats'])
+
+        summary = json.loads(self.app.get('/api/client-stats').data)
+        entry = summary[str(device_id)]
+        self.assertEqual(entry['samples'], 2)
+        self.assertEqual(entry['cpu_percent_avg'], 2.0)
+        self.assertEqual(entry['cpu_percent_max'], 3.0)
+        self.assertEqual(entry['probe_ms_avg'],
+                         {'cpu': 1001.0, 'thermal': 40.0})
+
+    def test_processes(self):
+        """Test storing top processes and reading them back."""
+        device_id = self._register()
+        self._send(device_id, processes=[
+            {'pid': 10, 'name': 'python3', 'cpu_percent': 80.0,
+             'rss_mb': 50.0},
+            {'pid': 11, 'name': 'sshd', 'cpu_percent': None, 'rss_mb': 5.0},
+        ])
+        self._send(device_id, processes=[
+            {'pid': 10, 'name': 'python3', 'cpu_percent': 40.0,
+             'rss_mb': 52.0},
+        ])
+        self._send(device_id)
+
+        latest = json.loads(self.app.get(f'/api/processes/{device_id}').data)
+        self.assertEqual(latest['processes'], [
+            {'pid': 10, 'name': 'python3', 'cpu_percent': 40.0,
+             'rss_mb': 52.0}
+        ])
+
+        window = json.loads(self.app.get(
+            f'/api/processes/{device_id}?start=0').data)
+        self.assertEqual(
+            [(p['name'], p['samples'], p['cpu_percent_avg'], p['rss_mb_max'])
+             for p in window['processes']],
+            [('python3', 2, 60.0, 52.0), ('sshd', 1, None, 5.0)]
+        )
+
+    def test_disks(self):
+        """Test disk I/O and mount history, before and after archiving."""
+        device_id = self._register()
+        self._send(device_id, disks={'devices': {}, 'mounts': {
+            '/': {'total': 29.0, 'used': 7.5, 'free': 20.0,
+                  'percentage': 25.86}}})
+        self._send(device_id, disks={
+            'devices': {
+                'mmcblk0': {'read_bps': 4096, 'write_bps': 1048576,
+                            'read_iops': 1.0, 'write_iops': 25.5,
+                            'busy_percent': 93.1},
+                'sda': {'read_bps': 0, 'write_bps': 0, 'read_iops': 0.0,
+                        'write_iops': 0.0, 'busy_percent': 0.0}},
+            'mounts': {
+                '/': {'total': 29.0, 'used': 7.6, 'free': 19.9,
+                      'percentage': 26.21},
+                '/mnt/ssd': {'total': 465.0, 'used': 93.0, 'free': 372.0,
+                             'percentage': 20.0}}})
+        self._send(device_id)
+
+        data = json.loads(self.app.get(f'/api/disks/{device_id}').data)
+        self.assertEqual(list(data['disks']), ['mmcblk0', 'sda'])
+        self.assertEqual(data['disks']['mmcblk0']['write_bps'], [1048576])
+        self.assertEqual(data['disks']['mmcblk0']['busy_percent'], [93.1])
+        self.assertEqual(data['mounts']['/']['used'], [7.5, 7.6])
+        self.assertEqual(len(data['mounts']['/']['timestamp']), 2)
+        self.assertEqual(data['mounts']['/mnt/ssd']['percentage'], [20.0])
+
+        conn = get_db_conn()
+        conn.execute("UPDATE stats SET timestamp = "
+                     "datetime(timestamp, '-2 days')")
+        conn.commit()
+        start = int((datetime.now(timezone.utc)
+                     - timedelta(days=3)).timestamp())
+        url = f'/api/disks/{device_id}?start={start}&end={start + 86400}'
+        before = json.loads(self.app.get(url).data)
+        self.assertEqual(before['disks']['mmcblk0']['write_bps'], [1048576])
+        self.assertEqual(before['mounts']['/']['used'], [7.5, 7.6])
+        self.assertEqual(server.compact_stats(), 3)
+        self.assertEqual(json.loads(self.app.get(url).data), before)
+
+        with patch.object(server, 'STATS_RETENTION_DAYS', 1):
+            prune_old_stats(conn)
+        for table in ('disk_stats', 'mount_stats'):
+            self.assertEqual(conn.execute(
+                f"SELECT COUNT(*) FROM {table}").fetchone()[0], 0)
+        conn.close()
+
+    def test_ingest_admission(self):
+        """Test that devices over their rate are told when to retry."""
+        server.admission = AdmissionController(device_rate=0.1,
+                                               device_burst=2)
+        device_id = self._register()
+        self.assertEqual(self._send(device_id).status_code, 201)
+        self.assertEqual(self._send(device_id).status_code, 201)
+        response = self._send(device_id)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '10')
+
+        server.admission = AdmissionController(max_concurrent=1)
+        server.admission.enter(device_id)
+        response = self._send(device_id)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+        server.admission.leave()
+        self.assertEqual(self._send(device_id).status_code, 201)
+
+    def test_udp_ingest(self):
+        """Test that datagrams take the same storage path as /api/data."""
+        listener = UdpListener('secret',
+                               server.ingest_listeners.ingest_datagram)
+        with patch.object(server.ingest_listeners, 'udp', listener):
+            response = self.app.post(
+                '/api/register', data=json.dumps({'device_uid': 'test-uid'}),
+                content_type='application/json',
+                headers={'X-Client-Version': SERVER_VERSION}
+            )
+        registration = json.loads(response.data)
+        key = bytes.fromhex(registration['udp_key'])
+        device_id = registration['device_id']
+
+        metrics = {
+            'cpu': {'usage': 12.5}, 'network': {'interfaces': {}},
+            'memory': {'total': 4, 'used': 1, 'percentage': 25.0},
+            'disk': {'total': 100, 'used': 20, 'percentage': 20.0},
+        }
+        for sequence, version in ((1, SERVER_VERSION), (2, '0.0.1')):
+            listener.handle_datagram(encode_datagram(
+                key, device_id, sequence,
+                {'v': version, 'i': 10, 'm': metrics}
+            ))
+        self.assertEqual((listener.counters['stored'],
+                          listener.counters['rejected']), (1, 1))
+        history = json.loads(self.app.get(f'/api/history/{device_id}').data)
+        self.assertEqual([row['cpu_usage'] for row in history], [12.5])
+
+    def test_udp_replay_across_workers(self):
+        """Test that a datagram accepted by one worker's listener is a
+        duplicate for every other worker sharing the database."""
+        listeners = [UdpListener('secret',
+                                 server.ingest_listeners.ingest_datagram)
+                     for _ in range(2)]
+        with patch.object(server.ingest_listeners, 'udp', listeners[0]):
+            response = self.app.post(
+                '/api/register', data=json.dumps({'device_uid': 'test-uid'}),
+                content_type='application/json',
+                headers={'X-Client-Version': SERVER_VERSION}
+            )
+        registration = json.loads(response.data)
+        metrics = {
+            'cpu': {'usage': 12.5}, 'network': {'interfaces': {}},
+            'memory': {'total': 4, 'used': 1, 'percentage': 25.0},
+            'disk': {'total': 100, 'used': 20, 'percentage': 20.0},
+        }
+
+        def datagram(sequence):
+            return encode_datagram(
+                bytes.fromhex(registration['udp_key']),
+                registration['device_id'], sequence,
+                {'v': SERVER_VERSION, 'i': 10, 'm': metrics})
+
+        self.assertEqual([listeners[0].handle_datagram(datagram(5)),
+                          listeners[1].handle_datagram(datagram(5)),
+                          listeners[1].handle_datagram(datagram(4)),
+                          listeners[1].handle_datagram(datagram(6)),
+                          listeners[0].handle_datagram(datagram(6))],
+                         ['stored', 'duplicate', 'duplicate', 'stored',
+                          'duplicate'])
+        history = json.loads(self.app.get(
+            f"/api/history/{registration['device_id']}").data)
+        self.assertEqual(len(history), 2)
+
+    def test_stream_ingest(self):
+        """Test stream epochs and that resent samples are skipped."""
+        device_id = self._register()
+        metrics = {
+            'cpu': {'usage': 12.5}, 'network': {'interfaces': {}},
+            'memory': {'total': 4, 'used': 1, 'percentage': 25.0},
+            'disk': {'total': 100, 'used': 20, 'percentage': 20.0},
+        }
+        listeners = server.ingest_listeners
+        self.assertEqual(listeners.open_stream(device_id, SERVER_VERSION, 'a'),
+                         0)
+        statuses = [
+            listeners.ingest_stream_sample(device_id, sequence, 10,
+                                           json.loads(json.dumps(metrics)))[1]
+            for sequence in (1, 2, 2)
+        ]
+        self.assertEqual(statuses, [201, 201, 200])
+        self.assertEqual(listeners.open_stream(device_id, SERVER_VERSION, 'a'),
+                         2)
+        # A new client cache starts the sequence over.
+        self.assertEqual(listeners.open_stream(device_id, SERVER_VERSION, 'b'),
+                         0)
+        with self.assertRaises(ProtocolError):
+            listeners.open_stream(device_id + 1, SERVER_VERSION, 'a')
+        history = json.loads(self.app.get(f'/api/history/{device_id}').data)
+        self.assertEqual(len(history), 2)
+
+    def test_alerts_notified_once(self):
+        """Test that alerts are evaluated at ingest and that a transition
+        seen by two server processes is stored and notified once."""
+        other = self.worker_engine()
+        device_id = self._register()
+        full = {'total': 100, 'used': 95, 'free': 5, 'percentage': 95.0}
+        self._send(device_id, disk=full)
+        with patch.object(server, 'alert_engine', other):
+            self._send(device_id, disk=full)
+        self.assertEqual([(a['rule'], a['state']) for a in self.notified],
+                         [('disk-full', 'firing')])
+        data = json.loads(self.app.get('/api/alerts').data)
+        self.assertEqual([(a['rule'], a['device_id']) for a in data['active']],
+                         [('disk-full', device_id)])
+
+        with patch.object(server, 'alert_engine', other):
+            self._send(device_id)
+        self._send(device_id)
+        self.assertEqual([(a['rule'], a['state']) for a in self.notified],
+                         [('disk-full', 'firing'), ('disk-full', 'resolved')])
+        data = json.loads(self.app.get('/api/alerts').data)
+        self.assertEqual(data['active'], [])
+        self.assertEqual(len(data['recent']), 2)
+
+
+class TestQueries(ServerTestCase):
+    """Test cases for the history, statistics and export endpoints."""
+
+    def test_history_since_cursor(self):
+        """Test that history only returns rows after the given cursor."""
+        device_id = self._register()
+        for temperature in (40.0, 50.0):
+            self._send(device_id, temperature=temperature)
+
+        response = self.app.get(f'/api/history/{device_id}')
+        history = json.loads(response.data)
+        self.assertEqual([row['temperature'] for row in history],
+                         [50.0, 40.0])
+        cursor = history[0]['id']
+
+        response = self.app.get(f'/api/history/{device_id}?since_id={cursor}')
+        self.assertEqual(json.loads(response.data), [])
+        self._send(device_id, temperature=60.0)
+        response = self.app.get(f'/api/history/{device_id}?since_id={cursor}')
+        self.assertEqual([row['temperature']
+                          for row in json.loads(response.data)], [60.0])
+
+        response = self.app.get(f'/api/history/{device_id}?since=2000000000')
+        self.assertEqual(json.loads(response.data), [])
+        response = self.app.get(f'/api/history/{device_id}?since=soon')
+        self.assertEqual(response.status_code, 400)
+
+    def test_archived_samples(self):
+        """Test that archived samples read the same as unarchived ones."""
+        first = self._register('test-uid-1')
+        second = self._register('test-uid-2')
+        self._send(first, temperature=40.0, network={'interfaces': {
+            'eth0': {'bytes_sent': 1, 'bytes_recv': 2, 'packets_sent': 3,
+                     'packets_recv': 4}}})
+        self._send(second, temperature=50.0, amperage=None)
+        self._send(first, temperature=60.5, throttled='0x50000')
+        conn = get_db_conn()
+        conn.execute("UPDATE stats SET timestamp = "
+                     "datetime(timestamp, '-2 days')")
+        conn.commit()
+
+        start = int((datetime.now(timezone.utc)
+                     - timedelta(days=3)).timestamp())
+        urls = [
+            f'/api/history/{first}',
+            f'/api/history/{first}?since_id=1',
+            f'/api/latest/{first}',
+            '/api/export?format=ndjson',
+            f'/api/export?format=csv&device_id={first}&start={start}',
+            f'/api/query?devices={first},{second}&metrics=temperature'
+            f'&start={start}&end={start + 2 * 86400}&step=3600&agg=max',
+        ]
+        before = [self.app.get(url).data for url in urls]
+
+        self.assertEqual(server.compact_stats(), 3)
+        self.assertEqual(server.compact_stats(), 0)
+        self.assertEqual(
+            conn.execute("SELECT COUNT(*) FROM stats").fetchone()[0], 0)
+        self.assertEqual(conn.execute(
+            "SELECT COUNT(*), SUM(samples) FROM stats_blocks").fetchone()[:],
+            (2, 3))
+        for url, expected in zip(urls, before):
+            self.assertEqual(self.app.get(url).data, expected, url)
+
+        with patch.object(server, 'STATS_RETENTION_DAYS', 1):
+            prune_old_stats(conn)
+        self.assertEqual(conn.execute(
+            "SELECT COUNT(*) FROM stats_blocks").fetchone()[0], 0)
+        self.assertEqual(conn.execute(
+            "SELECT COUNT(*) FROM network_stats").fetchone()[0], 0)
+        self.assertEqual(json.loads(self.app.get(urls[0]).data), [])
+        conn.close()
+
+    def test_percentiles(self):
+        """Test percentile queries answered from the ingest sketches."""
+        server.admission = AdmissionController(device_burst=100)
+        device_id = self._register()
+        for usage in range(1, 101):
+            self._send(device_id, cpu={'usage': float(usage)})
+
+        response = self.app.get(f'/api/percentiles/{device_id}'
+                                '?metric=cpu_usage,temperature&q=0.5,0.99')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)['metrics']
+        self.assertEqual(data['cpu_usage']['count'], 100)
+        self.assertAlmostEqual(data['cpu_usage']['percentiles']['p50'],
+                               50, delta=0.5)
+        self.assertAlmostEqual(data['cpu_usage']['percentiles']['p99'],
+                               99, delta=1)
+        self.assertAlmostEqual(data['temperature']['percentiles']['p50'],
+                               45, delta=0.45)
+
+        response = self.app.get(f'/api/percentiles/{device_id}'
+                                '?start=2000000000')
+        data = json.loads(response.data)['metrics']
+        self.assertEqual(data['cpu_usage']['count'], 0)
+        response = self.app.get(f'/api/percentiles/{device_id}?metric=uptime')
+        self.assertEqual(response.status_code, 400)
+        response = self.app.get(f'/api/percentiles/{device_id}?q=95')
+        self.assertEqual(response.status_code, 400)
+
+    def test_query(self):
+        """Test the multi-device aggregation endpoint."""
+        first = self._register('test-uid-1')
+        second = self._register('test-uid-2')
+        self._send(first, temperature=40.0)
+        self._send(second, temperature=60.0)
+
+        response = self.app.get(f'/api/query?devices={first},{second}'
+                                '&metrics=temperature&step=3600&agg=max')
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
-        self.assertEqual(len(data), 2)
+        self.assertEqual(len(data['timestamps']), 2)
+        self.assertEqual(
+            [max(v for v in s['values'] if v is not None)
+             for s in data['series']],
+            [40.0, 60.0]
+        )
+
+        response = self.app.get(f'/api/query?devices={first}&agg=median')
+        self.assertEqual(response.status_code, 400)
+        response = self.app.get('/api/query?devices=x')
+        self.assertEqual(response.status_code, 400)
+
+    def test_query_cache(self):
+        """Test that repeated reads hit the cache until the next ingest."""
+        cache = QueryCache()
+        with patch.object(server, 'query_cache', cache):
+            device_id = self._register()
+            self._send(device_id, temperature=40.0)
+            for _ in range(3):
+                response = self.app.get(f'/api/history/{device_id}')
+            self.assertEqual(len(json.loads(response.data)), 1)
+            self.assertEqual(cache.stats()['hits'], 2)
+
+            self._send(device_id, temperature=50.0)
+            response = self.app.get(f'/api/history/{device_id}')
+            self.assertEqual(len(json.loads(response.data)), 2)
+
+            for _ in range(2):
+                self.app.get(f'/api/query?devices={device_id}'
+                             '&start=2024-01-01&end=2024-01-02&step=3600')
+            self._send(device_id)
+            self.app.get(f'/api/query?devices={device_id}'
+                         '&start=2024-01-01&end=2024-01-02&step=3600')
+            response = self.app.get('/api/cache/stats')
+        stats = json.loads(response.data)
+        self.assertEqual((stats['hits'], stats['invalidations']), (4, 1))
+
+    def test_export(self):
+        """Test streaming exports for a device and for the fleet."""
+        first = self._register('test-uid-1')
+        second = self._register('test-uid-2')
+        self._send(first, temperature=40.0)
+        self._send(second, temperature=50.0)
+        self._send(first, temperature=60.0)
+
+        response = self.app.get(f'/api/export?format=csv&device_id={first}')
+        self.assertEqual(response.status_code, 200)
+        lines = response.data.decode('utf-8').strip().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('id,device_id,timestamp'))
+
+        response = self.app.get('/api/export?format=ndjson')
+        rows = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual([row['temperature'] for row in rows],
+                         [40.0, 50.0, 60.0])
+
+        response = self.app.get('/api/export?format=ndjson&start=2000000000')
+        self.assertEqual(response.data, b'')
+
+        response = self.app.get('/api/export?format=xml')
+        self.assertEqual(response.status_code, 400)
+        response = self.app.get('/api/export?start=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+    @unittest.skipIf(pq is None, 'pyarrow is not installed')
+    def test_export_parquet(self):
+        """Test that a Parquet export round-trips through pyarrow."""
+        device_id = self._register()
+        for _ in range(3):
+            self._send(device_id)
+        response = self.app.get(f'/api/export?format=parquet'
+                                f'&device_id={device_id}')
+        self.assertEqual(response.status_code, 200)
+        table = pq.read_table(io.BytesIO(response.data))
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(table.column('cpu_frequency').to_pylist(),
+                         [1000.0] * 3)
 
     def test_prune_old_stats(self):
         """Test pruning old statistics."""
@@ -158,30 +858,25 @@ class TestServer(unittest.TestCase):
             self.assertEqual(count, 1)
             conn.close()
 
-    def test_prune_inactive_devices(self):
-        """Test pruning inactive devices."""
-        with app.app_context():
-            conn = get_db_conn()
-            c = conn.cursor()
-            # Add an inactive device
-            old_date = datetime.now(timezone.utc) - timedelta(days=8)
-            c.execute("""
-                INSERT INTO devices (device_uid, device_name, last_seen)
-                VALUES (?, ?, ?)
-            """, ('inactive-uid-prune', 'inactive-device', old_date))
-            # Add an active device
-            c.execute("""
-                INSERT INTO devices (device_uid, device_name)
-                VALUES (?, ?)
-            """, ('active-uid-prune', 'active-device'))
-            conn.commit()
-
-            prune_inactive_devices(conn)
-
-            c.execute("SELECT COUNT(*) FROM devices")
-            count = c.fetchone()[0]
-            self.assertEqual(count, 1)
-            conn.close()
+    def test_profiling_header(self):
+        """Test profiling a single request by token."""
+        profiler = server.RequestProfiler(tempfile.mkdtemp())
+        with patch.object(server, 'request_profiler', profiler):
+            response = self.app.get('/api/profiling')
+            self.assertEqual(response.status_code, 404)
+            with patch.object(server, 'profiling_config', {'token': 'secret'}):
+                response = self.app.get('/api/devices',
+                                        headers={'X-Profile': 'wrong'})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(profiler.requests, {})
+                self.app.get('/api/devices', headers={'X-Profile': 'secret'})
+                response = self.app.get('/api/profiling',
+                                        headers={'X-Profile': 'secret'})
+        data = json.loads(response.data)
+        self.assertEqual(data['mode'], 'sample')
+        self.assertEqual(data['requests'], {'GET /api/devices': 1})
+        self.assertTrue(os.path.exists(
+            os.path.join(profiler.directory, 'GET_api_devices.folded')))
 
 
 if __name__ == '__main__':
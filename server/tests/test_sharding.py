@@ -0,0 +1,218 @@
+"""Unit tests for the sharded multi-node mode."""
+import io
+import json
+import sqlite3
+import unittest
+import urllib.parse
+from unittest.mock import patch
+
+import router
+from create_tables import create_tables
+from sharding import HashRing, first_device_id, shard_of_device
+
+
+# A device_uid that hashes to shard 0 of two but is registered on shard 1,
+# as after a shard was added.
+KNOWN_UID = 'uid-3'
+
+
+class FakeResponse(io.BytesIO):
+    """Stand-in for an open urllib response."""
+
+    def __init__(self, status, payload, content_type='application/json'):
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode('utf-8')
+        super().__init__(payload)
+        self.status = status
+        self.headers = {'Content-Type': content_type}
+
+
+class FakeShards(router.ShardClient):
+    """Shard client answering from per-shard handler functions."""
+
+    def __init__(self, handlers):
+        super().__init__([f'http://shard-{i}' for i in range(len(handlers))])
+        self.handlers = handlers
+        self.calls = []
+        self.headers = []
+
+    def open(self, shard, method, path, query='', body=None, headers=None):
+        self.calls.append((shard, method, path))
+        self.headers.append(headers)
+        return self.handlers[shard](method, path, query, body)
+
+
+class TestSharding(unittest.TestCase):
+    """Test cases for hashing and id allocation."""
+
+    def test_ring_is_stable_when_growing(self):
+        """Test that adding a node only moves keys onto the new node."""
+        keys = [f'uid-{i}' for i in range(2000)]
+        small = HashRing(range(4))
+        large = HashRing(range(5))
+        moved = [key for key in keys
+                 if small.node_for(key) != large.node_for(key)]
+        self.assertTrue(all(large.node_for(key) == 4 for key in moved))
+        self.assertLess(len(moved), len(keys) * 0.35)
+        counts = [sum(1 for key in keys if small.node_for(key) == node)
+                  for node in range(4)]
+        self.assertGreater(min(counts), 300)
+
+    def test_device_id_ranges(self):
+        """Test that shards allocate device ids from their own range."""
+        conn = sqlite3.connect(':memory:')
+        create_tables(conn, shard_index=3)
+        conn.execute("INSERT INTO devices (device_uid) VALUES ('a')")
+        device_id = conn.execute("SELECT id FROM devices").fetchone()[0]
+        self.assertEqual(device_id, first_device_id(3) + 1)
+        self.assertEqual(shard_of_device(device_id), 3)
+        self.assertEqual(shard_of_device(42), 0)
+        conn.close()
+
+
+class TestRouter(unittest.TestCase):
+    """Test cases for the query router."""
+
+    def setUp(self):
+        """Set up a router over two fake shards."""
+        def shard(index, devices):
+            listings = {
+                '/api/devices': devices,
+                '/api/devices/events': [
+                    {'device_id': devices[0]['id'], 'state': 'offline',
+                     'timestamp': devices[0]['last_seen'], 'seq': 1}
+                ],
+            }
+
+            def handle(_method, path, query, _body):
+                if path in listings:
+                    return FakeResponse(200, listings[path])
+                if path == '/api/devices/lookup':
+                    uid = urllib.parse.parse_qs(query)['device_uid'][0]
+                    known = [d['id'] for d in devices
+                             if d.get('device_uid') == uid]
+                    if known:
+                        return FakeResponse(200, {'device_id': known[0]})
+                    return FakeResponse(404, {'error': 'Not registered'})
+                if path == '/api/query':
+                    ids = urllib.parse.parse_qs(query)['devices'][0]
+                    return FakeResponse(200, {'series': [
+                        {'device_id': int(device_id), 'shard': index}
+                        for device_id in ids.split(',')
+                    ]})
+                if path == '/api/export':
+                    return FakeResponse(
+                        200, f'id,device_id\n{index},{index}\n'.encode(),
+                        'text/csv')
+                return FakeResponse(201, {'shard': index, 'path': path})
+            return handle
+
+        self.fake = FakeShards([
+            shard(0, [{'id': 1, 'last_seen': '2024-01-01 10:00:00'}]),
+            shard(1, [{'id': first_device_id(1) + 1,
+                       'device_uid': KNOWN_UID,
+                       'last_seen': '2024-01-01 11:00:00'}]),
+        ])
+        self.patches = [
+            patch.object(router, 'shards', self.fake),
+            patch.object(router, 'ring', HashRing(range(2))),
+        ]
+        for p in self.patches:
+            p.start()
+        self.app = router.app.test_client()
+
+    def tearDown(self):
+        """Remove the patches."""
+        for p in self.patches:
+            p.stop()
+
+    def test_register_follows_ring(self):
+        """Test that registrations go to the shard the uid hashes to."""
+        response = self.app.post('/api/register',
+                                 data=json.dumps({'device_uid': 'uid-7'}),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.data)['shard'],
+                         router.ring.node_for('uid-7'))
+
+    def test_register_finds_existing_device(self):
+        """Test that a known device_uid stays on its shard even if it
+        hashes elsewhere, and that registration waits for down shards."""
+        self.assertEqual(router.ring.node_for(KNOWN_UID), 0)
+        response = self.app.post('/api/register',
+                                 data=json.dumps({'device_uid': KNOWN_UID}),
+                                 content_type='application/json')
+        self.assertEqual(json.loads(response.data)['shard'], 1)
+
+        def down(*_args):
+            raise OSError('connection refused')
+
+        self.fake.handlers[1] = down
+        response = self.app.post('/api/register',
+                                 data=json.dumps({'device_uid': 'uid-new'}),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 503)
+
+    def test_per_device_requests_go_to_owner(self):
+        """Test that device ids are routed by their shard bits."""
+        device_id = first_device_id(1) + 5
+        response = self.app.post(
+            '/api/data', data=json.dumps({'device_id': device_id}),
+            content_type='application/json')
+        self.assertEqual(json.loads(response.data)['shard'], 1)
+        response = self.app.get('/api/latest/1')
+        self.assertEqual(json.loads(response.data)['shard'], 0)
+        response = self.app.get(f'/api/history/{first_device_id(9)}')
+        self.assertEqual(response.status_code, 404)
+        response = self.app.get(f'/api/disks/{first_device_id(1) + 1}')
+        self.assertEqual(json.loads(response.data)['shard'], 1)
+
+    def test_forwarded_for_is_appended(self):
+        """Test that the router adds the client address it saw to the
+        forwarding chain instead of replacing it."""
+        self.app.get('/api/latest/1', environ_base={'REMOTE_ADDR': '10.0.0.9'})
+        self.assertEqual(self.fake.headers[-1]['X-Forwarded-For'], '10.0.0.9')
+        self.app.get('/api/latest/1', headers={'X-Forwarded-For': '1.2.3.4'},
+                     environ_base={'REMOTE_ADDR': '10.0.0.9'})
+        self.assertEqual(self.fake.headers[-1]['X-Forwarded-For'],
+                         '1.2.3.4, 10.0.0.9')
+
+    def test_shed_samples_keep_retry_after(self):
+        """Test that a shard's Retry-After reaches the client."""
+        busy = FakeResponse(503, {'error': 'Server busy', 'retry_after': 2})
+        busy.headers['Retry-After'] = '2'
+        self.fake.handlers[0] = lambda *_args: busy
+        response = self.app.post('/api/data',
+                                 data=json.dumps({'device_id': 1}),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '2')
+
+    def test_query_is_split_by_shard(self):
+        """Test that multi-device queries go to the owning shards."""
+        second = first_device_id(1) + 1
+        response = self.app.get(f'/api/query?devices={second},1,2'
+                                '&metrics=cpu_usage')
+        series = json.loads(response.data)['series']
+        self.assertEqual([(s['device_id'], s['shard']) for s in series],
+                         [(1, 0), (2, 0), (second, 1)])
+        self.assertEqual(len(self.fake.calls), 2)
+
+    def test_fleet_reads_are_merged(self):
+        """Test fan-out of the device list and fleet exports."""
+        devices = json.loads(self.app.get('/api/devices').data)
+        self.assertEqual([d['id'] for d in devices],
+                         [first_device_id(1) + 1, 1])
+
+        events = json.loads(self.app.get('/api/devices/events?since=0').data)
+        self.assertEqual([e['device_id'] for e in events],
+                         [1, first_device_id(1) + 1])
+
+        response = self.app.get('/api/export?format=csv')
+        self.assertEqual(response.data, b'id,device_id\n0,0\n1,1\n')
+        response = self.app.get('/api/export?format=parquet')
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""Unit tests for the quantile sketches."""
+import random
+import sqlite3
+import unittest
+
+from create_tables import create_tables
+from sketches import (
+    BUCKET_SECONDS,
+    RELATIVE_ACCURACY,
+    DDSketch,
+    record_sample,
+    window_sketch
+)
+
+
+def exact_quantile(values, q):
+    """Return the quantile the sketch approximates."""
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+class TestDDSketch(unittest.TestCase):
+    """Test cases for DDSketch."""
+
+    def test_relative_accuracy(self):
+        """Test that quantiles are within the configured relative error."""
+        rng = random.Random(1)
+        values = [rng.lognormvariate(3, 1) for _ in range(5000)]
+        values += [-rng.uniform(1, 10) for _ in range(100)] + [0.0] * 50
+        sketch = DDSketch()
+        for value in values:
+            sketch.add(value)
+        for q in (0, 0.01, 0.25, 0.5, 0.95, 0.99, 1):
+            expected = exact_quantile(values, q)
+            self.assertLessEqual(
+                abs(sketch.quantile(q) - expected),
+                RELATIVE_ACCURACY * abs(expected) + 1e-12
+            )
+        self.assertIsNone(DDSketch().quantile(0.5))
+
+    def test_merge_and_round_trip(self):
+        """Test that merged sketches equal one sketch of all values."""
+        first, second, combined = DDSketch(), DDSketch(), DDSketch()
+        for value in range(1, 101):
+            (first if value % 2 else second).add(value)
+            combined.add(value)
+        first.merge(DDSketch.from_json(second.to_json()))
+        for q in (0.1, 0.5, 0.9):
+            self.assertEqual(first.quantile(q), combined.quantile(q))
+        self.assertEqual((first.count, first.min, first.max), (100, 1, 100))
+
+
+class TestSketchStorage(unittest.TestCase):
+    """Test cases for per-bucket sketch storage."""
+
+    def test_window_merges_buckets(self):
+        """Test that a window merges exactly the buckets it overlaps."""
+        conn = sqlite3.connect(':memory:')
+        create_tables(conn)
+        cursor = conn.cursor()
+        for i in range(30):
+            record_sample(cursor, 1, {'cpu_usage': float(i)},
+                          i * BUCKET_SECONDS / 10)
+        conn.commit()
+        self.assertEqual(conn.execute(
+            'SELECT COUNT(*) FROM metric_sketches').fetchone()[0], 3)
+
+        sketch = window_sketch(conn, 1, 'cpu_usage', BUCKET_SECONDS + 1,
+                               2 * BUCKET_SECONDS)
+        self.assertEqual((sketch.count, sketch.min, sketch.max),
+                         (10, 10.0, 19.0))
+        self.assertEqual(window_sketch(conn, 1, 'temperature', 0,
+                                       3 * BUCKET_SECONDS).count, 0)
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
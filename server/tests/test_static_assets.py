@@ -0,0 +1,84 @@
+"""Unit tests for the fingerprinted dashboard assets."""
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from flask import Flask, render_template_string
+
+import static_assets
+
+
+class TestAssets(unittest.TestCase):
+    """Test cases for building and serving the dashboard assets."""
+
+    def setUp(self):
+        """Create a static directory with some sources."""
+        self.static_dir = tempfile.mkdtemp()
+        self.dist_dir = os.path.join(self.static_dir, 'dist')
+        self.script = b'console.log("dashboard");\n' * 100
+        with open(os.path.join(self.static_dir, 'main.js'), 'wb') as f:
+            f.write(self.script)
+        with open(os.path.join(self.static_dir, 'style.css'), 'wb') as f:
+            f.write(b'body {}')
+        assets_patch = patch.object(static_assets, 'ASSETS',
+                                    ('style.css', 'main.js'))
+        assets_patch.start()
+        self.addCleanup(assets_patch.stop)
+
+    def test_build(self):
+        """Test fingerprinted names, compressed copies and the manifest."""
+        manifest = static_assets.build(self.static_dir)
+        self.assertEqual(set(manifest), {'main.js', 'style.css'})
+        self.assertRegex(manifest['main.js'], r'^main\.[0-9a-f]{10}\.js$')
+        path = os.path.join(self.dist_dir, manifest['main.js'])
+        with gzip.open(path + '.gz') as f:
+            self.assertEqual(f.read(), self.script)
+        # Compressing seven bytes does not pay off.
+        self.assertFalse(os.path.exists(
+            os.path.join(self.dist_dir, manifest['style.css'] + '.gz')))
+        self.assertEqual(static_assets.load_manifest(self.dist_dir), manifest)
+
+        with open(os.path.join(self.static_dir, 'main.js'), 'ab') as f:
+            f.write(b'// changed\n')
+        rebuilt = static_assets.build(self.static_dir)
+        self.assertNotEqual(rebuilt['main.js'], manifest['main.js'])
+        self.assertEqual(rebuilt['style.css'], manifest['style.css'])
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + '.gz'))
+
+        os.remove(os.path.join(self.static_dir, 'style.css'))
+        with self.assertRaises(FileNotFoundError):
+            static_assets.build(self.static_dir)
+
+    def test_serve(self):
+        """Test asset URLs and precompressed, immutable responses."""
+        manifest = static_assets.build(self.static_dir)
+        app = Flask(__name__, static_folder=self.static_dir)
+        static_assets.init_app(app, self.dist_dir)
+        with app.test_request_context():
+            urls = json.loads(render_template_string(
+                "{{ [asset_url('main.js')] | tojson }}"))
+            with self.assertRaises(FileNotFoundError):
+                render_template_string("{{ asset_url('vendor/chart.umd.js') }}")
+        self.assertEqual(urls, [f"/static/dist/{manifest['main.js']}"])
+
+        client = app.test_client()
+        response = client.get(urls[0], headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/javascript')
+        self.assertEqual(response.headers['Cache-Control'], static_assets.IMMUTABLE)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), self.script)
+        response.close()
+
+        response = client.get(urls[0], headers={'Accept-Encoding': 'br'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, self.script)
+        response.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+"""Unit tests for the stream ingest listener."""
+import hashlib
+import functools
+import hmac
+import json
+import socket
+import threading
+import unittest
+
+from stream_ingest import (
+    FRAME_HEADER, ProtocolError, StreamListener, encode_frame
+)
+from udp_ingest import device_key
+
+SECRET = 'test-secret'
+
+
+def read_frame(reader):
+    """Read one frame from a socket file."""
+    (length,) = FRAME_HEADER.unpack(reader.read(FRAME_HEADER.size))
+    return json.loads(reader.read(length))
+
+
+class TestStreamListener(unittest.TestCase):
+    """Test cases for the stream ingest listener."""
+
+    def setUp(self):
+        """Set up a listener that keeps sequence numbers like the server."""
+        self.stored = []
+        self.last_seq = {}
+        self.shed_at = None
+
+        def open_stream(device_id, version, epoch):
+            if version != '1.0':
+                raise ProtocolError('Client version mismatch')
+            return self.last_seq.get((device_id, epoch), 0)
+
+        def store(device_id, sequence, interval, metrics):
+            if sequence == self.shed_at:
+                return {'error': 'busy', 'retry_after': 3}, 429
+            key = (device_id, 'e1')
+            if sequence <= self.last_seq.get(key, 0):
+                return {'status': 'duplicate'}, 200
+            self.last_seq[key] = sequence
+            self.stored.append((device_id, sequence, interval, metrics))
+            return {'status': 'success'}, 201
+
+        self.listener = StreamListener(open_stream, store,
+                                       functools.partial(device_key, SECRET))
+
+    def connect(self, device_id=7, version='1.0', key=None):
+        """Serve one end of a socket pair; returns the other end."""
+        ours, theirs = socket.socketpair()
+        thread = threading.Thread(target=self.listener.serve, args=(theirs,))
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(ours.close)
+        reader = ours.makefile('rb')
+        self.addCleanup(reader.close)
+        challenge = bytes.fromhex(read_frame(reader)['challenge'])
+        mac = hmac.new(key or device_key(SECRET, device_id), challenge,
+                       hashlib.sha256).hexdigest()
+        ours.sendall(encode_frame({'device_id': device_id, 'version': version,
+                                   'epoch': 'e1', 'mac': mac}))
+        return ours, reader
+
+    @staticmethod
+    def samples(*sequences):
+        """Encode sample frames as one batch."""
+        return b''.join(encode_frame({'s': s, 'i': 10, 'm': {'cpu': s}})
+                        for s in sequences)
+
+    def test_batch_is_acknowledged_once(self):
+        """Test that frames sent together get one cumulative ack."""
+        sock, reader = self.connect()
+        self.assertEqual(read_frame(reader), {'last_seq': 0})
+        sock.sendall(self.samples(1, 2, 3))
+        self.assertEqual(read_frame(reader), {'ack': 3})
+        self.assertEqual([s[1] for s in self.stored], [1, 2, 3])
+        self.assertEqual(self.stored[0], (7, 1, 10, {'cpu': 1}))
+
+    def test_resend_after_reconnect(self):
+        """Test that samples resent on a new connection are not stored
+        twice."""
+        sock, reader = self.connect()
+        read_frame(reader)
+        sock.sendall(self.samples(1, 2))
+        read_frame(reader)
+        sock.close()
+
+        sock, reader = self.connect()
+        self.assertEqual(read_frame(reader), {'last_seq': 2})
+        sock.sendall(self.samples(2, 3))
+        self.assertEqual(read_frame(reader), {'ack': 3})
+        self.assertEqual([s[1] for s in self.stored], [1, 2, 3])
+        self.assertEqual(self.listener.stats()['duplicates'], 1)
+
+    def test_shed_sample_closes_with_retry_after(self):
+        """Test that admission control stops the stream with a hint."""
+        self.shed_at = 2
+        sock, reader = self.connect()
+        read_frame(reader)
+        sock.sendall(self.samples(1, 2, 3))
+        self.assertEqual(read_frame(reader), {'ack': 1, 'retry_after': 3})
+        self.assertEqual(reader.read(), b'')
+        self.assertEqual(self.listener.stats()['shed'], 1)
+
+    def test_rejects_bad_handshakes(self):
+        """Test that forged keys and old clients are refused."""
+        _, reader = self.connect(key=device_key('other', 7))
+        self.assertEqual(read_frame(reader),
+                         {'error': 'Authentication failed'})
+        _, reader = self.connect(version='0.1')
+        self.assertEqual(read_frame(reader),
+                         {'error': 'Client version mismatch'})
+
+    def test_socket(self):
+        """Test a connection over the loopback interface."""
+        listener = StreamListener(lambda *args: 0, lambda *args: ({}, 201),
+                                  functools.partial(device_key, SECRET),
+                                  '127.0.0.1', 0)
+        listener.start()
+        self.addCleanup(listener.sock.close)
+        port = listener.sock.getsockname()[1]
+        with socket.create_connection(('127.0.0.1', port), 5) as sock:
+            reader = sock.makefile('rb')
+            self.assertIn('challenge', read_frame(reader))
+            reader.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+"""Unit tests for the compressed archive blocks."""
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import unittest
+
+import tsblock
+from create_tables import create_tables
+
+
+def sample_columns(count, seed=1):
+    """Return `count` samples that look like a Pi reporting every 10 s."""
+    rng = random.Random(seed)
+    columns = {column: [] for column in tsblock.BLOCK_COLUMNS}
+    stats_id, timestamp, uptime = 1000, 1700000000, 12345.0
+    for _ in range(count):
+        stats_id += rng.choice((3, 4, 5))
+        timestamp += rng.choice((9, 10, 10, 11))
+        uptime += 10 + rng.random() / 50
+        columns['id'].append(stats_id)
+        columns['timestamp'].append(timestamp)
+        columns['cpu_usage'].append(round(rng.uniform(2, 40), 1))
+        columns['cpu_frequency'].append(rng.choice((600.0, 1500.0)))
+        columns['memory_used'].append(round(rng.gauss(800, 5), 2))
+        columns['memory_percentage'].append(round(rng.gauss(20, 0.2), 1))
+        columns['disk_used'].append(12.34)
+        columns['disk_percentage'].append(42.1)
+        columns['temperature'].append(round(rng.gauss(48, 1), 3))
+        columns['uptime'].append(uptime)
+        columns['amperage'].append(None)
+        columns['throttled'].append('0x0')
+        columns['voltages'].append(json.dumps({'core': 0.85}))
+    return columns
+
+
+class TestEncoding(unittest.TestCase):
+    """Test cases for the block encoding."""
+
+    def test_round_trip(self):
+        """Test that blocks decode to exactly what was encoded."""
+        columns = sample_columns(360)
+        columns['cpu_usage'][5] = None
+        columns['memory_used'][7] = float('inf')
+        columns['uptime'][9] = -0.0
+        payload = tsblock.encode_block(columns)
+        self.assertEqual(tsblock.decode_block(payload), columns)
+        # Far below the ~100 bytes of a stats row and its index entry.
+        self.assertLess(len(payload) / 360, 30)
+
+        single = {column: values[:1] for column, values in columns.items()}
+        self.assertEqual(tsblock.decode_block(tsblock.encode_block(single)),
+                         single)
+
+    def test_integer_extremes(self):
+        """Test ids and timestamps that do not fit the short ranges."""
+        writer = tsblock.BitWriter()
+        values = [0, -5, 10 ** 12, 10 ** 12, 2 ** 62, -2 ** 62, 7, 7, 8]
+        tsblock.encode_ints(writer, values)
+        tsblock.encode_ints(writer, values, order=1)
+        reader = tsblock.BitReader(writer.getvalue())
+        self.assertEqual(tsblock.decode_ints(reader, len(values)), values)
+        self.assertEqual(tsblock.decode_ints(reader, len(values), order=1),
+                         values)
+
+    def test_column_modes(self):
+        """Test that each REAL column takes its smallest encoding."""
+        self.assertEqual(tsblock.decimal_scale([12.3, 40.0]), 1)
+        self.assertEqual(tsblock.decimal_scale([48.125]), 3)
+        self.assertIsNone(tsblock.decimal_scale([1 / 3]))
+        self.assertIsNone(tsblock.decimal_scale([float('inf')]))
+
+        for values, mode in (([None, None], tsblock.ALL_NULL),
+                             ([12.5, None] + [13.5 + i for i in range(50)],
+                              tsblock.DELTA_OF_DELTA),
+                             ([20.5, 21.0] * 25, tsblock.DELTA),
+                             ([1 / 3, 2 / 3], tsblock.XOR)):
+            writer = tsblock.BitWriter()
+            tsblock.encode_column(writer, values)
+            reader = tsblock.BitReader(writer.getvalue())
+            self.assertEqual(tsblock.BitReader(writer.getvalue()).read(2),
+                             mode)
+            self.assertEqual(tsblock.decode_column(reader, len(values)),
+                             values)
+
+
+class TestCompaction(unittest.TestCase):
+    """Test cases for the compactor."""
+
+    def setUp(self):
+        """Create a database with two devices."""
+        db_fd, self.db_path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, self.db_path)
+        self.addCleanup(os.close, db_fd)
+        create_tables(db_path=self.db_path)
+        self.conn = sqlite3.connect(self.db_path)
+        self.addCleanup(self.conn.close)
+        for uid in ('a', 'b'):
+            self.conn.execute("INSERT INTO devices (device_uid) VALUES (?)",
+                              (uid,))
+        self.conn.commit()
+
+    def insert(self, device_id, epoch, cpu_usage):
+        """Insert a sample."""
+        self.conn.execute(
+            "INSERT INTO stats (device_id, timestamp, cpu_usage, voltages) "
+            "VALUES (?, ?, ?, '{}')",
+            (device_id, tsblock.format_timestamp(epoch), cpu_usage))
+        self.conn.commit()
+
+    def test_compact(self):
+        """Test that aged samples move to blocks and read back in order."""
+        base = 1700000000 // 3600 * 3600
+        for offset in range(0, 7200, 600):
+            self.insert(1, base + offset, offset / 100)
+            self.insert(2, base + offset + 1, offset / 10)
+        self.insert(1, base + 7200, 1.0)
+        expected = self.conn.execute(
+            f"SELECT {', '.join(tsblock.STATS_COLUMNS)} FROM stats "
+            "WHERE timestamp < ? ORDER BY id",
+            (tsblock.format_timestamp(base + 7200),)).fetchall()
+
+        self.assertEqual(tsblock.compact(self.conn, base + 7300), 24)
+        self.assertEqual(self.conn.execute(
+            "SELECT COUNT(*) FROM stats_blocks").fetchone()[0], 4)
+        self.assertEqual(self.conn.execute(
+            "SELECT COUNT(*) FROM stats").fetchone()[0], 1)
+
+        fleet = list(tsblock.archived_rows(self.conn, tsblock.STATS_COLUMNS))
+        self.assertEqual(fleet, expected)
+        newest = list(tsblock.archived_rows(
+            self.conn, ('id', 'cpu_usage'), [1], start=base + 600,
+            end=base + 1800, descending=True))
+        self.assertEqual([row[1] for row in newest], [12.0, 6.0])
+
+        # A late sample for an archived window is merged into its block.
+        self.insert(1, base + 5, 0.5)
+        self.assertEqual(tsblock.compact(self.conn, base + 7300), 1)
+        rows = list(tsblock.archived_rows(self.conn, ('cpu_usage',), [1],
+                                          end=base + 600))
+        self.assertEqual(rows, [(0.0,), (0.5,)])
+
+    def test_non_canonical_timestamps(self):
+        """Test that samples whose timestamps would change stay put and do
+        not hold up the rest of the device's history."""
+        base = 1700000000 // 3600 * 3600
+        self.conn.executemany(
+            "INSERT INTO stats (device_id, timestamp) VALUES (1, ?)",
+            [('2020-01-01 00:00:00.5',),
+             (tsblock.format_timestamp(base + 10) + '.5',)])
+        self.insert(1, base, 1.0)
+        self.insert(1, base + 20, 2.0)
+        self.insert(1, base + 3600, 3.0)
+        with self.assertLogs('tsblock', 'WARNING') as logs:
+            self.assertEqual(tsblock.compact(self.conn, base + 7200), 3)
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(self.conn.execute(
+            "SELECT COUNT(*) FROM stats").fetchone()[0], 2)
+        rows = list(tsblock.archived_rows(self.conn, ('cpu_usage',), [1]))
+        self.assertEqual(rows, [(1.0,), (2.0,), (3.0,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
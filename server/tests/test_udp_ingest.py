@@ -0,0 +1,88 @@
+"""Unit tests for the UDP ingest listener."""
+import socket
+import threading
+import unittest
+
+from udp_ingest import UdpListener, device_key, encode_datagram
+
+SECRET = 'test-secret'
+
+
+class TestUdpListener(unittest.TestCase):
+    """Test cases for the UDP ingest listener."""
+
+    def setUp(self):
+        """Set up a listener that records the samples it accepts and
+        keeps the last stored sequence number like the database does."""
+        self.samples = []
+        self.stored_sequence = {}
+        self.received = threading.Event()
+
+        def handler(device_id, sequence, version, interval, metrics):
+            if sequence <= self.stored_sequence.get(device_id, 0):
+                return 200
+            self.stored_sequence[device_id] = sequence
+            self.samples.append((device_id, version, interval, metrics))
+            self.received.set()
+            return 201
+
+        self.listener = UdpListener(SECRET, handler, '127.0.0.1', 0)
+
+    def datagram(self, sequence, device_id=7, key=None, **kwargs):
+        """Build a datagram for a device."""
+        return encode_datagram(key or device_key(SECRET, device_id),
+                               device_id, sequence,
+                               {'v': '1.0', 'i': 10, 'm': {'cpu': 1}},
+                               **kwargs)
+
+    def test_accepts_authenticated_datagrams(self):
+        """Test decoding of compressed and plain datagrams."""
+        self.assertEqual(self.listener.handle_datagram(self.datagram(1)),
+                         'stored')
+        self.assertEqual(self.listener.handle_datagram(
+            self.datagram(2, compress=False)), 'stored')
+        self.assertEqual(self.samples[0], (7, '1.0', 10, {'cpu': 1}))
+
+    def test_rejects_forged_and_malformed_datagrams(self):
+        """Test that bad signatures and garbage are dropped."""
+        forged = self.datagram(1, key=device_key('other', 7))
+        self.assertEqual(self.listener.handle_datagram(forged),
+                         'unauthenticated')
+        tampered = bytearray(self.datagram(1))
+        tampered[20] ^= 1
+        self.assertEqual(self.listener.handle_datagram(bytes(tampered)),
+                         'unauthenticated')
+        self.assertEqual(self.listener.handle_datagram(b'RM\x01'),
+                         'malformed')
+        self.assertEqual(self.samples, [])
+
+    def test_sequence_tracking(self):
+        """Test duplicate suppression and loss counting from gaps."""
+        for sequence in (1, 2, 2, 5, 4, 5000):
+            self.listener.handle_datagram(self.datagram(sequence))
+        stats = self.listener.stats()
+        self.assertEqual((stats['stored'], stats['duplicates'],
+                          stats['lost'], stats['restarts']), (4, 2, 2, 1))
+
+    def test_duplicates_stored_elsewhere(self):
+        """Test that the handler's answer drops replays this listener has
+        not seen itself."""
+        self.stored_sequence[7] = 10
+        self.assertEqual(self.listener.handle_datagram(self.datagram(9)),
+                         'duplicate')
+        self.assertEqual(self.listener.handle_datagram(self.datagram(11)),
+                         'stored')
+        self.assertEqual(self.listener.stats()['duplicates'], 1)
+
+    def test_socket(self):
+        """Test receiving a datagram over the loopback interface."""
+        self.listener.start()
+        port = self.listener.sock.getsockname()[1]
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            sender.sendto(self.datagram(1), ('127.0.0.1', port))
+        self.assertTrue(self.received.wait(5))
+        self.listener.sock.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+"""Helpers for converting between API time arguments and stored timestamps."""
+from datetime import datetime, timezone
+
+DB_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def parse_time(value):
+    """
+    Parse an API time argument into an aware UTC datetime.
+
+    Accepts Unix epoch seconds or an ISO-8601 string; naive ISO values are
+    taken to be UTC, like the timestamps SQLite stores. Returns None for
+    an empty value and raises ValueError for anything unparseable.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        dt = value
+    else:
+        try:
+            return datetime.fromtimestamp(float(value), tz=timezone.utc)
+        except (TypeError, ValueError):
+            pass
+        dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def to_db_timestamp(dt):
+    """Format a datetime the way SQLite's CURRENT_TIMESTAMP stores it."""
+    return dt.astimezone(timezone.utc).strftime(DB_TIMESTAMP_FORMAT)
@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+"""
+Compressed time-series blocks for aged samples.
+
+Samples older than ARCHIVE_AFTER_HOURS are only read as ranges (charts,
+exports), so the compactor moves them out of `stats` into one
+`stats_blocks` row per device and BLOCK_SECONDS window. Inside a block the
+columns are encoded one after another, Gorilla style:
+
+    id, timestamp   delta-of-delta: one bit while the spacing stays the
+                    same, 9 to 16 bits for the usual jitter
+    REAL columns    XOR with the previous value: one bit for an unchanged
+                    value, otherwise only the bits that differ. Columns
+                    that only hold short decimals (12.3 %, 48.25 °C) are
+                    stored as scaled integers with delta or delta-of-delta
+                    encoding instead, whichever is smallest.
+    TEXT columns    a zlib-compressed JSON list per column
+
+Decoding gives back the exact rows, and the readers of `stats` (history,
+latest, query, export) merge archived rows with the ones still in the
+table, so callers cannot tell them apart.
+
+    python tsblock.py [--db PATH] [--after-hours 24]
+
+runs the compactor once, e.g. from cron.
+"""
+import argparse
+import calendar
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import struct
+import time
+import zlib
+
+from timeutils import DB_TIMESTAMP_FORMAT
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.environ.get('RPI_MONITOR_DB', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'system_stats.db'
+))
+
+FORMAT_VERSION = 1
+BLOCK_SECONDS = 3600
+ARCHIVE_AFTER_HOURS = 24
+
+INT_COLUMNS = ('id', 'timestamp')
+FLOAT_COLUMNS = (
+    'cpu_usage', 'cpu_frequency', 'memory_used', 'memory_percentage',
+    'disk_used', 'disk_percentage', 'temperature', 'uptime', 'amperage'
+)
+TEXT_COLUMNS = ('throttled', 'voltages')
+# Columns of the stats table, in its order.
+STATS_COLUMNS = (
+    'id', 'device_id', 'timestamp', 'cpu_usage', 'cpu_frequency',
+    'memory_used', 'memory_percentage', 'disk_used', 'disk_percentage',
+    'temperature', 'uptime', 'throttled', 'voltages', 'amperage'
+)
+# Columns stored in a block (device_id is a column of the block row).
+BLOCK_COLUMNS = INT_COLUMNS + FLOAT_COLUMNS + TEXT_COLUMNS
+
+# Format version, number of samples, length of the bit stream in bytes.
+HEADER = struct.Struct('!BII')
+MASK64 = (1 << 64) - 1
+# Delta-of-delta ranges: (prefix, prefix bits, value bits). Larger values
+# take the prefix 0b1111 and 64 bits.
+DOD_RANGES = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12))
+# Encodings of a REAL column, chosen per block.
+XOR, DELTA, DELTA_OF_DELTA, ALL_NULL = range(4)
+# Most decimal places of a column stored as scaled integers.
+MAX_SCALE = 6
+# Scaled values stay below 2 ** 53, where floats are exact integers.
+MAX_SCALED = 2 ** 53 / 10 ** MAX_SCALE
+# NULL is stored as this NaN; SQLite never stores NaN in a REAL column.
+NULL_BITS = 0x7ff8000000000000
+DOUBLE = struct.Struct('!d')
+BITS = struct.Struct('!Q')
+
+
+class BitWriter:
+    """Appends values of any width to a byte string."""
+
+    __slots__ = ('buffer', 'acc', 'bits')
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.acc = 0
+        self.bits = 0
+
+    def write(self, value, bits):
+        """Append the lowest `bits` bits of a non-negative value."""
+        self.acc = (self.acc << bits) | value
+        self.bits += bits
+        while self.bits >= 8:
+            self.bits -= 8
+            self.buffer.append((self.acc >> self.bits) & 0xff)
+        self.acc &= (1 << self.bits) - 1
+
+    def __len__(self):
+        """Number of bits written."""
+        return len(self.buffer) * 8 + self.bits
+
+    def extend(self, other):
+        """Append everything written to another BitWriter."""
+        for byte in other.buffer:
+            self.write(byte, 8)
+        self.write(other.acc, other.bits)
+
+    def getvalue(self):
+        """Return the bytes written, the last one padded with zeros."""
+        if self.bits:
+            return bytes(self.buffer) + bytes(
+                [(self.acc << (8 - self.bits)) & 0xff])
+        return bytes(self.buffer)
+
+
+class BitReader:
+    """Reads values written by BitWriter."""
+
+    __slots__ = ('data', 'position')
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, bits):
+        """Return the next `bits` bits as a non-negative integer."""
+        start = self.position >> 3
+        end = (self.position + bits + 7) >> 3
+        chunk = int.from_bytes(self.data[start:end], 'big')
+        self.position += bits
+        return (chunk >> (end * 8 - self.position)) & ((1 << bits) - 1)
+
+    def read_flags(self, count):
+        """Return the next `count` bits as booleans, read at once."""
+        value = self.read(count)
+        return [bool(value >> shift & 1) for shift in range(count - 1, -1, -1)]
+
+
+def _signed(value):
+    return value - (1 << 64) if value >> 63 else value
+
+
+def encode_ints(writer, values, order=2):
+    """Write integers with delta (order 1) or delta-of-delta encoding."""
+    writer.write(values[0] & MASK64, 64)
+    previous, delta = values[0], 0
+    for value in values[1:]:
+        residual = value - previous - delta
+        if order == 2:
+            delta = value - previous
+        previous = value
+        if residual == 0:
+            writer.write(0, 1)
+            continue
+        for prefix, prefix_bits, bits in DOD_RANGES:
+            low = 1 - (1 << (bits - 1))
+            if low <= residual < low + (1 << bits):
+                writer.write(prefix, prefix_bits)
+                writer.write(residual - low, bits)
+                break
+        else:
+            writer.write(0b1111, 4)
+            writer.write(residual & MASK64, 64)
+
+
+def decode_ints(reader, count, order=2):
+    """Read `count` integers written by encode_ints()."""
+    previous = _signed(reader.read(64))
+    values = [previous]
+    delta = 0
+    for _ in range(count - 1):
+        residual = 0
+        if reader.read(1):
+            for *_, bits in DOD_RANGES:
+                if not reader.read(1):
+                    residual = reader.read(bits) + 1 - (1 << (bits - 1))
+                    break
+            else:
+                residual = _signed(reader.read(64))
+        # Residuals of 64 bits wrap around, like the values they encode.
+        if order == 2:
+            delta = _signed((delta + residual) & MASK64)
+            previous = _signed((previous + delta) & MASK64)
+        else:
+            previous = _signed((previous + residual) & MASK64)
+        values.append(previous)
+    return values
+
+
+def encode_floats(writer, values):
+    """Write floats (or None) XORed with their predecessor."""
+    previous = 0
+    # (leading, trailing) zeros of the last stored window; nothing fits
+    # before the first one.
+    window = (64, 64)
+    for value in values:
+        bits = NULL_BITS if value is None else \
+            BITS.unpack(DOUBLE.pack(float(value)))[0]
+        xor = bits ^ previous
+        previous = bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if leading >= window[0] and trailing >= window[1]:
+            # Fits the meaningful bits of the previous value.
+            writer.write(0b10, 2)
+            writer.write(xor >> window[1], 64 - window[0] - window[1])
+        else:
+            meaningful = 64 - leading - trailing
+            writer.write(0b11, 2)
+            writer.write(leading, 5)
+            writer.write(meaningful & 63, 6)
+            writer.write(xor >> trailing, meaningful)
+            window = (leading, trailing)
+
+
+def decode_floats(reader, count):
+    """Read `count` values written by encode_floats()."""
+    values = []
+    previous = 0
+    window = None
+    for _ in range(count):
+        if reader.read(1):
+            if reader.read(1):
+                leading = reader.read(5)
+                meaningful = reader.read(6) or 64
+                window = (leading, 64 - leading - meaningful)
+            previous ^= reader.read(64 - window[0] - window[1]) << window[1]
+        values.append(None if previous == NULL_BITS else
+                      DOUBLE.unpack(BITS.pack(previous))[0])
+    return values
+
+
+def decimal_scale(values):
+    """
+    Return the fewest decimal places (up to MAX_SCALE) that represent all
+    values exactly, or None.
+    """
+    if not all(abs(value) < MAX_SCALED for value in values):
+        return None
+    for scale in range(MAX_SCALE + 1):
+        factor = 10 ** scale
+        if all(round(value * factor) / factor == value for value in values):
+            return scale
+    return None
+
+
+def encode_column(writer, values):
+    """Write a REAL column in the encoding that takes the fewest bits."""
+    present = [value for value in values if value is not None]
+    if not present:
+        writer.write(ALL_NULL, 2)
+        return
+    candidates = []
+    xor = BitWriter()
+    xor.write(XOR, 2)
+    encode_floats(xor, values)
+    candidates.append(xor)
+
+    scale = decimal_scale(present)
+    if scale is not None:
+        factor = 10 ** scale
+        scaled = [round(value * factor) for value in present]
+        for mode, order in ((DELTA, 1), (DELTA_OF_DELTA, 2)):
+            candidate = BitWriter()
+            candidate.write(mode, 2)
+            candidate.write(scale, 3)
+            if len(present) < len(values):
+                candidate.write(1, 1)
+                for value in values:
+                    candidate.write(value is not None, 1)
+            else:
+                candidate.write(0, 1)
+            encode_ints(candidate, scaled, order)
+            candidates.append(candidate)
+    writer.extend(min(candidates, key=len))
+
+
+def decode_column(reader, count):
+    """Read a column written by encode_column()."""
+    mode = reader.read(2)
+    if mode == ALL_NULL:
+        return [None] * count
+    if mode == XOR:
+        return decode_floats(reader, count)
+    factor = 10 ** reader.read(3)
+    present = reader.read_flags(count) if reader.read(1) else [True] * count
+    scaled = iter(decode_ints(reader, sum(present),
+                              1 if mode == DELTA else 2))
+    return [next(scaled) / factor if flag else None for flag in present]
+
+
+def parse_timestamp(value):
+    """
+    Return the epoch seconds of a stored timestamp. Raises ValueError for
+    timestamps that would not be restored exactly.
+    """
+    epoch = calendar.timegm(time.strptime(value, DB_TIMESTAMP_FORMAT))
+    if format_timestamp(epoch) != value:
+        raise ValueError(f'Timestamp {value!r} is not in canonical form')
+    return epoch
+
+
+def format_timestamp(epoch):
+    """Format epoch seconds the way SQLite's CURRENT_TIMESTAMP stores it."""
+    return time.strftime(DB_TIMESTAMP_FORMAT, time.gmtime(epoch))
+
+
+def encode_block(columns):
+    """
+    Encode samples given as {column: [values]} for all BLOCK_COLUMNS, with
+    timestamps in epoch seconds. Returns the payload of a block.
+    """
+    count = len(columns['id'])
+    writer = BitWriter()
+    for column in INT_COLUMNS:
+        encode_ints(writer, columns[column])
+    for column in FLOAT_COLUMNS:
+        encode_column(writer, columns[column])
+    stream = writer.getvalue()
+    text = zlib.compress(json.dumps(
+        [columns[column] for column in TEXT_COLUMNS], separators=(',', ':')
+    ).encode())
+    return HEADER.pack(FORMAT_VERSION, count, len(stream)) + stream + text
+
+
+def decode_block(payload):
+    """Return the samples of a block as {column: [values]}."""
+    version, count, length = HEADER.unpack_from(payload)
+    if version != FORMAT_VERSION:
+        raise ValueError(f'Unknown block format {version}')
+    reader = BitReader(bytes(payload[HEADER.size:HEADER.size + length]))
+    columns = {}
+    for column in INT_COLUMNS:
+        columns[column] = decode_ints(reader, count)
+    for column in FLOAT_COLUMNS:
+        columns[column] = decode_column(reader, count)
+    texts = json.loads(zlib.decompress(payload[HEADER.size + length:]))
+    columns.update(zip(TEXT_COLUMNS, texts))
+    return columns
+
+
+def iter_blocks(conn, device_ids=None, start=None, end=None,
+                descending=False):
+    """
+    Yield (device_id, block_start, columns) of the blocks overlapping
+    [start, end) (epoch seconds), ordered by window and device.
+    """
+    conditions = []
+    params = []
+    if device_ids is not None:
+        conditions.append(
+            f"device_id IN ({','.join('?' for _ in device_ids)})")
+        params.extend(device_ids)
+    if start is not None:
+        conditions.append('block_end > ?')
+        params.append(start)
+    if end is not None:
+        conditions.append('block_start < ?')
+        params.append(end)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    order = 'DESC' if descending else ''
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(
+        f"SELECT device_id, block_start, payload FROM stats_blocks {where} "
+        f"ORDER BY block_start {order}, device_id",
+        params
+    )
+    try:
+        while True:
+            row = cursor.fetchone()
+            if row is None:
+                break
+            yield row[0], row[1], decode_block(row[2])
+    finally:
+        cursor.close()
+
+
+def archived_rows(conn, columns, device_ids=None, start=None, end=None,
+                  descending=False, epoch=False):
+    """
+    Yield archived samples in [start, end) (epoch seconds) as tuples of
+    `columns` (any of STATS_COLUMNS). A single device is ordered by time,
+    several by id within each block window. Timestamps are formatted like
+    stored ones unless `epoch` is set.
+    """
+    def window_rows(group):
+        rows = []
+        for device_id, _, block in group:
+            timestamps = block['timestamp']
+            block['device_id'] = itertools.repeat(device_id)
+            if not epoch:
+                block['timestamp'] = [format_timestamp(value)
+                                      for value in timestamps]
+            for timestamp, row in zip(timestamps, zip(
+                    *(block[column] for column in columns))):
+                if (start is None or timestamp >= start) and \
+                        (end is None or timestamp < end):
+                    rows.append(row)
+        if len(group) > 1:
+            # Blocks of different devices in one window interleave by id.
+            position = columns.index('id')
+            rows.sort(key=lambda row: row[position])
+        if descending:
+            rows.reverse()
+        return rows
+
+    blocks = iter_blocks(conn, device_ids, start, end, descending)
+    for _, group in itertools.groupby(blocks, key=lambda block: block[1]):
+        yield from window_rows(list(group))
+
+
+def _archive_block(conn, device_id, block_start, block_end):
+    """Move the samples of one device and window into a block; returns
+    the number of samples moved. Samples whose timestamps would not be
+    restored exactly are logged and left in `stats`."""
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Checked again under the write lock, in case another process
+        # archived the same window.
+        cursor.execute(f'''
+            SELECT {', '.join(BLOCK_COLUMNS)} FROM stats
+            WHERE device_id = ? AND timestamp >= ? AND timestamp < ?
+            ORDER BY timestamp, id
+        ''', (device_id, format_timestamp(block_start),
+              format_timestamp(block_end)))
+        rows, skipped = [], []
+        for row in cursor.fetchall():
+            try:
+                rows.append((row[0], parse_timestamp(row[1])) + row[2:])
+            except (ValueError, TypeError) as e:
+                logger.warning('Not archiving sample %s of device %s: %s',
+                               row[0], device_id, e)
+                skipped.append(row[0])
+        if not rows:
+            conn.rollback()
+            return 0
+        columns = {column: list(values)
+                   for column, values in zip(BLOCK_COLUMNS, zip(*rows))}
+
+        cursor.execute('''
+            SELECT payload FROM stats_blocks
+            WHERE device_id = ? AND block_start = ?
+        ''', (device_id, block_start))
+        existing = cursor.fetchone()
+        if existing is not None:
+            stored = decode_block(existing[0])
+            merged = sorted(zip(*(stored[column] + columns[column]
+                                  for column in BLOCK_COLUMNS)),
+                            key=lambda row: (row[1], row[0]))
+            columns = {column: list(values)
+                       for column, values in zip(BLOCK_COLUMNS, zip(*merged))}
+
+        cursor.execute('''
+            INSERT OR REPLACE INTO stats_blocks (
+                device_id, block_start, block_end, first_id, last_id,
+                samples, payload
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (device_id, block_start, block_end, min(columns['id']),
+              max(columns['id']), len(columns['id']),
+              encode_block(columns)))
+        cursor.execute(f'''
+            DELETE FROM stats
+            WHERE device_id = ? AND timestamp >= ? AND timestamp < ?
+              AND id NOT IN ({', '.join('?' * len(skipped))})
+        ''', (device_id, format_timestamp(block_start),
+              format_timestamp(block_end), *skipped))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return len(rows)
+
+
+def compact(conn, before, block_seconds=BLOCK_SECONDS):
+    """
+    Move the samples recorded before `before` (epoch seconds, rounded down
+    to a block boundary) into blocks, one transaction per block. Returns
+    the number of samples archived; samples with unparsable timestamps
+    are skipped and stay in `stats`.
+    """
+    cutoff = format_timestamp(int(before) // block_seconds * block_seconds)
+    device_ids = [row[0] for row in
+                  conn.execute('SELECT id FROM devices').fetchall()]
+    archived = 0
+    for device_id in device_ids:
+        # Timestamps compare as text; everything up to `done` is archived
+        # or skipped.
+        done = ''
+        while True:
+            oldest = conn.execute('''
+                SELECT MIN(timestamp) FROM stats
+                WHERE device_id = ? AND timestamp > ? AND timestamp < ?
+            ''', (device_id, done, cutoff)).fetchone()[0]
+            if oldest is None:
+                break
+            try:
+                block_start = (parse_timestamp(oldest)
+                               // block_seconds * block_seconds)
+            except (ValueError, TypeError) as e:
+                logger.warning('Not archiving samples of device %s at '
+                               '%s: %s', device_id, oldest, e)
+                done = oldest
+                continue
+            block_end = block_start + block_seconds
+            archived += _archive_block(conn, device_id, block_start,
+                                       block_end)
+            done = format_timestamp(block_end - 1)
+    return archived
+
+
+def block_ids(conn, condition, params):
+    """Return the sample ids stored in the blocks matching a condition."""
+    ids = []
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(f'SELECT payload FROM stats_blocks WHERE {condition}',
+                   params)
+    for (payload,) in cursor.fetchall():
+        ids.extend(decode_block(payload)['id'])
+    return ids
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description='Move aged samples into compressed archive blocks.'
+    )
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--after-hours', type=float,
+                        default=ARCHIVE_AFTER_HOURS,
+                        help='archive samples older than this')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    try:
+        archived = compact(conn, time.time() - args.after_hours * 3600)
+    finally:
+        conn.close()
+    print(f'Archived {archived} samples.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Optional UDP datagram ingest for very constrained clients.
+
+Each sample travels in one datagram, fire-and-forget:
+
+    header   magic "RM", format version, flags, device id (u64),
+             sequence number (u64), all big-endian
+    payload  JSON {"v": client version, "i": report interval, "m": metrics},
+             zlib-compressed when flag bit 0 is set
+    trailer  first 16 bytes of HMAC-SHA256(device key, header + payload)
+
+Device keys are derived from the server secret and the device id, so the
+server does not store them; clients receive theirs when they register.
+Senders number their datagrams with an increasing sequence number (clients
+start from their clock in milliseconds, so it also increases across
+restarts), which lets the server drop duplicates and replays and count
+lost datagrams from the gaps.
+
+Several worker processes of one server (never different shards, which
+have ports of their own) can listen on the same port (SO_REUSEPORT), so
+replay protection cannot rely on one process: the handler stores the
+last accepted sequence number of each device in the database, in the
+same transaction as the sample. Each listener also remembers the numbers
+it accepted itself, which drops most duplicates without a database write
+and counts the gaps of the devices the kernel sends to this worker.
+"""
+import hashlib
+import hmac
+import logging
+import socket
+import struct
+import threading
+import zlib
+
+from serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'RM'
+FORMAT_VERSION = 1
+FLAG_ZLIB = 0x01
+HEADER = struct.Struct('!2sBBQQ')
+MAC_SIZE = 16
+MAX_DATAGRAM = 65507
+
+# Jumps larger than this are treated as a client restart, not as loss.
+MAX_GAP = 1000
+
+
+def device_key(secret, device_id):
+    """Return the datagram signing key of a device."""
+    return hmac.new(secret.encode('utf-8'), f'device:{device_id}'.encode(),
+                    hashlib.sha256).digest()
+
+
+def encode_datagram(key, device_id, sequence, body, compress=True):
+    """Build a signed datagram (the format clients send)."""
+    payload = dumps(body)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= FLAG_ZLIB
+    message = HEADER.pack(MAGIC, FORMAT_VERSION, flags, device_id,
+                          sequence) + payload
+    return message + hmac.new(key, message, hashlib.sha256).digest()[:MAC_SIZE]
+
+
+class UdpListener:
+    """
+    Receives metric datagrams and hands valid ones to a handler.
+
+    handler(device_id, sequence, version, interval, metrics) returns an
+    HTTP status: 201 if the sample was stored, 200 if a sample with that
+    sequence number or a later one was stored before.
+    """
+
+    def __init__(self, secret, handler, host='0.0.0.0', port=5001):
+        self.secret = secret
+        self.handler = handler
+        self.address = (host, port)
+        self.counters = dict.fromkeys((
+            'received', 'stored', 'malformed', 'unauthenticated',
+            'duplicates', 'lost', 'restarts', 'rejected'
+        ), 0)
+        # Device id -> [key, last accepted sequence number]. Only devices
+        # that proved they hold their key are remembered.
+        self._devices = {}
+        self._lock = threading.Lock()
+        self.sock = None
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def _seen(self, device_id, sequence):
+        """Return True if this listener accepted the sequence already."""
+        with self._lock:
+            last = self._devices[device_id][1]
+            return last is not None and sequence <= last
+
+    def _accepted(self, device_id, sequence):
+        """Remember a stored sequence number; count gaps as loss."""
+        with self._lock:
+            device = self._devices[device_id]
+            last = device[1]
+            if last is not None and sequence > last:
+                gap = sequence - last - 1
+                if gap > MAX_GAP:
+                    self.counters['restarts'] += 1
+                else:
+                    self.counters['lost'] += gap
+            if last is None or sequence > last:
+                device[1] = sequence
+
+    def handle_datagram(self, data):
+        """Verify, decode and store one datagram. Returns the outcome."""
+        self._count('received')
+        verified = self._verify(data)
+        outcome = verified if isinstance(verified, str) else \
+            self._store(*verified)
+        self._count('duplicates' if outcome == 'duplicate' else outcome)
+        return outcome
+
+    def _verify(self, data):
+        """
+        Return (device_id, sequence, flags, payload) of an authentic
+        datagram, or the outcome of a bad one.
+        """
+        if len(data) < HEADER.size + MAC_SIZE:
+            return 'malformed'
+        message, mac = data[:-MAC_SIZE], data[-MAC_SIZE:]
+        magic, version, flags, device_id, sequence = HEADER.unpack_from(
+            message)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            return 'malformed'
+        device = self._devices.get(device_id)
+        key = device[0] if device else device_key(self.secret, device_id)
+        expected = hmac.new(key, message, hashlib.sha256).digest()[:MAC_SIZE]
+        if not hmac.compare_digest(mac, expected):
+            return 'unauthenticated'
+        self._devices.setdefault(device_id, [key, None])
+        return device_id, sequence, flags, message[HEADER.size:]
+
+    def _store(self, device_id, sequence, flags, payload):
+        """Decode an authentic datagram and hand it to the handler."""
+        if self._seen(device_id, sequence):
+            return 'duplicate'
+        try:
+            if flags & FLAG_ZLIB:
+                payload = zlib.decompress(payload)
+            body = loads(payload)
+            status = self.handler(device_id, sequence, body.get('v'),
+                                  body.get('i'), body['m'])
+        except (ValueError, KeyError, TypeError, AttributeError,
+                zlib.error) as e:
+            logger.debug('Malformed datagram from device %s: %s',
+                         device_id, e)
+            return 'malformed'
+        if status == 201:
+            self._accepted(device_id, sequence)
+            return 'stored'
+        # 200: stored before, possibly through another worker.
+        return 'duplicate' if status == 200 else 'rejected'
+
+    def stats(self):
+        """Return the listener counters."""
+        with self._lock:
+            return dict(self.counters, devices=len(self._devices))
+
+    def start(self):
+        """Bind the socket and start the receive thread (once per process)."""
+        with self._lock:
+            if self.sock is not None:
+                return
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(self.address)
+            self.sock = sock
+            threading.Thread(target=self._run, daemon=True,
+                             name='udp-ingest').start()
+        logger.info('Listening for metric datagrams on %s:%s',
+                    *self.address)
+
+    def _run(self):
+        while True:
+            try:
+                data, _ = self.sock.recvfrom(MAX_DATAGRAM)
+            except OSError:
+                return
+            try:
+                self.handle_datagram(data)
+            except Exception:
+                logger.exception('Failed to ingest a datagram')